@@ -0,0 +1,34 @@
+"""
+Compile the taxdump files of a taxonomy database into the binary snapshot
+loaded by the tabulate steps (taxonomy.snapshot inside the same directory).
+
+Usage:
+  python compile_taxonomy_snapshot.py <taxdump_dir> [--output <snapshot_file>] [--nprocesses <n>]
+"""
+import os, sys, time, argparse
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utilities.taxonomy_snapshot import compile_taxonomy_snapshot, load_taxonomy_snapshot
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Compile taxdump files into a taxonomy snapshot.")
+  parser.add_argument("taxonomy_database", help="directory containing names.dmp, nodes.dmp and merged.dmp")
+  parser.add_argument("--output", default="", help="snapshot file (default: <taxonomy_database>/taxonomy.snapshot)")
+  parser.add_argument("--nprocesses", type=int, default=1, help="number of processes parsing the taxdump files")
+  args = parser.parse_args()
+  
+  # Start the timer
+  start_time = time.time()
+  snapshot_file = compile_taxonomy_snapshot(args.taxonomy_database, args.output, args.nprocesses)
+  print(f"Compile time: {time.time() - start_time:.3f} seconds")
+  
+  # Restart the timer
+  start_time = time.time()
+  snapshot = load_taxonomy_snapshot(snapshot_file)
+  print(f"Loaded {len(snapshot)} nodes in: {time.time() - start_time:.3f} seconds")
+
+
+
+if __name__ == "__main__":
+  main()
@@ -49,6 +49,19 @@ def create_valid_taxid_list(taxonomy_tree, metadata_file, taxid_index, excluded_
 
 
 
+def get_subtree_node(taxonomy_tree, taxid):
+  # node of the subtree root, merged taxids are not the taxid of any lineage
+  node = taxonomy_tree.get(taxid, None)
+  return node if node is not None and node.taxid == taxid else None
+
+
+def write_taxid_list(taxids, output_file):
+  sorted_taxids = sorted(taxids)
+  with open(output_file, "w") as file:
+    file.write("\n".join(sorted_taxids))    
+    file.write("\n")
+
+
 def create_valid_taxid_list(taxonomy_tree, output_file, include_subtree='1', exclude_subtree='0'):
   """
   Creates a list of all tax ids excluding the excluded_taxid and all its subtree.
@@ -60,23 +73,43 @@ def create_valid_taxid_list(taxonomy_tree, output_file, include_subtree='1', exc
   - output_file: Path to the output file that will contains all valid tax ids.
   """
   valid_taxids = set()
-  for taxid, node in taxonomy_tree.items():
-    valid_taxid, exclude_taxid = False, False
-    current_node = node
-    while current_node is not None:
-      valid_taxid = valid_taxid or (current_node.taxid == include_subtree)
-      exclude_taxid = exclude_taxid or (current_node.taxid == exclude_subtree)
-      current_node = current_node.parent
-    if valid_taxid and not exclude_taxid:
-      valid_taxids.add(taxid)
-  
-  sorted_taxids = sorted(valid_taxids)
-  with open(output_file, "w") as file:
-    file.write("\n".join(sorted_taxids))    
-    file.write("\n")
+  include_node = get_subtree_node(taxonomy_tree, include_subtree)
+  exclude_node = get_subtree_node(taxonomy_tree, exclude_subtree)
+  if include_node is not None:
+    # the Euler tour intervals tell if the node is in each subtree
+    for taxid, node in taxonomy_tree.items():
+      if (node.is_descendant_of(include_node) and
+          (exclude_node is None or not node.is_descendant_of(exclude_node))):
+        valid_taxids.add(taxid)
+  
+  write_taxid_list(valid_taxids, output_file)
   return valid_taxids
 
 
+def create_clade_taxid_lists(taxonomy_tree, output_file_by_taxid):
+  """
+  Creates the list of the tax ids of each clade, with all clades filled in a single
+  pass over the taxonomy tree.
+  
+  Parameters:
+  - taxonomy_tree: complete taxonomy tree.
+  - output_file_by_taxid: tax id of each clade root to the output file of its list.
+  
+  Returns:
+  - dict: tax id of each clade root to the set of tax ids in the clade.
+  """
+  clade_taxids = {taxid: set() for taxid in output_file_by_taxid}
+  clade_nodes = [(taxid, get_subtree_node(taxonomy_tree, taxid)) for taxid in output_file_by_taxid]
+  clade_nodes = [(taxid, node) for taxid, node in clade_nodes if node is not None]
+  for taxid, node in taxonomy_tree.items():
+    for clade_taxid, clade_node in clade_nodes:
+      if node.is_descendant_of(clade_node):
+        clade_taxids[clade_taxid].add(taxid)
+  for clade_taxid, output_file in output_file_by_taxid.items():
+    write_taxid_list(clade_taxids[clade_taxid], output_file)
+  return clade_taxids
+
+
 
 # def main_remove_viral_genomes_from_level():  
 #   fasta_file = "/home/pedro/aesop/viruses_pipeline/viruses_genomes/viral_genomes.fasta"
@@ -165,33 +198,20 @@ def main_create_valid_taxons_list():
   
   # acc_list = create_valid_taxid_list(taxid_tree, output_file, root_taxid, none_taxid)
   # print(f"Found {len(acc_list)} root_taxid.")
-  output_file = os.path.join(taxdump_dir, "viruses.txt")
-  acc_list = create_valid_taxid_list(taxid_tree, output_file, viruses_taxid, none_taxid)
-  print(f"Found {len(acc_list)} viruses_taxid.")
-
-  output_file = os.path.join(taxdump_dir, "coronaviridae.txt")
-  acc_list = create_valid_taxid_list(taxid_tree, output_file, coronaviridae_taxid, none_taxid)
-  print(f"Found {len(acc_list)} coronaviridae_taxid.")
-  
-  output_file = os.path.join(taxdump_dir, "betacoronavirus.txt")
-  acc_list = create_valid_taxid_list(taxid_tree, output_file, betacoronavirus_taxid, none_taxid)
-  print(f"Found {len(acc_list)} betacoronavirus_taxid.")
-  
-  output_file = os.path.join(taxdump_dir, "sars_cov2_species.txt")
-  acc_list = create_valid_taxid_list(taxid_tree, output_file, sars_cov2_species_taxid, none_taxid)
-  print(f"Found {len(acc_list)} sars_cov_taxid.")
-  
-  output_file = os.path.join(taxdump_dir, "alphainfluenzavirus.txt")
-  acc_list = create_valid_taxid_list(taxid_tree, output_file, alphainfluenzavirus_taxid, none_taxid)
-  print(f"Found {len(acc_list)} alphainfluenzavirus_taxid.")
-  
-  output_file = os.path.join(taxdump_dir, "enterovirus.txt")
-  acc_list = create_valid_taxid_list(taxid_tree, output_file, enterovirus_taxid, none_taxid)
-  print(f"Found {len(acc_list)} enterovirus_taxid.")
-  
-  output_file = os.path.join(taxdump_dir, "orthoflavivirus.txt")
-  acc_list = create_valid_taxid_list(taxid_tree, output_file, orthoflavivirus_taxid, none_taxid)
-  print(f"Found {len(acc_list)} orthoflavivirus_taxid.")
+  clade_names = {
+    viruses_taxid: "viruses",
+    coronaviridae_taxid: "coronaviridae",
+    betacoronavirus_taxid: "betacoronavirus",
+    sars_cov2_species_taxid: "sars_cov2_species",
+    alphainfluenzavirus_taxid: "alphainfluenzavirus",
+    enterovirus_taxid: "enterovirus",
+    orthoflavivirus_taxid: "orthoflavivirus",
+  }
+  output_file_by_taxid = {taxid: os.path.join(taxdump_dir, f"{name}.txt")
+    for taxid, name in clade_names.items()}
+  clade_taxids = create_clade_taxid_lists(taxid_tree, output_file_by_taxid)
+  for taxid, name in clade_names.items():
+    print(f"Found {len(clade_taxids[taxid])} {name}_taxid.")
   # filter_virus_genomes_efficiently(fasta_file, acc_list, output_file, buffer_size)
   
   # End the timer
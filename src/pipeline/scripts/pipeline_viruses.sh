@@ -153,7 +153,8 @@ run_pipeline_step "tabulate_blastn" "$dataset_name" "$base_dataset_path" \
   "${args_dict[tabulate_blastn_count_reads_folder]}" \
   "${args_dict[tabulate_blastn_count_reads_extension]}" \
   "${args_dict[tabulate_blastn_mapping_folder]}" \
-  "${args_dict[tabulate_blastn_kraken_folder]}"
+  "${args_dict[tabulate_blastn_kraken_folder]}" \
+  "${args_dict[tabulate_blastn_kraken_confidences]}"
 
 
 ## FILTER CONTIGS NOT CLASSIFIED
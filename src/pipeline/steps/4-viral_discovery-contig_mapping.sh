@@ -21,6 +21,8 @@ echo() {
 }
 # exit when any command fails
 set -e
+# fail when the aligner fails in the middle of the pipe
+set -o pipefail
 # keep track of the last executed command
 trap 'last_command=$current_command; current_command=$BASH_COMMAND' DEBUG
 # echo an error message before exiting
@@ -52,7 +54,8 @@ output_prefix="${output_dir}/${input_id}"
 
 bowtie2_script=$BOWTIE2_EXECUTABLE
 bowtie2_build_script=$BOWTIE2_BUILD_EXECUTABLE
-samtools_script=$SAMTOOLS_EXECUTABLE
+# folder of this script, with the python post processing of the alignments
+script_dir=$(dirname "$(readlink -f "$0")")
 
 
 # if not exists input
@@ -75,53 +78,14 @@ fi
   echo "Indexing contigs with Bowtie2..."
   $bowtie2_build_script $input_contigs ${output_prefix}_contigs_index
   
-  # Step 2: Align the Paired-End Reads to the Contigs using Bowtie2
-  echo "Aligning reads with Bowtie2..."
-  $bowtie2_script -x ${output_prefix}_contigs_index --threads $nthreads -1 $input_file1 -2 $input_file2 -S "${output_prefix}_aligned.sam"
-  
-  # Step 3: Convert SAM to BAM, Sort, and Index using Samtools
-  echo "Converting SAM to BAM, sorting, and indexing..."
-  $samtools_script view -Sb "${output_prefix}_aligned.sam" > "${output_prefix}_aligned.bam"
-  $samtools_script sort "${output_prefix}_aligned.bam" -o "${output_prefix}_sorted_aligned.bam"
-  $samtools_script index "${output_prefix}_sorted_aligned.bam"
-  
-  # Step 4: Calculate Coverage per Contig using Samtools
-  echo "Calculating coverage for each contig..."
-  $samtools_script depth "${output_prefix}_sorted_aligned.bam" > "${output_prefix}_coverage.tsv"
-  
-  # Step 5: Print per-contig read counts and coverage
-  echo "Generating read count per contig and coverage summary..."
-  
-  # Get contig read counts and coverage
-  $samtools_script idxstats "${output_prefix}_sorted_aligned.bam" > "${output_prefix}_contig_read_counts.tsv"
-  
-  printf "Contig\tReference_Length\tTotal_Reads\tCoverage\n" > "${output_prefix}_contig_stats.tsv"
-  
-  # Combine read counts and coverage in one report
-  while read -r contig; do
-    # Extract the number of reads that mapped to the current contig
-    reference_length=$(grep "^$contig\s" "${output_prefix}_contig_read_counts.tsv" | cut -f2)
-    
-    # Extract the number of reads that mapped to the current contig
-    reads_mapped=$(grep "^$contig\s" "${output_prefix}_contig_read_counts.tsv" | cut -f3)
-    
-    # Calculate total coverage for the current contig
-    total_coverage=$(grep "^$contig\s" "${output_prefix}_coverage.tsv" | awk 'BEGIN {sum = 0} {sum += $3} END {print sum}')
-    
-    # Output the results (use 0 for coverage if it's not found)
-    printf "${contig}\t${reference_length}\t${reads_mapped}\t${total_coverage:-0}\n" >> "${output_prefix}_contig_stats.tsv"
-    
-    # Step 6: Extract reads mapped to the current contig
-    echo "Extracting reads mapped to $contig..."
-    
-    # Use samtools to extract all reads mapped to the contig
-    $samtools_script view "${output_prefix}_sorted_aligned.bam" "$contig" | \
-      awk -v contig_name="$contig" '{print contig_name "\t" $1}' >> "${output_prefix}_contig_reads.tsv"
-    
-  done < <(grep ">" "$input_contigs" | sed 's/>//')
+  # Step 2: Align the Paired-End Reads to the Contigs using Bowtie2 and summarize the
+  # SAM stream, writing the read counts, coverage, stats and reads of each contig
+  echo "Aligning reads with Bowtie2 and calculating contig coverage..."
+  $bowtie2_script -x ${output_prefix}_contigs_index --threads $nthreads -1 $input_file1 -2 $input_file2 | \
+    PYTHONPATH="${script_dir}/../..:${PYTHONPATH}" python "${script_dir}/4-viral_discovery-contig_mapping_stats.py" "${output_prefix}"
   
   echo "Cleaning intermediate files..."
-  rm -rvf ${output_prefix}_contigs_index* ${output_prefix}_aligned* ${output_prefix}_sorted*
+  rm -rvf ${output_prefix}_contigs_index*
   
   echo "Mapping and coverage calculation completed."
   echo "Results are stored in ${output_prefix}_contig_stats.tsv"
@@ -0,0 +1,31 @@
+import os, sys
+sys.path.append("/home/pedro/aesop/github/aesop-metagenomics-pipeline/src")
+sys.path.append("/home/pablo.viana/jobs/github/aesop-metagenomics-pipeline/src")
+sys.path.append("/mnt/c/Users/pablo/Documents/github/aesop-metagenomics-pipeline/src")
+
+import utilities.contig_mapping_parser as ContigMappingParser
+
+# Post processing of 4-viral_discovery-contig_mapping.sh, reads the SAM output of
+# bowtie2 from the standard input and writes the contig mapping tables.
+#   $1 output_prefix
+
+
+def main():
+  output_prefix = sys.argv[1]
+  print(f"Parameters: {sys.argv}")
+
+  # Create the folder to place the output if it doesn't exist
+  os.makedirs(os.path.dirname(os.path.abspath(output_prefix)), exist_ok=True)
+
+  contig_mapping = ContigMappingParser.parse_sam_stream(sys.stdin.buffer)
+  print(f"Contigs: {len(contig_mapping.contig_names)} "
+    f"Records on contigs: {len(contig_mapping.read_names)} "
+    f"Unplaced unmapped reads: {contig_mapping.unplaced_count}")
+  ContigMappingParser.write_contig_mapping(contig_mapping, output_prefix)
+
+  # Print end message
+  print("Finished!")
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,102 @@
+import os, sys
+sys.path.append("/home/pedro/aesop/github/aesop-metagenomics-pipeline/src")
+sys.path.append("/home/pablo.viana/jobs/github/aesop-metagenomics-pipeline/src")
+sys.path.append("/mnt/c/Users/pablo/Documents/github/aesop-metagenomics-pipeline/src")
+
+import utilities.taxonomy_tree_parser as TaxonomyParser
+import utilities.fastq_read_info as FastqReadInfo
+import utilities.kraken_output_parser as KrakenOutputParser
+
+# Extraction of 4-viral_discovery-extract_reads.sh, writes the read pairs classified
+# by kraken to any of the taxons, or to their children, in one pass over the files.
+#   $1 kraken_output $2 kraken_report $3 taxons (comma separated) $4 input_file1
+#   $5 input_file2 $6 output_fastq1 (.gz) $7 output_fastq2 (.gz) $8 nthreads
+
+
+def get_taxids_with_children(kraken_report, taxons):
+  """
+  Expand the taxons to the set of their taxids and of their children in the kraken report.
+  Parameters:
+    kraken_report (str): kraken report file
+    taxons (list): taxids of the taxons to extract
+  Returns:
+    set: taxids to extract
+  """
+  _, report_tree = TaxonomyParser.load_tree_from_kraken_report(kraken_report)
+  taxids = set()
+  for taxon in taxons:
+    # the taxon is extracted even if it is not in the report
+    taxids.add(taxon)
+    if taxon not in report_tree:
+      print(f"Taxon not found in kraken report: {taxon}")
+      continue
+    children_nodes = report_tree[taxon].get_all_nodes()
+    taxids.update(node.taxid for node in children_nodes)
+    print(f"Taxon {taxon} with {len(children_nodes)} taxids to extract")
+  return taxids
+
+
+def get_read_id(record_id):
+  # kraken removes the mate suffix from the read ids
+  if record_id.endswith("/1") or record_id.endswith("/2"):
+    return record_id[:-2]
+  return record_id
+
+
+def write_fastq_record(file, header, sequence, quality):
+  # same record written by the kraken tools extraction, without the title after '+'
+  file.write(header.rstrip() + b"\n" + sequence.rstrip() + b"\n+\n" + quality.rstrip() + b"\n")
+
+
+def extract_read_pairs(read_names, input_file1, input_file2, output_file1, output_file2, nthreads=1):
+  """
+  Write the read pairs with the given names, reading both mates in lock-step.
+  Returns:
+    int: number of records written of each mate
+  """
+  write_counts = [0, 0]
+  with FastqReadInfo.open_fastq_bytes(input_file1) as fastq1, \
+       FastqReadInfo.open_fastq_bytes(input_file2) as fastq2, \
+       FastqReadInfo.open_gzip_writer(output_file1, nthreads) as out_file1, \
+       FastqReadInfo.open_gzip_writer(output_file2, nthreads) as out_file2:
+    records1 = FastqReadInfo.iter_fastq_lines(fastq1)
+    records2 = FastqReadInfo.iter_fastq_lines(fastq2)
+    for record1, record2 in zip(records1, records2):
+      if get_read_id(record1[0]) in read_names:
+        write_fastq_record(out_file1, record1[1], record1[2], record1[4])
+        write_counts[0] += 1
+      if get_read_id(record2[0]) in read_names:
+        write_fastq_record(out_file2, record2[1], record2[2], record2[4])
+        write_counts[1] += 1
+    if next(records1, None) is not None or next(records2, None) is not None:
+      print(f"Paired files with different number of reads: {input_file1} {input_file2}")
+  return write_counts
+
+
+def main():
+  kraken_output = sys.argv[1]
+  kraken_report = sys.argv[2]
+  taxons = [taxon.strip() for taxon in sys.argv[3].split(",") if taxon.strip() != ""]
+  input_file1 = sys.argv[4]
+  input_file2 = sys.argv[5]
+  output_fastq1 = sys.argv[6]
+  output_fastq2 = sys.argv[7]
+  nthreads = int(sys.argv[8]) if len(sys.argv) > 8 else 1
+  print(f"Parameters: {sys.argv}")
+
+  # Create the folder to place the output if it doesn't exist
+  os.makedirs(os.path.dirname(os.path.abspath(output_fastq1)), exist_ok=True)
+
+  taxids = get_taxids_with_children(kraken_report, taxons)
+  read_names = KrakenOutputParser.get_read_names_by_taxids(kraken_output, taxids)
+  print(f"Reads to extract: {len(read_names)}")
+  write_counts = extract_read_pairs(read_names, input_file1, input_file2,
+    output_fastq1, output_fastq2, nthreads)
+  print(f"Reads written: {write_counts[0]} {output_fastq1} {write_counts[1]} {output_fastq2}")
+
+  # Print end message
+  print("Finished!")
+
+
+if __name__ == '__main__':
+  main()
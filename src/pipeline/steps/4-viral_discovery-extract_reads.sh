@@ -33,7 +33,7 @@ input_file=$2
 input_suffix=$3
 input_dir=$4
 output_dir=$5
-# nthreads=$6 # NOT USED
+nthreads=$6
 kraken_output_dir=$7
 taxons=$8
 
@@ -47,15 +47,14 @@ input_suffix2=${input_suffix2/_1./_2.}
 input_file1="${input_dir}/${input_id}${input_suffix1}"
 input_file2="${input_dir}/${input_id}${input_suffix2}"
 
-output_fastq1="${output_dir}/${input_id}_1.fastq"
-output_fastq2="${output_dir}/${input_id}_2.fastq"
-tmp_output_fastq1="${output_dir}/tmp_${input_id}_1.fastq"
-tmp_output_fastq2="${output_dir}/tmp_${input_id}_2.fastq"
+output_fastq1="${output_dir}/${input_id}_1.fastq.gz"
+output_fastq2="${output_dir}/${input_id}_2.fastq.gz"
 
 kraken_report="${kraken_output_dir}/${input_id}.kreport"
 kraken_output="${kraken_output_dir}/${input_id}.kout"
 
-extract_reads_script=$EXTRACT_READS_EXECUTABLE
+# folder of this script, with the python extraction of the reads
+script_dir=$(dirname "$(readlink -f "$0")")
 
 # if exists output
 if [ -f $output_fastq1 ]; then
@@ -79,33 +78,10 @@ fi
   
   echo "Started task Input: $2 Count: $1"
   
-  # Initialize output as empty files
-  > $output_fastq1
-  > $output_fastq1
-  
-  IFS=',' read -r -a taxon_array <<< "$taxons"
-  # Iterate over each taxon in the list and extract reads
-  for taxon in "${taxon_array[@]}"; do
-    # Run extract_reads_script for the current taxon
-    echo "Running extract kraken reads command: "
-    echo "$extract_reads_script -k $kraken_output -r $kraken_report -t $taxon --include-children" \
-      "-s $input_file1 -s2 $input_file2 --fastq-output -o $tmp_output_fastq1 -o2 $tmp_output_fastq2"
-    $extract_reads_script -k $kraken_output -r $kraken_report -t $taxon --include-children \
-      -s $input_file1 -s2 $input_file2 --fastq-output -o $tmp_output_fastq1 -o2 $tmp_output_fastq2
-    
-    # Concatenate the current output to the final combined output
-    cat $tmp_output_fastq1 >> $output_fastq1
-    cat $tmp_output_fastq2 >> $output_fastq2
-    
-    # Remove the temporary output files to avoid duplication in the next iteration
-    rm -f $tmp_output_fastq1 $tmp_output_fastq2
-  done
-  
-  echo "gzip $output_fastq1"
-  gzip $output_fastq1
-  
-  echo "gzip $output_fastq2"
-  gzip $output_fastq2
+  # Extract the reads of all taxons, with their children, in one pass over the files
+  echo "Running extract reads of taxons: $taxons"
+  PYTHONPATH="${script_dir}/../..:${PYTHONPATH}" python "${script_dir}/4-viral_discovery-extract_reads.py" \
+    $kraken_output $kraken_report $taxons $input_file1 $input_file2 $output_fastq1 $output_fastq2 $nthreads
   
   # Finish script profile
   finish=$(date +%s.%N)
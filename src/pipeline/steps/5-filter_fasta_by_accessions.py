@@ -1,47 +1,10 @@
 import sys, os, csv
 from datetime import datetime, timezone
+sys.path.append("/home/pedro/aesop/github/aesop-metagenomics-pipeline/src")
+sys.path.append("/home/pablo.viana/jobs/github/aesop-metagenomics-pipeline/src")
+sys.path.append("/mnt/c/Users/pablo/Documents/github/aesop-metagenomics-pipeline/src")
 
-
-def filter_virus_genomes_efficiently(fasta_file, valid_accessions, output_file, buffer_size=100000):
-  """
-  Efficiently filters a large FASTA file to exclude genomes from a specific accessions.  
-  Parameters:
-  - fasta_path: Path to the input FASTA file.
-  - valid_accessions: List of valid accessions to include in the output.
-  - output_path: Path to the output FASTA file.
-  - buffer_size: Number of lines to batch before writing to disk.
-  """
-  print(f"Valid accessions to write: {len(valid_accessions)}")
-  with open(output_file, "w") as out_file:
-    out_file.write("")
-  
-  write_count = 0  
-  write_flag = False
-  buffer = []  # Buffer to accumulate lines for batch writing
-  
-  # Step 2: Process the FASTA file in chunks and batch write
-  with open(fasta_file, "r") as in_file:
-    for line in in_file:
-      if line.startswith(">"):  # Header line
-        accession = line.split()[0][1:]  # Extract accession (remove ">")
-        write_flag = accession in valid_accessions
-        # print(f"{accession}: {write_flag}")      
-      if write_flag:
-        buffer.append(line)      
-      # Flush buffer to file when it reaches the buffer size
-      if len(buffer) >= buffer_size:  
-        with open(output_file, "a") as out_file:
-          out_file.writelines(buffer)
-          write_count += 1
-        buffer.clear()
-        
-  # Write any remaining lines in the buffer
-  if len(buffer) > 0:
-    with open(output_file, "a") as out_file:
-      out_file.writelines(buffer)
-      write_count += 1
-  print(f"Count blocks written: {write_count}")
-
+import utilities.fasta_filter as FastaFilter
 
 
 def main():
@@ -67,7 +30,8 @@ def main():
     for row in csv_reader:
       valid_accessions.add(row[0].strip())
   
-  filter_virus_genomes_efficiently(fasta_file, valid_accessions, output_file, buffer_size=100000)
+  # the index of the contigs is reused by the next filters of the same contigs
+  FastaFilter.filter_fasta_records(fasta_file, valid_accessions, output_file, build_index=True)
 
 
 
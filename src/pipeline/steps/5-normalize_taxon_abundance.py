@@ -86,7 +86,9 @@ def main():
   file = input_file
   
   print(f"Analyzing input file: {file}")
-  total_reads = get_total_abundance(file)
+  # the read count is cached with the outputs, not in the input folder
+  os.makedirs(output_path, exist_ok=True)
+  total_reads = get_total_abundance(file, cache_dir=output_path)
   print(f"Total reads on input fastq: {total_reads}")
   filename = os.path.basename(file).split(input_extension)[0].replace("_metadata", "")
   
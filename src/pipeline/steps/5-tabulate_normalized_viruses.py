@@ -5,12 +5,13 @@ sys.path.append("/home/pablo.viana/jobs/github/aesop-metagenomics-pipeline/src")
 sys.path.append("/mnt/c/Users/pablo/Documents/github/aesop-metagenomics-pipeline/src")
 
 import utilities.taxonomy_tree_parser as TaxonomyParser
+import utilities.taxonomy_array_tree as TaxonomyArrayTree
 import utilities.normalize_classified_matches as ClassifiedMatches
 
 
 def tabulate_known_viruses(classified_tree, input_count_reads_path, count_reads_extension,
       input_mapping_path, align_filters, input_alignment_path, input_kraken_path,
-      kraken_folder, filename, output_path):
+      kraken_folder, filename, output_path, compact_mapped_reads=False, nthreads=1):
   """
   Tabulates known viruses by creating a ground truth tree from mock data, setting up
   confusion matrices for BLAST and Kraken classification results.
@@ -25,6 +26,8 @@ def tabulate_known_viruses(classified_tree, input_count_reads_path, count_reads_
     kraken_folder: The folder containing Kraken results.
     filename: The base filename for input and output files.
     output_path: Path to the directory where output files will be saved.
+    compact_mapped_reads: Count the mapped reads in a compact table of read name hashes.
+    nthreads: Number of processes used to get the alignment results of the contigs.
   Processes:
   1. Loads the count read file to determine read abudance and contig abundance.
   2. Sets up the alignment normalization by loading the alignment result, applying alignment filters, and performing the calculation.
@@ -38,7 +41,7 @@ def tabulate_known_viruses(classified_tree, input_count_reads_path, count_reads_
   output_file = os.path.join(output_path, filename + "_ground_truth.csv")
   # create the ground truth tree with the real taxa from the mocks and the number of reads from each one
   total_abundance, contig_read_count, mapped_reads = ClassifiedMatches.load_read_count( 
-    count_reads_file, count_reads_extension, mapping_file, output_file)
+    count_reads_file, count_reads_extension, mapping_file, output_file, compact_mapped_reads)
   
   #######################################################################################################
   # GET ALIGNMENT NORMALIZATION
@@ -48,7 +51,7 @@ def tabulate_known_viruses(classified_tree, input_count_reads_path, count_reads_
   output_matches_file = os.path.join(output_path, filename + "_contig_matched_alignment.csv")
   # load alignment tree
   ClassifiedMatches.load_alignment_tree(classified_tree, contig_read_count, 
-    alignment_file, align_filters, output_unmatches_file, output_matches_file)
+    alignment_file, align_filters, output_unmatches_file, output_matches_file, nthreads)
   # Calculate normalization for alignment results
   output_file = os.path.join(output_path, filename + "_alignment_report.csv")
   ClassifiedMatches.normalize_classified_matches(total_abundance, classified_tree, output_file)
@@ -78,7 +81,7 @@ def main():
   input_suffix = sys.argv[3]
   input_dir = sys.argv[4]
   output_dir = sys.argv[5]
-  # nthreads=$6 
+  nthreads = int(sys.argv[6])
   align_coverage = float(sys.argv[7])
   align_identity = float(sys.argv[8])
   align_length = float(sys.argv[9])
@@ -105,11 +108,9 @@ def main():
   os.makedirs(output_path, exist_ok=True)
   
   ########################################################################################################
-  # Load complete taxonomy tree
-  names_file = os.path.join(taxonomy_database, "names.dmp")
-  nodes_file = os.path.join(taxonomy_database, "nodes.dmp")
-  merged_file = os.path.join(taxonomy_database, "merged.dmp")
-  _, taxonomy_tree = TaxonomyParser.load_tree_from_taxonomy_files(names_file, nodes_file, merged_file)
+  # Load complete taxonomy tree, from the compiled snapshot when available
+  _, taxonomy_tree = TaxonomyArrayTree.load_taxonomy_array_tree(taxonomy_database,
+    nprocesses=nthreads)
   TaxonomyParser.clear_abundance_from_tree(taxonomy_tree)
   
   ########################################################################################################  
@@ -120,7 +121,7 @@ def main():
   
   tabulate_known_viruses(taxonomy_tree, input_count_reads_path, count_reads_extension,
     input_mapping_path, align_filters, input_alignment_path, input_kraken_path,
-    kraken_folder, filename, output_path)
+    kraken_folder, filename, output_path, nthreads=nthreads)
   
   # Print end message
   print("Finished!")
@@ -0,0 +1,131 @@
+import os, sys, importlib, traceback, multiprocessing
+from datetime import datetime, timezone
+sys.path.append("/home/pedro/aesop/github/aesop-metagenomics-pipeline/src")
+sys.path.append("/home/pablo.viana/jobs/github/aesop-metagenomics-pipeline/src")
+sys.path.append("/mnt/c/Users/pablo/Documents/github/aesop-metagenomics-pipeline/src")
+
+import utilities.taxonomy_array_tree as TaxonomyArrayTree
+# per sample tabulation from the single sample step, in the same folder
+TabulateNormalizedViruses = importlib.import_module("5-tabulate_normalized_viruses")
+
+# Batch version of 5-tabulate_normalized_viruses.py: the taxonomy is loaded once and
+# the samples are tabulated by a pool of forked processes sharing the taxonomy arrays.
+# It replaces the call of custom_task.sh with the single sample step, so it is run
+# directly instead of from pipeline_viruses.sh, inside the folder of the log files:
+#   python 5-tabulate_normalized_viruses_batch.py nprocesses input_suffix input_dir \
+#     output_dir nthreads align_coverage align_identity align_length align_evalue \
+#     taxonomy_database base_path metadata_path count_reads_folder count_reads_extension \
+#     [mapping_folder] [kraken_folder]
+# the parameters after nthreads are the same $7 ... $17 of the single sample step.
+# A failed sample is reported in its log and the others are still tabulated, the script
+# exits with error code 1 at the end if any sample failed.
+
+# taxonomy tree loaded by the parent process and inherited by the forked workers
+taxonomy_tree = None
+sample_parameters = {}
+
+
+def get_input_files(input_dir, input_suffix):
+  # same input files found by custom_task.sh
+  input_files = []
+  for root, _, files in os.walk(input_dir, followlinks=True):
+    for file_name in files:
+      if file_name.endswith(input_suffix):
+        input_files.append(os.path.join(root, file_name))
+  return sorted(input_files)
+
+
+def tabulate_sample(task):
+  input_count, input_file = task
+  pid = os.getpid()
+  input_id = os.path.basename(input_file).split(".", 1)[0]
+  timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S+0000")
+  print(f"B_PID: {pid} [{timestamp}]: Started task Input: {input_file} Count: {input_count}", flush=True)
+
+  # Open the sample log file in line-buffered mode and assign sys.stdout
+  f = open(f"{pid}_{input_id}.log", "w", buffering=1)
+  sys.stdout = f
+  try:
+    filename = os.path.basename(input_file).split(".")[0]
+    print(f"\n\nB_PID: {pid} [{timestamp}]: Started task Input: {filename}")
+    # abundances of this sample are set in its own arrays over the shared topology
+    sample_tree = taxonomy_tree.new_overlay()
+    TabulateNormalizedViruses.tabulate_known_viruses(sample_tree, filename=filename,
+      **sample_parameters)
+    print("Finished!")
+  except Exception:
+    # keep tabulating the other samples, as the independent processes of custom_task.sh
+    print(f"Error tabulating sample: {input_file}")
+    traceback.print_exc(file=sys.stdout)
+    return input_file, False
+  finally:
+    # Restore original stdout and close the log file
+    sys.stdout = sys.__stdout__
+    f.close()
+  return input_file, True
+
+
+def main():
+  global taxonomy_tree
+  nprocesses = int(sys.argv[1])
+  input_suffix = sys.argv[2]
+  input_dir = sys.argv[3]
+  output_dir = sys.argv[4]
+  # nthreads=$5
+  align_coverage = float(sys.argv[6])
+  align_identity = float(sys.argv[7])
+  align_length = float(sys.argv[8])
+  align_evalue = float(sys.argv[9])
+  taxonomy_database = sys.argv[10]
+  base_path = sys.argv[11]
+  # metadata_path=$12
+  count_reads_folder = sys.argv[13]
+  count_reads_extension = sys.argv[14]
+  mapping_folder = sys.argv[15] if len(sys.argv) > 15 else ""
+  kraken_folder = sys.argv[16] if len(sys.argv) > 16 else ""
+  print(f"Parameters: {sys.argv}")
+
+  # Create the folder to place the output if it doesn't exist
+  os.makedirs(output_dir, exist_ok=True)
+  sample_parameters.update({
+    "input_count_reads_path": os.path.join(base_path, count_reads_folder),
+    "count_reads_extension": count_reads_extension,
+    "input_mapping_path": os.path.join(base_path, mapping_folder),
+    "align_filters": {
+      "length": align_length, "identity": align_identity,
+      "coverage": align_coverage, "evalue": align_evalue },
+    "input_alignment_path": input_dir,
+    "input_kraken_path": os.path.join(base_path, kraken_folder),
+    "kraken_folder": kraken_folder,
+    "output_path": output_dir,
+    # many samples are in memory at once, keep only hashes of the mapped read names
+    "compact_mapped_reads": True })
+
+  ########################################################################################################
+  # Load complete taxonomy tree once, from the compiled snapshot when available
+  _, taxonomy_tree = TaxonomyArrayTree.load_taxonomy_array_tree(taxonomy_database,
+    nprocesses=nprocesses)
+
+  ########################################################################################################
+  # Tabulate the samples in forked processes, that inherit the loaded taxonomy
+  input_files = get_input_files(input_dir, input_suffix)
+  print(f"Tabulating {len(input_files)} samples with {nprocesses} processes")
+  tasks = list(enumerate(input_files, start=1))
+  failed_files = []
+  with multiprocessing.get_context("fork").Pool(nprocesses) as pool:
+    for input_file, is_finished in pool.imap_unordered(tabulate_sample, tasks):
+      if is_finished:
+        print(f"Finished sample: {input_file}")
+      else:
+        print(f"Failed sample: {input_file}")
+        failed_files.append(input_file)
+
+  if len(failed_files) > 0:
+    print(f"Failed {len(failed_files)} of {len(input_files)} samples: {sorted(failed_files)}")
+    sys.exit(1)
+  # Print end message
+  print("Finished!")
+
+
+if __name__ == '__main__':
+  main()
@@ -1,17 +1,19 @@
-import os, sys, csv, copy
+import os, sys, csv
 from datetime import datetime, timezone
 sys.path.append("/home/pedro/aesop/github/aesop-metagenomics-pipeline/src")
 sys.path.append("/home/pablo.viana/jobs/github/aesop-metagenomics-pipeline/src")
 sys.path.append("/mnt/c/Users/pablo/Documents/github/aesop-metagenomics-pipeline/src")
 
 import utilities.taxonomy_tree_parser as TaxonomyParser
+import utilities.taxonomy_array_tree as TaxonomyArrayTree
 import utilities.calculate_confusion_matrix as ConfusionMatrix
 
 
 def tabulate_known_viruses(
   ground_truth_tree, classified_tree, true_positive_tree, accession_taxids,
   input_count_reads_path, count_reads_extension, input_mapping_path, align_filters,
-  input_alignment_path, input_kraken_path, kraken_folder, filename, output_path):
+  input_alignment_path, input_kraken_path, kraken_folder, filename, output_path, nthreads=1,
+  kraken_confidences=None, align_filters_grid=None, compact_mapped_reads=False):
   """
   Tabulates known viruses by creating a ground truth tree from mock data, setting up
   confusion matrices for BLAST and Kraken classification results.
@@ -29,10 +31,17 @@ def tabulate_known_viruses(
     kraken_folder: The folder containing Kraken results.
     filename: The base filename for input and output files.
     output_path: Path to the directory where output files will be saved.
+    nthreads: Number of processes used to count the reads of the ground truth and to get
+      the alignment results of the contigs.
+    kraken_confidences: Confidence thresholds to re-score the Kraken output with, if given.
+    align_filters_grid: Lists of values of each alignment filter to sweep, if given.
+    compact_mapped_reads: Count the mapped reads in a compact table of read name hashes.
   Processes:
   1. Loads and processes the ground truth tree using mock data to determine the real taxa and their abundance.
   2. Sets up the alignment confusion matrix by loading the alignment result file, applying alignment filters, and calculating metrics.
   3. If provided, sets up the Kraken confusion matrix by loading the Kraken result and calculating metrics.
+  4. If provided, sets up the Kraken confusion matrix of each confidence threshold from the Kraken output.
+  5. If provided, sets up the alignment confusion matrix of every combination of the alignment filters.
   """
   #######################################################################################################
   # GROUND TRUTH
@@ -43,7 +52,7 @@ def tabulate_known_viruses(
   # create the ground truth tree with the real taxa from the mocks and the number of reads from each one    
   total_abundance, contig_reads, mapped_reads = ConfusionMatrix.load_ground_truth_tree(
     ground_truth_tree, accession_taxids, count_reads_file, count_reads_extension,
-    mapping_file, filename, output_file)
+    mapping_file, filename, output_file, nthreads, compact_mapped_reads)
   
   #######################################################################################################
   # SET ALIGNMENT CONFUSION MATRIX
@@ -54,7 +63,7 @@ def tabulate_known_viruses(
   # load alignment tree
   ConfusionMatrix.load_alignment_tree(classified_tree, true_positive_tree,
     accession_taxids, contig_reads, alignment_file, align_filters,
-    output_unmatches_file, output_matches_file)
+    output_unmatches_file, output_matches_file, nthreads)
   # Calculate confusion matrix for alignment
   output_file = os.path.join(output_path, filename + "_blast_metrics.csv")
   ConfusionMatrix.calculate_confusion_matrix(accession_taxids, total_abundance,
@@ -80,6 +89,21 @@ def tabulate_known_viruses(
     output_file = os.path.join(output_path, filename + "_kraken_metrics.csv")
     ConfusionMatrix.calculate_confusion_matrix(accession_taxids, total_abundance,
       ground_truth_tree, true_positive_tree, classified_tree, output_file)
+    
+    # re-score the kraken output for the confidence thresholds
+    if kraken_confidences:
+      output_prefix = os.path.join(output_path, filename)
+      ConfusionMatrix.calculate_kraken_confidence_sweep(ground_truth_tree,
+        classified_tree, true_positive_tree, accession_taxids, total_abundance,
+        kout_file, kraken_confidences, output_prefix)
+  
+  #######################################################################################################
+  # SET ALIGNMENT FILTERS SWEEP
+  if align_filters_grid:
+    output_file = os.path.join(output_path, filename + "_alignment_filters_sweep.csv")
+    ConfusionMatrix.calculate_alignment_filters_sweep(ground_truth_tree, classified_tree,
+      true_positive_tree, accession_taxids, contig_reads, total_abundance, alignment_file,
+      align_filters_grid, output_file)
 
 
 
@@ -89,11 +113,12 @@ def main():
   input_suffix = sys.argv[3]
   input_dir = sys.argv[4]
   output_dir = sys.argv[5]
-  # nthreads=$6 
-  align_coverage = float(sys.argv[7])
-  align_identity = float(sys.argv[8])
-  align_length = float(sys.argv[9])
-  align_evalue = float(sys.argv[10])
+  nthreads = int(sys.argv[6])
+  # comma separated lists of values sweep the alignment filters
+  align_coverage = [float(value) for value in sys.argv[7].split(",")]
+  align_identity = [float(value) for value in sys.argv[8].split(",")]
+  align_length = [float(value) for value in sys.argv[9].split(",")]
+  align_evalue = [float(value) for value in sys.argv[10].split(",")]
   taxonomy_database = sys.argv[11]
   base_path = sys.argv[12]
   metadata_path = sys.argv[13]
@@ -101,31 +126,36 @@ def main():
   count_reads_extension = sys.argv[15]
   mapping_folder = sys.argv[16] if len(sys.argv) > 16 else ""
   kraken_folder = sys.argv[17] if len(sys.argv) > 17 else ""
+  kraken_confidences = sys.argv[18] if len(sys.argv) > 18 else ""
   print(f"Parameters: {sys.argv}")
   
   input_count_reads_path = os.path.join(base_path, count_reads_folder)
   input_mapping_path = os.path.join(base_path, mapping_folder)
   input_kraken_path = os.path.join(base_path, kraken_folder)
   input_alignment_path = input_dir
-  align_filters = {
+  align_filters_grid = {
     "length": align_length, "identity": align_identity, 
     "coverage": align_coverage, "evalue": align_evalue }
+  # the step outputs use the first value of each filter
+  align_filters = {name: values[0] for name, values in align_filters_grid.items()}
+  if all(len(values) == 1 for values in align_filters_grid.values()):
+    align_filters_grid = None
+  kraken_confidences = [float(confidence) for confidence in kraken_confidences.split(",")
+    if confidence.strip() != ""]
   
   # Create the folder to place the output if it doesn't exist
   output_path = output_dir
   os.makedirs(output_path, exist_ok=True)
   
   ########################################################################################################
-  # Load complete taxonomy tree
-  names_file = os.path.join(taxonomy_database, "names.dmp")
-  nodes_file = os.path.join(taxonomy_database, "nodes.dmp")
-  merged_file = os.path.join(taxonomy_database, "merged.dmp")
-  _, taxonomy_tree = TaxonomyParser.load_tree_from_taxonomy_files(names_file, nodes_file, merged_file)
+  # Load complete taxonomy tree, from the compiled snapshot when available
+  _, taxonomy_tree = TaxonomyArrayTree.load_taxonomy_array_tree(taxonomy_database,
+    nprocesses=nthreads)
   TaxonomyParser.clear_abundance_from_tree(taxonomy_tree)
-  # create a copy of the taxonomy tree for the confusion matrix calculation
+  # create abundance overlays sharing the taxonomy for the confusion matrix calculation
   ground_truth_tree = taxonomy_tree
-  true_positive_tree = copy.deepcopy(taxonomy_tree)
-  classified_tree = copy.deepcopy(taxonomy_tree)
+  true_positive_tree = taxonomy_tree.new_overlay()
+  classified_tree = taxonomy_tree.new_overlay()
   
   ########################################################################################################  
   # collect the expected taxid from accessions of the mock
@@ -141,10 +171,12 @@ def main():
     filename = f"{os.path.basename(input_file).rsplit('_', maxsplit=1)[0]}_{i}"
     print(f"\n\nB_PID: {pid} [{timestamp}]: Started task Input: {filename}")
     
+    # the mapped reads looked up in the kraken output are kept as hashes of their names
     tabulate_known_viruses(
       ground_truth_tree, classified_tree, true_positive_tree, accession_taxids,
       input_count_reads_path, count_reads_extension, input_mapping_path, align_filters,
-      input_alignment_path, input_kraken_path, kraken_folder, filename, output_path)
+      input_alignment_path, input_kraken_path, kraken_folder, filename, output_path, nthreads,
+      kraken_confidences, align_filters_grid, compact_mapped_reads=True)
   
   # Print end message
   print("Finished!")
@@ -250,7 +250,8 @@ def main():
   input_taxonomy_path = "/home/pedro/aesop/pipeline/databases/taxdump"
   names_file = os.path.join(input_taxonomy_path, "names.dmp")
   nodes_file = os.path.join(input_taxonomy_path, "nodes.dmp")
-  _, taxonomy_tree = TaxonomyParser.load_tree_from_taxonomy_files(names_file, nodes_file)
+  _, taxonomy_tree = TaxonomyParser.load_tree_from_taxonomy_files(names_file, nodes_file,
+    keep_taxids={"10239"})
   
   # set Viruses Domain as root and deletes the rest of the tree
   viruses_root = taxonomy_tree["10239"]
@@ -292,12 +293,14 @@ def main():
   loaded_accession_taxids = load_accession_metadata(metadata_file)
   accession_taxids = {}
   for accession,taxid in loaded_accession_taxids.items():
-    node = taxonomy_tree[taxid]
-    domain_node = node.get_parent_by_level(TaxonomyParser.Level.D)
-    if domain_node.name.lower() == "viruses":
+    # only the viruses subtree is loaded, the other taxids are not in the tree
+    node = taxonomy_tree.get(taxid, None)
+    domain_node = node.get_parent_by_level(TaxonomyParser.Level.D) if node is not None else None
+    if domain_node is not None and domain_node.name.lower() == "viruses":
       accession_taxids[accession] = taxid
     else:
-      print(f"Removing {accession}:{taxid} because its domain is {domain_node.name}")
+      domain_name = domain_node.name if domain_node is not None else "not viruses"
+      print(f"Removing {accession}:{taxid} because its domain is {domain_name}")
   
   # include the number of reads of each accession as the abundance of each taxa species
   accession_abundance = count_reads_by_sequence_id(fastq_file)
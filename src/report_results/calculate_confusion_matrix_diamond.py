@@ -211,7 +211,7 @@ def main():
   input_suffix = sys.argv[3]
   input_dir = sys.argv[4]
   output_dir = sys.argv[5]
-  # nthreads=$6 
+  nthreads = int(sys.argv[6])
   align_identity = float(sys.argv[7])
   align_length = float(sys.argv[8])
   align_evalue = float(sys.argv[9])
@@ -236,7 +236,8 @@ def main():
   # Load complete taxonomy tree
   names_file = os.path.join(taxonomy_database, "names.dmp")
   nodes_file = os.path.join(taxonomy_database, "nodes.dmp")
-  _, taxonomy_tree = TaxonomyParser.load_tree_from_taxonomy_files(names_file, nodes_file)  
+  _, taxonomy_tree = TaxonomyParser.load_tree_from_taxonomy_files(names_file, nodes_file,
+    nprocesses=nthreads)
   TaxonomyParser.clear_abundance_from_tree(taxonomy_tree)
   # create a copy of the taxonomy tree for the confusion matrix calculation
   ground_truth_tree = copy.deepcopy(taxonomy_tree)
@@ -1,5 +1,7 @@
-import os, csv, copy
+import os, sys, io, contextlib, multiprocessing
+import concurrent.futures
 from typing import List, Tuple
+import numpy as np
 from collections import defaultdict
 from dataclasses import dataclass, field
 from .utility_functions import is_equal, bigger_or_equal
@@ -9,110 +11,255 @@ from . import taxonomy_tree_parser as TaxonomyParser
 #########################################################################################
 #### ALIGNMENT DATA FUNCTIONS
 
+def bigger_or_equal_array(a, b, tol=1e-3):
+  # vectorized bigger_or_equal, same rule as math.isclose with rel_tol=tol
+  a = np.asarray(a, dtype=np.float64)
+  return (a > b) | (np.abs(a - b) <= tol * np.maximum(np.abs(a), abs(b)))
+
+
 @dataclass
 class ResultInfo:
   contig_length: int = 0
-  contig_coverage: List[float] = field(default_factory=list)
+  contig_coverage: np.ndarray = field(default_factory=lambda: np.zeros(0))
   hits_pident: List[Tuple[str, float]] = field(default_factory=list)
   
   def add_alignment_result(self, result_row):
-    length   = int(result_row['qlen'])
-    identity = float(result_row['pident'])
-    qstart   = int(result_row['qstart'])
-    qend     = int(result_row['qend'])
-    subject  = result_row['sseqid'].strip()
+    self.add_alignment(int(result_row['qlen']), float(result_row['pident']),
+      int(result_row['qstart']), int(result_row['qend']), result_row['sseqid'].strip())
+  
+  def add_alignment(self, length, identity, qstart, qend, subject):
     # init attributes when adding first result
     if self.contig_length == 0:
       self.contig_length = length
-      self.contig_coverage = [0.0] * length
+      self.contig_coverage = np.zeros(length, dtype=np.float64)
     elif self.contig_length != length:
       raise ValueError("Trying to include invalid result: "
-        f"contig length: {self.contig_length} / result: {result_row}")
+        f"contig length: {self.contig_length} / result: {subject} with qlen {length}")
     # update coverage with best identity for position
     start = min(qstart, qend)
     end = max(qstart, qend)
-    for i in range(start-1, end):
-      if identity > self.contig_coverage[i]:
-        self.contig_coverage[i] = identity
+    covered = self.contig_coverage[start-1:end]
+    np.maximum(covered, identity, out=covered)
     # add hit identity
     self.hits_pident.append((subject, identity))
   
   def include_result_info(self, result_info):
     if self.contig_length != result_info.contig_length:
       raise ValueError("Trying to include invalid result: "
-        f"contig length: {self.contig_length} / result: {result_row}")
-    for i in range(self.contig_length):      
-      if result_info.contig_coverage[i] > self.contig_coverage[i]:
-        self.contig_coverage[i] = result_info.contig_coverage[i]
+        f"contig length: {self.contig_length} / result: {result_info.contig_length}")
+    np.maximum(self.contig_coverage, result_info.contig_coverage, out=self.contig_coverage)
     self.hits_pident.extend(result_info.hits_pident)
   
-  def get_stats_per_identity(self, min_identity):    
-    values = [idt for idt in self.contig_coverage if bigger_or_equal(idt, min_identity)]
-    mean_identity = sum(values) / len(values) if len(values) > 0 else 0
-    coverage_percentage = len(values) * 100.0 / self.contig_length if self.contig_length > 0 else 0
-    coverage_lenght = len(values)
-    identity_hits = [sseqid for sseqid,idt in self.hits_pident if bigger_or_equal(idt, min_identity)]
-    total_hits = len(identity_hits)
-    unique_hits = len(set(identity_hits))
-    return (mean_identity, coverage_percentage, coverage_lenght, total_hits, unique_hits)
+  def merge_result_info(self, result_info):
+    """
+    Copy-on-write version of include_result_info, neither result is changed.
+    Parameters:
+      result_info (ResultInfo): result of the same contig
+    Returns:
+      ResultInfo: new result with the best coverage and the hits of both
+    """
+    if self.contig_length != result_info.contig_length:
+      raise ValueError("Trying to include invalid result: "
+        f"contig length: {self.contig_length} / result: {result_info.contig_length}")
+    return ResultInfo(self.contig_length,
+      np.maximum(self.contig_coverage, result_info.contig_coverage),
+      self.hits_pident + result_info.hits_pident)
+  
+  def get_stats_per_identities(self, min_identities):
+    """
+    Get the coverage and hits stats of the result for many identity thresholds.
+    Parameters:
+      min_identities (list): identity thresholds
+    Returns:
+      list: (mean_identity, coverage_percentage, coverage_lenght, total_hits,
+        unique_hits) for each identity threshold
+    """
+    # best identity of each hit and of each subject
+    hit_identities = np.fromiter((idt for _,idt in self.hits_pident),
+      dtype=np.float64, count=len(self.hits_pident))
+    subject_codes = {}
+    hit_subjects = np.fromiter((subject_codes.setdefault(sseqid, len(subject_codes))
+      for sseqid,_ in self.hits_pident), dtype=np.int64, count=len(self.hits_pident))
+    subject_identities = np.full(len(subject_codes), -np.inf)
+    np.maximum.at(subject_identities, hit_subjects, hit_identities)
+    
+    stats = []
+    for min_identity in min_identities:
+      values = self.contig_coverage[bigger_or_equal_array(self.contig_coverage, min_identity)]
+      # sequential sum, same result as summing the values one by one
+      mean_identity = float(np.cumsum(values)[-1]) / len(values) if len(values) > 0 else 0
+      coverage_percentage = len(values) * 100.0 / self.contig_length if self.contig_length > 0 else 0
+      coverage_lenght = len(values)
+      total_hits = int(np.count_nonzero(bigger_or_equal_array(hit_identities, min_identity)))
+      unique_hits = int(np.count_nonzero(bigger_or_equal_array(subject_identities, min_identity)))
+      stats.append((mean_identity, coverage_percentage, coverage_lenght, total_hits, unique_hits))
+    return stats
+  
+  def get_stats_per_identity(self, min_identity):
+    return self.get_stats_per_identities([min_identity])[0]
 
 
 #########################################################################################
 #### GET RESULTS FROM ALIGNMENT FILE
 
-def get_alignment_results(input_file):
-  # fixing size limit error
-  csv.field_size_limit(sys.maxsize)
-  # Dictionary to store each query ID and its corresponding row
-  alignment_results = []
-  if os.path.exists(input_file) and os.path.getsize(input_file) > 0:
-    # Open the alignment output file and use csv.DictReader to read it
-    with open(input_file, 'r') as infile:      
-      # remove comments and the last column 'salltitles'
-      uncommented_lines = (line for line in infile if not line.startswith('#'))
-      filtered_lines = (line.rsplit('\t', 1)[0] for line in uncommented_lines)
-      # Use DictReader to automatically map columns to fieldnames
-      reader = csv.DictReader(filtered_lines, delimiter='\t', fieldnames=[
-        'qseqid', 'sseqid', 'pident', 'length', 'qlen', 'slen', 'qcovhsp',
-        'mismatch', 'gapopen', 'gaps', 'qstart', 'qend', 'sstart', 'send',
-        'evalue', 'bitscore', 'staxids']) #, 'salltitles'
-      for row in reader:
-        # append row
-        alignment_results.append(row)
-  return alignment_results
-
-
-def get_contig_result_infos(alignment_results, contig, max_evalue=0.00001, min_length=200):
+ALIGNMENT_FIELDS = [
+  'qseqid', 'sseqid', 'pident', 'length', 'qlen', 'slen', 'qcovhsp',
+  'mismatch', 'gapopen', 'gaps', 'qstart', 'qend', 'sstart', 'send',
+  'evalue', 'bitscore', 'staxids'] #, 'salltitles'
+# columns used from the outfmt 6 table and their types
+ALIGNMENT_COLUMNS = {
+  'qseqid': np.int32, 'sseqid': object, 'pident': np.float64, 'length': np.int64,
+  'qlen': np.int64, 'qstart': np.int64, 'qend': np.int64, 'evalue': np.float64,
+  'staxids': object}
+
+
+def iter_alignment_batches(input_file, max_evalue=0.00001, min_length=200,
+  contigs=None, contig_ids=None, batch_size=100000):
+  """
+  Stream the alignment file and yield typed columnar batches of the rows
+  that pass the evalue and length filters.
+  Parameters:
+    input_file (str): BLAST/DIAMOND outfmt 6 file, with salltitles as last column
+    max_evalue (float): maximum evalue of a hit
+    min_length (int): minimum alignment length of a hit
+    contigs (set): if given only hits of these contigs are kept
+    contig_ids (dict): contig name to the code stored in the 'qseqid' column,
+      filled while parsing
+    batch_size (int): maximum number of rows in each batch
+  Yields:
+    dict: column name to a numpy array with the values of the batch rows
+  """
+  contig_ids = {} if contig_ids is None else contig_ids
+  if not os.path.exists(input_file) or os.path.getsize(input_file) == 0:
+    return
+  batch = {column: [] for column in ALIGNMENT_COLUMNS}
+  with open(input_file, 'rb') as infile:
+    for line in infile:
+      # remove comments
+      if line.startswith(b'#'):
+        continue
+      fields = line.split(b'\t', 17)
+      # skip blank and truncated lines
+      if len(fields) < 17:
+        if len(line.strip()) > 0:
+          print(f"Invalid alignment line: {line}")
+        continue
+      contig = fields[0].strip().decode()
+      if contigs is not None and contig not in contigs:
+        continue
+      evalue = float(fields[14])
+      length = int(fields[3])
+      if not (bigger_or_equal(max_evalue, evalue) and length >= min_length):
+        row = dict(zip(ALIGNMENT_FIELDS, (field.decode() for field in fields[:17])))
+        print(f"Query didn't meet the filter criteria: {row}")
+        continue
+      batch['qseqid'].append(contig_ids.setdefault(contig, len(contig_ids)))
+      batch['sseqid'].append(fields[1].strip().decode())
+      batch['pident'].append(float(fields[2]))
+      batch['length'].append(length)
+      batch['qlen'].append(int(fields[4]))
+      batch['qstart'].append(int(fields[10]))
+      batch['qend'].append(int(fields[11]))
+      batch['evalue'].append(evalue)
+      batch['staxids'].append(fields[16].strip().decode())
+      if len(batch['qseqid']) >= batch_size:
+        yield {column: np.array(values, dtype=ALIGNMENT_COLUMNS[column])
+          for column, values in batch.items()}
+        batch = {column: [] for column in ALIGNMENT_COLUMNS}
+  if len(batch['qseqid']) > 0:
+    yield {column: np.array(values, dtype=ALIGNMENT_COLUMNS[column])
+      for column, values in batch.items()}
+
+
+class AlignmentTable:
+  """
+  Filtered alignment hits stored by column, with the hits of each contig
+  indexed in file order.
+  """
+  def __init__(self, columns: dict, contig_ids: dict):
+    self.columns = columns
+    self.contig_ids = contig_ids
+    # stable sort keeps the file order of the hits inside each contig
+    self.order = np.argsort(columns['qseqid'], kind='stable')
+    self.bounds = np.searchsorted(columns['qseqid'][self.order],
+      np.arange(len(contig_ids) + 1))
+  
+  def __len__(self):
+    return len(self.order)
+  
+  def get_contig_rows(self, contig):
+    code = self.contig_ids.get(contig, -1)
+    if code < 0:
+      return self.order[0:0]
+    return self.order[self.bounds[code]:self.bounds[code+1]]
+  
+  def filter_rows(self, max_evalue, min_length):
+    # table with only the hits passing stricter evalue and length filters
+    columns = self.columns
+    is_valid = (bigger_or_equal_array(max_evalue, columns['evalue']) &
+      (columns['length'] >= min_length))
+    return AlignmentTable({column: values[is_valid] for column, values in columns.items()},
+      self.contig_ids)
+
+
+def get_alignment_results(input_file, max_evalue=0.00001, min_length=200, contigs=None):
+  """
+  Load the hits of the alignment file that pass the filters.
+  Parameters:
+    input_file (str): BLAST/DIAMOND outfmt 6 file
+    max_evalue (float): maximum evalue of a hit
+    min_length (int): minimum alignment length of a hit
+    contigs (set): if given only hits of these contigs are kept
+  Returns:
+    AlignmentTable: filtered hits grouped by contig
+  """
+  contig_ids = {}
+  batches = list(iter_alignment_batches(input_file, max_evalue, min_length, contigs, contig_ids))
+  columns = {column: np.concatenate([batch[column] for batch in batches])
+    if len(batches) > 0 else np.array([], dtype=dtype)
+    for column, dtype in ALIGNMENT_COLUMNS.items()}
+  return AlignmentTable(columns, contig_ids)
+
+
+def get_contig_result_infos(alignment_table, contig):
   # Dictionary to store each contig ResultInfo()
   contig_result_infos = defaultdict(ResultInfo)
   
-  for row in alignment_results:
-    # Store the first occurrence of each query in the dictionary
-    contig_id = row['qseqid'].strip()
-    evalue    = float(row['evalue'])
-    length    = int(row['length'])
-    taxids    = row['staxids'].strip().split(';')   
-    if contig_id != contig:
-      continue
-    
-    # already_included_hit = False
-    if bigger_or_equal(max_evalue, evalue) and length >= min_length:
-      for taxid in taxids:
-        taxid = taxid.strip()
-        if taxid != '':
-          contig_result_infos[taxid].add_alignment_result(row)
-        else:
-          print(f"Query error invalid taxid: {taxid}; in row: {row}")
-    else:
-      print(f"Query didn't meet the filter criteria: {row}")
+  # only the hits of this contig are visited
+  rows = alignment_table.get_contig_rows(contig)
+  columns = alignment_table.columns
+  hits = zip(columns['qlen'][rows].tolist(), columns['pident'][rows].tolist(),
+    columns['qstart'][rows].tolist(), columns['qend'][rows].tolist(),
+    columns['sseqid'][rows].tolist(), columns['staxids'][rows].tolist())
+  for qlen, pident, qstart, qend, sseqid, staxids in hits:
+    for taxid in staxids.split(';'):
+      taxid = taxid.strip()
+      if taxid != '':
+        contig_result_infos[taxid].add_alignment(qlen, pident, qstart, qend, sseqid)
+      else:
+        print(f"Query error invalid taxid: {taxid}; in row: {contig}\t{sseqid}\t{staxids}")
   return contig_result_infos
 
 
 def get_best_hit_taxids(results, min_identity=97.0, min_coverage=95.0):
-  best_taxids, best_coverage = [], 0
   # get result info stats with specified thresholds for each taxid
-  for taxid, result_info in results.items():
-    result_identity,result_coverage,_,_,_ = result_info.get_stats_per_identity(min_identity)
+  taxid_stats = [(taxid, result_info.get_stats_per_identity(min_identity))
+    for taxid, result_info in results.items()]
+  return select_best_hit_taxids(taxid_stats, min_identity, min_coverage)
+
+
+def select_best_hit_taxids(taxid_stats, min_identity=97.0, min_coverage=95.0):
+  """
+  Select the taxids with the best coverage among the ones passing the filters.
+  Parameters:
+    taxid_stats (list): (taxid, stats) with the stats of the result info at min_identity
+    min_identity (float): minimum mean identity of the covered positions
+    min_coverage (float): minimum percentage of the contig covered
+  Returns:
+    list: taxids of the best hits
+  """
+  best_taxids, best_coverage = [], 0
+  for taxid, (result_identity,result_coverage,_,_,_) in taxid_stats:
     if (bigger_or_equal(result_identity, min_identity) and
         bigger_or_equal(result_coverage, min_coverage)):
       # if identity is bigger than threshold the best hit is the best coverage
@@ -129,6 +276,7 @@ def get_best_hit_taxids(results, min_identity=97.0, min_coverage=95.0):
 #########################################################################################
 #### CALCULATE ALIGNMENT RESULTS PER LEVEL
 def include_results_in_level(previous_results, level_results, level, taxonomy_tree):
+  # results are shared between levels, so merging must create a new result info
   included_taxids = []
   for taxid, result_info in previous_results.items():
     if taxid not in taxonomy_tree:
@@ -140,7 +288,8 @@ def include_results_in_level(previous_results, level_results, level, taxonomy_tr
       if level_node.taxid not in level_results:
         level_results[level_node.taxid] = result_info
       else:
-        level_results[level_node.taxid].include_result_info(result_info)
+        level_results[level_node.taxid] = \
+          level_results[level_node.taxid].merge_result_info(result_info)
       included_taxids.append(taxid)  
   # Remove the included taxids from previous results
   for taxid in included_taxids:
@@ -162,8 +311,122 @@ def get_alignment_result_per_level(contig_results, level, previous_results, taxo
   return level_results
 
 
+# identity thresholds of the matches written for each contig
+IDENTITY_THRESHOLDS = [99, 98, 97, 95, 92, 90, 85, 80, 70, 60, 50, 40, 30]
+# IDENTITY_THRESHOLDS = [97, 90, 70, 50, 30]
+
+# alignment results and filters inherited by the forked workers of load_alignment_results
+alignment_worker_state = None
+
+
+def get_contig_alignment_output(contig, contig_read_info, alignment_results, align_filters,
+  taxonomy_tree):
+  """
+  Get the alignment results of a contig by level and its best species hits.
+  Parameters:
+    contig (str): contig name
+    contig_read_info: reads mapped to the contig, as written in the unmatched contigs
+    alignment_results (AlignmentTable): filtered alignment hits
+    align_filters (dict): alignment filters
+    taxonomy_tree (TaxonomyTree): taxonomy tree
+  Returns:
+    output_not_match (str): line of the contig in the unmatched contigs, or empty
+    output_matches (str): lines of the contig in the matched contigs
+    results_by_level (dict): level to the alignment results, None without results
+    species_best_hit_taxids (list): best hit taxids at species level, None without results
+  """
+  output_not_match, output_matches = "", ""
+  # get contig alignment results
+  print(f"Getting alignment results for contig {contig}: {str(contig_read_info)}")    
+  contig_results = get_contig_result_infos(alignment_results, contig)
+  # write unmatched contigs with alignment results
+  if len(contig_results) == 0:
+    output_not_match += f"{contig}\t{str(contig_read_info)}\n"
+    return output_not_match, output_matches, None, None
+  
+  level_results = {}
+  results_by_level = {}
+  # get result info per level
+  for level in reversed(TaxonomyParser.level_list(above_level=1)):
+    level_results = get_alignment_result_per_level(
+      contig_results, level, level_results, taxonomy_tree)
+    # collect matches by identity threshold
+    for taxid, result_info in level_results.items():
+      name = taxonomy_tree[taxid].name
+      parent_node = taxonomy_tree[taxid].get_highest_node_at_next_level()
+      parent_taxid = parent_node.taxid if parent_node is not None else "0"
+      
+      identity_stats = result_info.get_stats_per_identities(IDENTITY_THRESHOLDS)
+      for min_idt, (pidt,pcov,lcov,hits,uhits) in zip(IDENTITY_THRESHOLDS, identity_stats):
+        # write matches by identity threshold
+        if hits > 0:
+          output_matches += (f"{contig},{level},{parent_taxid},{taxid},"
+            f"{name},{min_idt},{pidt},{pcov},{lcov},{hits},{uhits}\n")
+    # save a snapshot of level_results in results_by_level, the result
+    # infos are never changed after added to a level so they can be shared
+    results_by_level[level] = dict(level_results)
+  
+  # get species result info
+  species_results = results_by_level[TaxonomyParser.Level.S]
+  print(f"{contig}: matched with species: {species_results.keys()}")
+  # collect species taxids of best hits
+  species_best_hit_taxids = get_best_hit_taxids(species_results,
+    align_filters["identity"], align_filters["coverage"])
+  # write unmatched contigs at species level
+  if len(species_best_hit_taxids) == 0:
+    output_not_match += f"{contig}\t{str(contig_read_info)}\n"
+  return output_not_match, output_matches, results_by_level, species_best_hit_taxids
+
+
+def get_contig_alignment_outputs(contigs):
+  # worker of load_alignment_results, the log of each contig is returned to be
+  # printed by the parent in the contigs order
+  alignment_results, align_filters, taxonomy_tree, contig_reads = alignment_worker_state
+  contig_outputs = []
+  for contig in contigs:
+    with contextlib.redirect_stdout(io.StringIO()) as log:
+      contig_output = get_contig_alignment_output(contig, contig_reads[contig],
+        alignment_results, align_filters, taxonomy_tree)
+    contig_outputs.append((contig, log.getvalue(), contig_output))
+  return contig_outputs
+
+
+def iter_contig_alignment_outputs(contig_reads, alignment_results, align_filters,
+  taxonomy_tree, nprocesses=1):
+  """
+  Get the alignment output of each contig, in the contig_reads order, from a pool
+  of forked processes that inherit the alignment results and the taxonomy.
+  Yields:
+    tuple: contig and its get_contig_alignment_output result
+  """
+  global alignment_worker_state
+  contigs = list(contig_reads)
+  # forked workers can't be created by the daemon workers of a pool
+  if (nprocesses <= 1 or len(contigs) <= 1 or multiprocessing.current_process().daemon or
+      "fork" not in multiprocessing.get_all_start_methods()):
+    for contig in contigs:
+      yield contig, get_contig_alignment_output(contig, contig_reads[contig],
+        alignment_results, align_filters, taxonomy_tree)
+    return
+  
+  # contiguous chunks of contigs, a few for each process to balance the load
+  chunk_size = max(1, -(-len(contigs) // (nprocesses * 4)))
+  chunks = [contigs[i:i + chunk_size] for i in range(0, len(contigs), chunk_size)]
+  alignment_worker_state = (alignment_results, align_filters, taxonomy_tree, contig_reads)
+  sys.stdout.flush()
+  try:
+    with concurrent.futures.ProcessPoolExecutor(nprocesses,
+        mp_context=multiprocessing.get_context("fork")) as executor:
+      for contig_outputs in executor.map(get_contig_alignment_outputs, chunks):
+        for contig, log, contig_output in contig_outputs:
+          print(log, end="")
+          yield contig, contig_output
+  finally:
+    alignment_worker_state = None
+
+
 def load_alignment_results(contig_reads, alignment_file, align_filters,
-  taxonomy_tree, output_unmatches_file, output_matches_file):
+  taxonomy_tree, output_unmatches_file, output_matches_file, nprocesses=1):
   """
   Load alignment results from alignment results file, filter the results
   by given filters, and write the unmatched contigs and matched contigs
@@ -176,6 +439,7 @@ def load_alignment_results(contig_reads, alignment_file, align_filters,
     taxonomy_tree (TaxonomyTree): taxonomy tree
     output_unmatches_file (str): file to write the unmatched contigs
     output_matches_file (str): file to write the matched contigs
+    nprocesses (int): number of processes getting the results of the contigs
   
   Returns:
     contig_results_by_level (dict): mapping of contig to alignment results by level
@@ -185,55 +449,22 @@ def load_alignment_results(contig_reads, alignment_file, align_filters,
   output_not_match = "contig\tread_count\n"
   output_matches = ("contig,level,parent_taxid,taxid,name,identity_threshold,"
     "mean_identity,coverage_perc,coverage_lenght,total_hits,unique_hits\n")
-  identity_thresholds = [99, 98, 97, 95, 92, 90, 85, 80, 70, 60, 50, 40, 30]
-  # identity_thresholds = [97, 90, 70, 50, 30]
   
-  # get alignment results from file
-  alignment_results = get_alignment_results(alignment_file)
+  # get filtered alignment results of the contigs from file
+  alignment_results = get_alignment_results(alignment_file,
+    align_filters['evalue'], align_filters['length'], set(contig_reads))
   
   contig_species_taxids = {}  
   contig_results_by_level = defaultdict(dict)
-  # get alignment results for the contigs
-  for contig in contig_reads:
-    # get contig alignment results
-    print(f"Getting alignment results for contig {contig}: {str(contig_reads[contig])}")    
-    contig_results = get_contig_result_infos(alignment_results, contig,
-      align_filters['evalue'], align_filters['length'])
-    # write unmatched contigs with alignment results
-    if len(contig_results) == 0:
-      output_not_match += f"{contig}\t{str(contig_reads[contig])}\n"
-      continue
-    
-    level_results = {}
-    # get result info per level
-    for level in reversed(TaxonomyParser.level_list(above_level=1)):
-      level_results = get_alignment_result_per_level(
-        contig_results, level, level_results, taxonomy_tree)
-      # collect matches by identity threshold
-      for taxid, result_info in level_results.items():
-        name = taxonomy_tree[taxid].name
-        parent_node = taxonomy_tree[taxid].get_highest_node_at_next_level()
-        parent_taxid = parent_node.taxid if parent_node is not None else "0"
-        
-        for min_idt in identity_thresholds:
-          pidt,pcov,lcov,hits,uhits = result_info.get_stats_per_identity(min_idt)
-          # write matches by identity threshold
-          if hits > 0:
-            output_matches += (f"{contig},{level},{parent_taxid},{taxid},"
-              f"{name},{min_idt},{pidt},{pcov},{lcov},{hits},{uhits}\n")
-      # save level_results in contig_results_by_level
-      contig_results_by_level[contig][level] = copy.deepcopy(level_results)
-    
-    # get species result info
-    species_results = contig_results_by_level[contig][TaxonomyParser.Level.S]
-    print(f"{contig}: matched with species: {species_results.keys()}")
-    # collect species taxids of best hits
-    species_best_hit_taxids = get_best_hit_taxids(species_results,
-      align_filters["identity"], align_filters["coverage"])
-    contig_species_taxids[contig] = species_best_hit_taxids
-    # write unmatched contigs at species level
-    if len(species_best_hit_taxids) == 0:
-      output_not_match += f"{contig}\t{str(contig_reads[contig])}\n"
+  # get alignment results for the contigs, merged in the contigs order
+  contig_outputs = iter_contig_alignment_outputs(contig_reads, alignment_results,
+    align_filters, taxonomy_tree, nprocesses)
+  for contig, (not_match, matches, results_by_level, species_best_hit_taxids) in contig_outputs:
+    output_not_match += not_match
+    output_matches += matches
+    if results_by_level is not None:
+      contig_results_by_level[contig] = results_by_level
+      contig_species_taxids[contig] = species_best_hit_taxids
   
   # write unmatched contigs to results
   with open(output_unmatches_file, "w") as unmatched_file:
@@ -245,6 +476,41 @@ def load_alignment_results(contig_reads, alignment_file, align_filters,
   return contig_results_by_level, contig_species_taxids
 
 
+def get_contig_species_taxids_per_filters(contig_reads, alignment_table, taxonomy_tree,
+  min_identities, min_coverages):
+  """
+  Get the best species hits of the contigs for every combination of identity and
+  coverage filters, building the coverage of each contig only once.
+  Parameters:
+    contig_reads (dict): mapping of contigs
+    alignment_table (AlignmentTable): hits passing the evalue and length filters
+    taxonomy_tree (TaxonomyTree): taxonomy tree
+    min_identities (list): identity filters
+    min_coverages (list): coverage filters
+  Returns:
+    dict: (min_identity, min_coverage) to the mapping of contig to best hit taxids
+      at species level
+  """
+  contig_species_taxids_per_filters = {(min_identity, min_coverage): {}
+    for min_identity in min_identities for min_coverage in min_coverages}
+  for contig in contig_reads:
+    contig_results = get_contig_result_infos(alignment_table, contig)
+    if len(contig_results) == 0:
+      continue
+    # species is the first level, so only the contig results are merged in it
+    species_results = get_alignment_result_per_level(
+      contig_results, TaxonomyParser.Level.S, {}, taxonomy_tree)
+    # stats of every taxid for all identities at once
+    taxid_stats = [(taxid, result_info.get_stats_per_identities(min_identities))
+      for taxid, result_info in species_results.items()]
+    for index, min_identity in enumerate(min_identities):
+      identity_stats = [(taxid, stats[index]) for taxid, stats in taxid_stats]
+      for min_coverage in min_coverages:
+        contig_species_taxids_per_filters[(min_identity, min_coverage)][contig] = \
+          select_best_hit_taxids(identity_stats, min_identity, min_coverage)
+  return contig_species_taxids_per_filters
+
+
 #########################################################################################
 #### MAIN TEST
 
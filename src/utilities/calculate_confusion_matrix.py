@@ -1,9 +1,14 @@
 import csv
+from array import array
 from collections import defaultdict
 from dataclasses import dataclass, field
 from . import fastq_read_info as FastqReadInfo
 from . import taxonomy_tree_parser as TaxonomyParser
 from . import alignment_result_parser as AlignmentResultParser
+from . import mapped_reads_table as MappedReadsTable
+from . import kraken_output_parser as KrakenOutputParser
+from . import taxonomy_lca as TaxonomyLCA
+from . import kraken_confidence_sweep as KrakenConfidenceSweep
 
 
 #########################################################################################
@@ -24,16 +29,14 @@ def load_accession_metadata(metadata_file):
 #### CONTIG TO READ DATA FUNCTIONS
 @dataclass
 class ContigInfo:
-  reads: set = field(default_factory=set)
+  # only the count of reads by accession is kept, not the read names
   accession_read_count: dict = field(default_factory=dict)
   
   def add_read_by_accession(self, read_seqid: str):
-    # if read_seqid not in self.reads:
     accession = read_seqid.rsplit('_', 2)[0]
     if accession not in self.accession_read_count:
       self.accession_read_count[accession] = 0
     self.accession_read_count[accession] += 1
-    self.reads.add(read_seqid)
   
   def __str__(self):
     return str(self.accession_read_count)
@@ -44,22 +47,29 @@ class ContigInfo:
 
 #########################################################################################
 ## SET GROUND TRUTH
-def count_contig_reads(mapping_file):
+def count_contig_reads(mapping_file, compact_mapped_reads=False):
   # Dictionary to store contig to unique reads mapping
   # Open the file and read line by line
   contig_reads = defaultdict(ContigInfo)
   mapped_reads = defaultdict(int)
+  # hashes of the read names, when counted in a compact table
+  read_hashes = array("q")
   with open(mapping_file, 'r') as file:
     reader = csv.reader(file, delimiter='\t')
     for row in reader:
       contig_name = row[0].strip()
       read_mapped_name = row[1].strip()
-      mapped_reads[read_mapped_name] += 1
-      if mapped_reads[read_mapped_name] > 2: 
-        print(f"** MAPPING ERROR: read {read_mapped_name} was mapped to a contig " +
-          f"{mapped_reads[read_mapped_name]} times")
+      if compact_mapped_reads:
+        read_hashes.append(hash(read_mapped_name))
+      else:
+        mapped_reads[read_mapped_name] += 1
+        if mapped_reads[read_mapped_name] > 2: 
+          print(f"** MAPPING ERROR: read {read_mapped_name} was mapped to a contig " +
+            f"{mapped_reads[read_mapped_name]} times")
       # Add the read to the set for the given contig
       contig_reads[contig_name].add_read_by_accession(read_mapped_name)
+  if compact_mapped_reads:
+    mapped_reads = MappedReadsTable.build_mapped_reads_table(read_hashes, mapping_file)
   return contig_reads, mapped_reads
 
 
@@ -84,13 +94,15 @@ def count_remaining_contigs_reads(remaining_contigs_file):
 def set_ground_truth_tree_real_counts(accession_abundance, accession_taxids, ground_truth_tree, output_file):
   output_content = "read_accession_id,count\n"
   # include the number of reads of each accession as the abundance of each taxa
+  taxid_abundance = defaultdict(int)
   for accession, taxid in accession_taxids.items():
     if accession in accession_abundance:
       abundance = accession_abundance[accession].count
-      ground_truth_tree[taxid].add_abundance(abundance)
+      taxid_abundance[taxid] += abundance
       output_content += f"{accession},{abundance}\n"
     else:
       print(f"Accession {accession} not present in ground truth.")
+  TaxonomyParser.add_abundance_by_taxid(ground_truth_tree, taxid_abundance)
   # write output
   with open(output_file, "w") as out_file:
     out_file.write(output_content)
@@ -98,20 +110,27 @@ def set_ground_truth_tree_real_counts(accession_abundance, accession_taxids, gro
 
 #########################################################################################
 #### SET CLASSIFIED TRUE POSITIVE TREE
-def set_true_positive_in_taxonomy(true_taxid, classified_taxid, true_positive_tree, count):
+def get_true_positive_node(true_taxid, classified_taxid, true_positive_tree):
+  true_node = true_positive_tree.get(true_taxid, None)
+  classified_node = true_positive_tree.get(classified_taxid, None)
+  if true_node is None or classified_node is None:
+    return None
+  # with the Euler tour, the true positive is the first classified ancestor whose
+  # interval contains the true node, the LCA index is only built for batches of pairs
+  if true_node.tour_start is not None and classified_node.tour_start is not None:
+    while classified_node is not None and not true_node.is_descendant_of(classified_node):
+      classified_node = classified_node.parent
+    return classified_node
   # get taxids of the correct accession full taxonomy
   true_positive_taxids = set()  
-  true_node = true_positive_tree.get(true_taxid, None)
   while true_node is not None:
     true_positive_taxids.add(true_node.taxid)
     true_node = true_node.parent
   #  for every taxid from the classified result taxonomy
   # check if any is equal to the expected result (true_node)
   is_true_positive = False
-  classified_node = true_positive_tree.get(classified_taxid, None)
   while not is_true_positive and classified_node is not None:
     if classified_node.taxid in true_positive_taxids:
-      classified_node.add_abundance(count)
       is_true_positive = True
     else:
       classified_node = classified_node.parent
@@ -119,6 +138,41 @@ def set_true_positive_in_taxonomy(true_taxid, classified_taxid, true_positive_tr
   return classified_node if is_true_positive else None
 
 
+def set_true_positive_in_taxonomy(true_taxid, classified_taxid, true_positive_tree, count):
+  classified_node = get_true_positive_node(true_taxid, classified_taxid, true_positive_tree)
+  if classified_node is not None:
+    classified_node.add_abundance(count)
+  return classified_node
+
+
+def set_true_positive_counts_in_taxonomy(true_classified_counts, true_positive_tree):
+  """
+  Add the counts of many (true_taxid, classified_taxid) pairs to the true positive tree
+  in a single accumulation pass.
+  Parameters:
+    true_classified_counts (dict): (true_taxid, classified_taxid) pair to read count.
+    true_positive_tree (TaxonomyTree): Tree representing true positive results.
+  Returns:
+    dict: (true_taxid, classified_taxid) pair to its true positive node, or None.
+  """
+  true_positive_nodes = {}
+  taxid_abundance = defaultdict(int)
+  pairs = list(true_classified_counts.keys())
+  if TaxonomyLCA.get_lca_index(true_positive_tree) is not None:
+    # LCA of all pairs in one vectorized query
+    classified_nodes = TaxonomyLCA.get_lca_nodes(true_positive_tree,
+      [true_taxid for true_taxid, _ in pairs], [classified_taxid for _, classified_taxid in pairs])
+  else:
+    classified_nodes = [get_true_positive_node(true_taxid, classified_taxid, true_positive_tree)
+      for true_taxid, classified_taxid in pairs]
+  for pair, classified_node in zip(pairs, classified_nodes):
+    true_positive_nodes[pair] = classified_node
+    if classified_node is not None:
+      taxid_abundance[classified_node.taxid] += true_classified_counts[pair]
+  TaxonomyParser.add_abundance_by_taxid(true_positive_tree, taxid_abundance)
+  return true_positive_nodes
+
+
 #########################################################################################
 #### SET ALIGNMENT CLASSIFIED TREE
 def set_alignment_best_species_hit_in_trees(contig_reads, contig_species_taxids,
@@ -166,39 +220,43 @@ def set_alignment_best_species_hit_in_trees(contig_reads, contig_species_taxids,
 ## SET KRAKEN CLASSIFIED TREE
 def include_k2result_for_unmatched(classified_tree, true_positive_tree, accession_taxids, mapped_reads, kout_file):
   print(f"Get accession taxid abundance from: {kout_file}")
+  read_counts, unmapped_counts = KrakenOutputParser.count_kraken_classified_reads(kout_file,
+    mapped_reads, by_accession=True, valid_taxids=classified_tree)
+  # unmapped reads are added to both trees at once
+  taxid_abundance = defaultdict(int)
+  true_classified_counts = defaultdict(int)
+  for (accession_id, taxid), read_unmapped_count in unmapped_counts.items():
+    taxid_abundance[taxid] += read_unmapped_count
+    true_taxid = accession_taxids[accession_id]
+    true_classified_counts[(true_taxid, taxid)] += read_unmapped_count
+  # get result by accession
   k2result_accession_to_taxid = {}
-  with open(kout_file, "r") as kraken_file:
-    for line in kraken_file:
-      line = line.strip().split()
-      if len(line) >= 3 and line[0] == "C":
-        read_name = line[1].strip()
-        accession_id = read_name.rsplit('_', 2)[0]
-        taxid = line[2].strip()
-        if len(accession_id) == 0 or len(taxid) == 0 or taxid not in classified_tree:
-          print(f"Error not included k2result: read_name: {read_name}, taxid: {taxid}")
-          continue
-        # get result if unmapped
-        read_unmapped_count = 2 - mapped_reads.get(read_name, 0)
-        if read_unmapped_count > 0:
-          classified_tree[taxid].add_abundance(read_unmapped_count)
-          true_taxid = accession_taxids[accession_id]
-          set_true_positive_in_taxonomy(true_taxid, taxid, true_positive_tree, read_unmapped_count)
-        # get result by accession
-        if accession_id not in k2result_accession_to_taxid:
-          k2result_accession_to_taxid[accession_id] = defaultdict(int)
-        k2result_accession_to_taxid[accession_id][taxid] += 1
+  for (accession_id, taxid), count in read_counts.items():
+    if accession_id not in k2result_accession_to_taxid:
+      k2result_accession_to_taxid[accession_id] = defaultdict(int)
+    k2result_accession_to_taxid[accession_id][taxid] += count
+  TaxonomyParser.add_abundance_by_taxid(classified_tree, taxid_abundance)
+  set_true_positive_counts_in_taxonomy(true_classified_counts, true_positive_tree)
   return k2result_accession_to_taxid
 
 ## INCLUDE KRAKEN TRUE POSITIVE RESULT
 def set_kraken_true_positive_tree_counts(k2result_accession_to_taxid, accession_taxids, true_positive_tree):
+  # sum the counts of all accessions by (true taxid, classified taxid)
+  true_classified_counts = defaultdict(int)
+  for accession, true_taxid in accession_taxids.items():
+    if accession not in k2result_accession_to_taxid:
+      continue
+    for taxid, count in k2result_accession_to_taxid[accession].items():
+      true_classified_counts[(true_taxid, taxid)] += count
+  # set true positive tree
+  true_positive_nodes = set_true_positive_counts_in_taxonomy(true_classified_counts, true_positive_tree)
   # loop through all accessions
   for accession, true_taxid in accession_taxids.items():
     if accession not in k2result_accession_to_taxid:
       continue
     for taxid in k2result_accession_to_taxid[accession]:
       count = k2result_accession_to_taxid[accession][taxid]      
-      # set true positive tree
-      classified_node = set_true_positive_in_taxonomy(true_taxid, taxid, true_positive_tree, count)
+      classified_node = true_positive_nodes[(true_taxid, taxid)]
       is_true_positive = classified_node is not None
       #if not is_true_positive:
       print(f"{is_true_positive} positive for {accession}:{true_taxid} mapping {count} reads " + \
@@ -207,6 +265,11 @@ def set_kraken_true_positive_tree_counts(k2result_accession_to_taxid, accession_
 
 #########################################################################################
 #### CALCULATE CONFUSION MATRIX
+CONFUSION_MATRIX_HEADER = ("level,parent_taxid,taxid,name,sample_total_reads,"
+  "level_total_reads,level_total_classified,level_correct_reads,"
+  "true_positive,true_negative,false_positive,false_negative\n")
+
+
 def get_confusion_matrix_values(sample_total_reads, total_tax_reads,
   total_mapped_to_tax, correct_tax_reads):
   """
@@ -266,22 +329,17 @@ def get_output_for_confusion_matrix(node, sample_total_reads,
   return output_content
 
 
-def calculate_confusion_matrix(accession_taxids, sample_total_reads,
-  ground_truth_tree, true_positive_tree, classified_tree, output_file):
+def get_confusion_matrix_nodes(accession_taxids, ground_truth_tree):
   """
-  Calculate the confusion matrix for the given accession-taxid mapping.
+  Get the nodes of the confusion matrix, in the output order: the domain of the
+  accessions not from viruses and every level of the viruses accessions.
   Parameters:
     accession_taxids (dict): mapping of accession to taxid
-    sample_total_reads (int): total number of reads in the sample
     ground_truth_tree (TaxonomyTree): ground truth tree
-    true_positive_tree (TaxonomyTree): true positive tree
-    classified_tree (TaxonomyTree): classified tree
-    output_file (str): file to write the output to
+  Returns:
+    list: nodes of the confusion matrix
   """
-  print(f"Calculating confusion matrix: {output_file}")
-  output_content = "level,parent_taxid,taxid,name,sample_total_reads,"
-  output_content += "level_total_reads,level_total_classified,level_correct_reads,"
-  output_content += "true_positive,true_negative,false_positive,false_negative\n"
+  confusion_matrix_nodes = []
   # set of nodes already included in the output
   included_nodes = set()
   
@@ -292,36 +350,71 @@ def calculate_confusion_matrix(accession_taxids, sample_total_reads,
     if domain_node is None:
       continue
     elif domain_node.name.lower() != "viruses":
-      # print(f"Printing domain node: {domain_node}")
       # print if domain node is not viruses
       if domain_node not in included_nodes:
-        # get confusion matrix output values
-        output_content += get_output_for_confusion_matrix(
-          domain_node, sample_total_reads, ground_truth_tree,
-          true_positive_tree, classified_tree)
+        confusion_matrix_nodes.append(domain_node)
         included_nodes.add(domain_node)
     else:
-      # print(f"Printing levels for node: {node}")
       # if domain is viruses print all taxonomic levels
       for level in reversed(TaxonomyParser.level_list(above_level=1)):
         # get the highest node at this level
         level_node = node.get_highest_node_at_level(level)
         if level_node is not None and level_node not in included_nodes:
-          # get confusion matrix output values
-          output_content += get_output_for_confusion_matrix(
-            level_node, sample_total_reads, ground_truth_tree,
-            true_positive_tree, classified_tree)
+          confusion_matrix_nodes.append(level_node)
           included_nodes.add(level_node)
+  return confusion_matrix_nodes
+
+
+def calculate_confusion_matrix(accession_taxids, sample_total_reads,
+  ground_truth_tree, true_positive_tree, classified_tree, output_file):
+  """
+  Calculate the confusion matrix for the given accession-taxid mapping.
+  Parameters:
+    accession_taxids (dict): mapping of accession to taxid
+    sample_total_reads (int): total number of reads in the sample
+    ground_truth_tree (TaxonomyTree): ground truth tree
+    true_positive_tree (TaxonomyTree): true positive tree
+    classified_tree (TaxonomyTree): classified tree
+    output_file (str): file to write the output to
+  """
+  print(f"Calculating confusion matrix: {output_file}")
+  output_content = CONFUSION_MATRIX_HEADER
+  
+  for node in get_confusion_matrix_nodes(accession_taxids, ground_truth_tree):
+    # get confusion matrix output values
+    output_content += get_output_for_confusion_matrix(
+      node, sample_total_reads, ground_truth_tree,
+      true_positive_tree, classified_tree)
   
   with open(output_file, "w") as out_file:
     out_file.write(output_content)
 
 
+def get_confusion_curve_content(confidence, accession_taxids, sample_total_reads,
+  ground_truth_tree, true_positive_tree, classified_tree):
+  # sensitivity and precision of each node of the confusion matrix for one confidence
+  output_content = ""
+  for node in get_confusion_matrix_nodes(accession_taxids, ground_truth_tree):
+    if node.acumulated_abundance <= 0:
+      continue
+    total_reads = ground_truth_tree[node.taxid].acumulated_abundance
+    correct_reads = true_positive_tree[node.taxid].acumulated_abundance
+    total_classified = classified_tree[node.taxid].acumulated_abundance
+    metrics = get_confusion_matrix_values(sample_total_reads, total_reads, total_classified, correct_reads)
+    sensitivity = metrics[0] / float(metrics[0] + metrics[3]) if metrics[0] + metrics[3] > 0 else 0.0
+    precision = metrics[0] / float(metrics[0] + metrics[2]) if metrics[0] + metrics[2] > 0 else 0.0
+    output_content += f"{confidence},{node.level_enum},{node.taxid},{node.name},"
+    output_content += f"{metrics[0]},{metrics[1]},{metrics[2]},{metrics[3]},"
+    output_content += f"{sensitivity:.6f},{precision:.6f}\n"
+  return output_content
+
+
 #########################################################################################
 #### LOAD TAXONOMY TREES
 #########################################################################################
 def load_ground_truth_tree(ground_truth_tree, accession_taxids,
-  count_reads_file, count_reads_extension, mapping_file, filename, output_file):
+  count_reads_file, count_reads_extension, mapping_file, filename, output_file, nprocesses=1,
+  compact_mapped_reads=False):
   """
   Create the ground truth tree with the real taxa from the mocks and the number of reads from each one.
   Parameters:
@@ -332,6 +425,8 @@ def load_ground_truth_tree(ground_truth_tree, accession_taxids,
     mapping_file (str): file to map read name to contigs
     filename (str): filename to use for the output
     output_file (str): file to write the output to
+    nprocesses (int): number of processes to count the reads of plain or BGZF fastq files
+    compact_mapped_reads (bool): count the mapped reads in a MappedReadsTable
   Returns:
     dict: mapping of accession to count
   """
@@ -341,8 +436,8 @@ def load_ground_truth_tree(ground_truth_tree, accession_taxids,
   # include the number of reads of each accession as the abundance of each taxa species
   accession_abundance, contig_reads, mapped_reads = {}, {}, {}
   if count_reads_extension.endswith(".fastq.gz"):
-    accession_abundance = FastqReadInfo.count_reads_by_sequence_id(count_reads_file)
-    contig_reads, mapped_reads = count_contig_reads(mapping_file)
+    accession_abundance = FastqReadInfo.count_reads_by_sequence_id(count_reads_file, nprocesses)
+    contig_reads, mapped_reads = count_contig_reads(mapping_file, compact_mapped_reads)
     # double the abundance value to account for each mate from the sequencing
     for acc in accession_abundance:
       accession_abundance[acc].count *= 2
@@ -363,7 +458,7 @@ def load_ground_truth_tree(ground_truth_tree, accession_taxids,
 
 
 def load_alignment_tree(classified_tree, true_positive_tree, accession_taxids, contig_reads,
-  alignment_file, align_filters, output_unmatches_file, output_matches_file):  
+  alignment_file, align_filters, output_unmatches_file, output_matches_file, nprocesses=1):  
   """
   Calculate the alignment classified tree and the true positive tree.
   Parameters:
@@ -375,6 +470,7 @@ def load_alignment_tree(classified_tree, true_positive_tree, accession_taxids, c
     align_filters (AlignmentFilters): alignment filters
     output_unmatches_file (str): file to write the alignment unmatched contigs
     output_matches_file (str): file to write the output the alignment matches
+    nprocesses (int): number of processes getting the alignment results of the contigs
   """
   # clean the true positive tree
   TaxonomyParser.clear_abundance_from_tree(true_positive_tree)
@@ -384,13 +480,64 @@ def load_alignment_tree(classified_tree, true_positive_tree, accession_taxids, c
   # get the best species hit for each contig from alignment results
   _, contig_species_taxids = AlignmentResultParser.load_alignment_results(
     contig_reads, alignment_file, align_filters, classified_tree,
-    output_unmatches_file, output_matches_file)
+    output_unmatches_file, output_matches_file, nprocesses)
   
   # Set alignment classified tree and the true positive
   set_alignment_best_species_hit_in_trees(contig_reads, contig_species_taxids,
     accession_taxids, classified_tree, true_positive_tree)
 
 
+def calculate_alignment_filters_sweep(ground_truth_tree, classified_tree, true_positive_tree,
+  accession_taxids, contig_reads, sample_total_reads, alignment_file, align_filters_grid,
+  output_file):
+  """
+  Calculate the alignment confusion matrix for every combination of the alignment
+  filters, parsing the alignment file once and building the coverage of the contigs
+  once for each evalue and length filters. The output is a long format table with
+  the filters followed by the confusion matrix columns.
+  Parameters:
+    ground_truth_tree (TaxonomyTree): ground truth tree
+    classified_tree (TaxonomyTree): alignment classified tree
+    true_positive_tree (TaxonomyTree): true positive tree
+    accession_taxids (dict): mapping of accession to taxid
+    contig_reads (dict): mapping of contig to reads
+    sample_total_reads (int): total number of reads in the sample
+    alignment_file (str): alignment output file
+    align_filters_grid (dict): list of values of each alignment filter
+    output_file (str): file to write the output to
+  """
+  print(f"Calculating alignment filters sweep: {output_file}")
+  output_content = "evalue,length,identity,coverage," + CONFUSION_MATRIX_HEADER
+  min_identities, min_coverages = align_filters_grid["identity"], align_filters_grid["coverage"]
+  # hits of the loosest evalue and length filters
+  alignment_results = AlignmentResultParser.get_alignment_results(alignment_file,
+    max(align_filters_grid["evalue"]), min(align_filters_grid["length"]), set(contig_reads))
+  confusion_matrix_nodes = get_confusion_matrix_nodes(accession_taxids, ground_truth_tree)
+  
+  for max_evalue in align_filters_grid["evalue"]:
+    for min_length in align_filters_grid["length"]:
+      contig_species_taxids_per_filters = AlignmentResultParser.get_contig_species_taxids_per_filters(
+        contig_reads, alignment_results.filter_rows(max_evalue, min_length), classified_tree,
+        min_identities, min_coverages)
+      for min_identity in min_identities:
+        for min_coverage in min_coverages:
+          # clean the true positive and alignment result trees
+          TaxonomyParser.clear_abundance_from_tree(true_positive_tree)
+          TaxonomyParser.clear_abundance_from_tree(classified_tree)
+          set_alignment_best_species_hit_in_trees(contig_reads,
+            contig_species_taxids_per_filters[(min_identity, min_coverage)],
+            accession_taxids, classified_tree, true_positive_tree)
+          filters = f"{max_evalue},{min_length},{min_identity},{min_coverage},"
+          for node in confusion_matrix_nodes:
+            node_output = get_output_for_confusion_matrix(node, sample_total_reads,
+              ground_truth_tree, true_positive_tree, classified_tree)
+            if node_output != "":
+              output_content += filters + node_output
+  
+  with open(output_file, "w") as out_file:
+    out_file.write(output_content)
+
+
 def load_kraken_tree(classified_tree, true_positive_tree,
   accession_taxids, kreport_file, k2result_accession_to_taxid):
   """
@@ -410,11 +557,13 @@ def load_kraken_tree(classified_tree, true_positive_tree,
   # create the classified_tree from the kraken report
   _, report_tree = TaxonomyParser.load_tree_from_kraken_report(kreport_file)  
   # set values from the kraken report in the classified_tree
+  taxid_abundance = {}
   for k,node in report_tree.items():
     if k not in classified_tree:
       print(f"Node not found in taxonomy tree: {node}")
     elif node.abundance > 0:
-      classified_tree[k].add_abundance(node.abundance * 2)
+      taxid_abundance[k] = node.abundance * 2
+  TaxonomyParser.add_abundance_by_taxid(classified_tree, taxid_abundance)
   
   # double the abundance value to account for each mate from the sequencing
   for accession in k2result_accession_to_taxid:
@@ -423,4 +572,47 @@ def load_kraken_tree(classified_tree, true_positive_tree,
   
   # create the true positive tree adding the abundance only if they are correctly mapped
   set_kraken_true_positive_tree_counts(
-    k2result_accession_to_taxid, accession_taxids, true_positive_tree)
\ No newline at end of file
+    k2result_accession_to_taxid, accession_taxids, true_positive_tree)
+
+
+def calculate_kraken_confidence_sweep(ground_truth_tree, classified_tree, true_positive_tree,
+  accession_taxids, sample_total_reads, kout_file, confidences, output_prefix):
+  """
+  Re-score the kraken output for each confidence threshold and calculate its kraken
+  confusion matrix, without running kraken again. Writes for each confidence:
+    {output_prefix}_confidence_{confidence}.kreport: kraken report of the re-scored reads
+    {output_prefix}_kraken_metrics_confidence_{confidence}.csv: kraken confusion matrix
+  and the sensitivity and precision of all confidences in
+    {output_prefix}_kraken_confidence_curves.csv
+  Parameters:
+    ground_truth_tree (TaxonomyTree): ground truth tree, with the complete taxonomy
+    classified_tree (TaxonomyTree): kraken classified tree
+    true_positive_tree (TaxonomyTree): true positive tree
+    accession_taxids (dict): mapping of accession to taxid
+    sample_total_reads (int): total number of reads in the sample
+    kout_file (str): kraken output file, with the k-mer hit lists
+    confidences (list): confidence thresholds, from 0 to 1
+    output_prefix (str): prefix of the output files
+  """
+  results = KrakenConfidenceSweep.rescore_kraken_output(
+    kout_file, ground_truth_tree, confidences, by_accession=True)
+  output_content = "confidence,level,taxid,name,"
+  output_content += "true_positive,true_negative,false_positive,false_negative,"
+  output_content += "sensitivity,precision\n"
+  for result in results:
+    confidence = f"{result.confidence:g}"
+    kreport_file = f"{output_prefix}_confidence_{confidence}.kreport"
+    KrakenConfidenceSweep.write_kraken_report(ground_truth_tree, result.taxid_counts,
+      result.unclassified_count, kreport_file)
+    # load kraken tree
+    load_kraken_tree(classified_tree, true_positive_tree, accession_taxids,
+      kreport_file, result.accession_taxid_counts)
+    # Calculate confusion matrix for kraken
+    output_file = f"{output_prefix}_kraken_metrics_confidence_{confidence}.csv"
+    calculate_confusion_matrix(accession_taxids, sample_total_reads,
+      ground_truth_tree, true_positive_tree, classified_tree, output_file)
+    output_content += get_confusion_curve_content(confidence, accession_taxids,
+      sample_total_reads, ground_truth_tree, true_positive_tree, classified_tree)
+  
+  with open(f"{output_prefix}_kraken_confidence_curves.csv", "w") as out_file:
+    out_file.write(output_content)
@@ -0,0 +1,167 @@
+"""
+  Summarize the alignments of the reads to the contigs in one streaming pass over
+  the SAM output of the aligner, writing the same tables produced before with
+  samtools idxstats, samtools depth and samtools view over a sorted BAM file.
+"""
+import re
+from array import array
+import numpy as np
+
+
+# SAM flags
+FLAG_REVERSE = 0x10
+FLAG_UNMAPPED = 0x4
+FLAG_SECONDARY = 0x100
+FLAG_QCFAIL = 0x200
+FLAG_DUPLICATE = 0x400
+# alignments not counted in the depth, the default of samtools depth
+DEPTH_EXCLUDED_FLAGS = FLAG_UNMAPPED | FLAG_SECONDARY | FLAG_QCFAIL | FLAG_DUPLICATE
+CIGAR_PATTERN = re.compile(rb"(\d+)([MIDNSHP=X])")
+
+
+class ContigMapping:
+  """
+  Reads placed on each contig and the reference segments covered by the alignments.
+  """
+  def __init__(self):
+    self.contig_names = []
+    self.contig_lengths = []
+    self.contig_index = {}
+    self.mapped_counts = []
+    self.unmapped_counts = []
+    # unmapped reads without a contig, the '*' line of samtools idxstats
+    self.unplaced_count = 0
+    # one entry by record placed on a contig
+    self.read_contigs = array("i")
+    self.read_positions = array("q")
+    self.read_strands = array("b")
+    self.read_names = []
+    # one entry by reference segment covered by an alignment, 0-based half open
+    self.segment_contigs = array("i")
+    self.segment_starts = array("q")
+    self.segment_ends = array("q")
+
+  def add_reference(self, header_line: bytes):
+    # @SQ header line with the name and length of a contig
+    fields = dict(field.split(b":", 1) for field in header_line.rstrip(b"\r\n").split(b"\t")[1:])
+    self.contig_index[fields[b"SN"]] = len(self.contig_names)
+    self.contig_names.append(fields[b"SN"])
+    self.contig_lengths.append(int(fields[b"LN"]))
+    self.mapped_counts.append(0)
+    self.unmapped_counts.append(0)
+
+  def add_alignment(self, line: bytes):
+    read_name, flag, contig_name, position, _, cigar, _ = line.split(b"\t", 6)
+    flag = int(flag)
+    if contig_name == b"*":
+      self.unplaced_count += 1
+      return
+    index = self.contig_index[contig_name]
+    if flag & FLAG_UNMAPPED:
+      self.unmapped_counts[index] += 1
+    else:
+      self.mapped_counts[index] += 1
+    # every record with a contig is listed in the contig reads, even unmapped mates
+    position = int(position)
+    self.read_contigs.append(index)
+    self.read_positions.append(position)
+    self.read_strands.append(1 if flag & FLAG_REVERSE else 0)
+    self.read_names.append(read_name)
+    if flag & DEPTH_EXCLUDED_FLAGS or cigar == b"*":
+      return
+    # reference segments of the matches, deletions and skips are not covered
+    reference_position = position - 1
+    for length, operation in CIGAR_PATTERN.findall(cigar):
+      length = int(length)
+      if operation in b"M=X":
+        self.segment_contigs.append(index)
+        self.segment_starts.append(reference_position)
+        self.segment_ends.append(reference_position + length)
+        reference_position += length
+      elif operation in b"DN":
+        reference_position += length
+
+  def iter_contig_depths(self):
+    """
+    Get the depth of each contig with at least one covered position.
+    Returns:
+      iterator: contig index, 0-based covered positions and their depths
+    """
+    segment_contigs = np.frombuffer(self.segment_contigs, dtype=np.int32)
+    starts = np.frombuffer(self.segment_starts, dtype=np.int64)
+    ends = np.frombuffer(self.segment_ends, dtype=np.int64)
+    order = np.argsort(segment_contigs, kind="stable")
+    bounds = np.searchsorted(segment_contigs[order], np.arange(len(self.contig_names) + 1))
+    for index in range(len(self.contig_names)):
+      segments = order[bounds[index]:bounds[index+1]]
+      if len(segments) == 0:
+        continue
+      length = self.contig_lengths[index]
+      depth = np.cumsum(np.bincount(starts[segments], minlength=length + 1) -
+        np.bincount(ends[segments], minlength=length + 1))[:length]
+      positions = np.flatnonzero(depth)
+      yield index, positions, depth[positions]
+
+  def get_sorted_reads(self):
+    # records ordered by contig, position and strand, as in a sorted BAM file
+    read_contigs = np.frombuffer(self.read_contigs, dtype=np.int32)
+    read_positions = np.frombuffer(self.read_positions, dtype=np.int64)
+    read_strands = np.frombuffer(self.read_strands, dtype=np.int8)
+    return np.lexsort((read_strands, read_positions, read_contigs))
+
+
+def parse_sam_stream(stream):
+  """
+  Parse a SAM stream, as written by bowtie2 to the standard output.
+  Parameters:
+    stream (BinaryIO): SAM lines as bytes
+  Returns:
+    ContigMapping: reads and coverage of each contig
+  """
+  contig_mapping = ContigMapping()
+  for line in stream:
+    if line.startswith(b"@"):
+      if line.startswith(b"@SQ\t"):
+        contig_mapping.add_reference(line)
+      continue
+    contig_mapping.add_alignment(line)
+  return contig_mapping
+
+
+def write_contig_mapping(contig_mapping: ContigMapping, output_prefix: str):
+  """
+  Write the tables of the contig mapping:
+    {output_prefix}_contig_read_counts.tsv: name, length, mapped and unmapped reads (idxstats)
+    {output_prefix}_coverage.tsv: name, 1-based position and depth of the covered positions
+    {output_prefix}_contig_stats.tsv: name, length, mapped reads and summed depth
+    {output_prefix}_contig_reads.tsv: name and read name of each record on the contig
+  """
+  contig_names = [name.decode("utf-8") for name in contig_mapping.contig_names]
+  with open(f"{output_prefix}_contig_read_counts.tsv", "w") as file:
+    for index, name in enumerate(contig_names):
+      file.write(f"{name}\t{contig_mapping.contig_lengths[index]}\t"
+        f"{contig_mapping.mapped_counts[index]}\t{contig_mapping.unmapped_counts[index]}\n")
+    file.write(f"*\t0\t0\t{contig_mapping.unplaced_count}\n")
+
+  total_coverages = [0] * len(contig_names)
+  with open(f"{output_prefix}_coverage.tsv", "w") as file:
+    for index, positions, depths in contig_mapping.iter_contig_depths():
+      total_coverages[index] = int(depths.sum())
+      name = contig_names[index]
+      file.write("".join([f"{name}\t{position}\t{depth}\n"
+        for position, depth in zip((positions + 1).tolist(), depths.tolist())]))
+
+  with open(f"{output_prefix}_contig_stats.tsv", "w") as file:
+    file.write("Contig\tReference_Length\tTotal_Reads\tCoverage\n")
+    for index, name in enumerate(contig_names):
+      file.write(f"{name}\t{contig_mapping.contig_lengths[index]}\t"
+        f"{contig_mapping.mapped_counts[index]}\t{total_coverages[index]}\n")
+
+  # read names are written as bytes, as they came from the aligner
+  read_names = contig_mapping.read_names
+  read_contigs = contig_mapping.read_contigs
+  contig_prefixes = [name + b"\t" for name in contig_mapping.contig_names]
+  with open(f"{output_prefix}_contig_reads.tsv", "wb") as file:
+    file.writelines(contig_prefixes[read_contigs[index]] + read_names[index] + b"\n"
+      for index in contig_mapping.get_sorted_reads().tolist())
+
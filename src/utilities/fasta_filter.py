@@ -0,0 +1,150 @@
+"""
+  Filter the records of a FASTA file by the accession in their header, copying the
+  byte ranges of the selected records from an offset index of the file, or with a
+  streaming scan of the file when there is no index.
+"""
+import os, gzip, mmap
+
+
+# sidecar file with the byte range of each record of a fasta file
+FASTA_INDEX_EXTENSION = ".record_index"
+
+
+def get_header_accession(header: bytes):
+  # accession is the first word of the header, without '>'
+  words = header.split(None, 1)
+  return words[0][1:].decode() if len(words) > 0 else ""
+
+
+#########################################################################################
+#### FASTA RECORD INDEX
+
+def build_fasta_index(fasta_file):
+  """
+  Scan a plain fasta file for the byte range of each record, from its header to the
+  next header, and save it in the sidecar index file.
+  Returns:
+    list: (accession, offset, length) of each record in file order
+  """
+  index = []
+  accession, record_offset, offset = None, 0, 0
+  with open(fasta_file, "rb") as file:
+    for line in file:
+      if line.startswith(b">"):
+        if accession is not None:
+          index.append((accession, record_offset, offset - record_offset))
+        accession, record_offset = get_header_accession(line), offset
+      offset += len(line)
+  if accession is not None:
+    index.append((accession, record_offset, offset - record_offset))
+  save_fasta_index(fasta_file, index)
+  return index
+
+
+def save_fasta_index(fasta_file, index):
+  index_file = fasta_file + FASTA_INDEX_EXTENSION
+  stat = os.stat(fasta_file)
+  try:
+    with open(index_file, "w") as file:
+      file.write(f"#{stat.st_size}\t{stat.st_mtime_ns}\n")
+      file.writelines(f"{accession}\t{offset}\t{length}\n" for accession, offset, length in index)
+  except OSError as e:
+    print(f"Could not write fasta index {index_file}: {e}")
+
+
+def load_fasta_index(fasta_file):
+  """
+  Load the sidecar index of a fasta file, valid while the fasta file keeps the same
+  size and modification time.
+  Returns:
+    list: (accession, offset, length) of each record in file order, None if not valid
+  """
+  index_file = fasta_file + FASTA_INDEX_EXTENSION
+  if not os.path.exists(index_file):
+    return None
+  stat = os.stat(fasta_file)
+  try:
+    with open(index_file, "r") as file:
+      size, mtime_ns = file.readline()[1:].strip().split("\t")
+      if int(size) != stat.st_size or int(mtime_ns) != stat.st_mtime_ns:
+        return None
+      index = []
+      for line in file:
+        accession, offset, length = line.rstrip("\n").split("\t")
+        index.append((accession, int(offset), int(length)))
+  except ValueError:
+    print(f"Ignoring invalid fasta index: {index_file}")
+    return None
+  return index
+
+
+#########################################################################################
+#### FILTER FASTA RECORDS
+
+def copy_file_ranges(fasta_file, ranges, output_file):
+  # copy the byte ranges in the kernel with sendfile, or through a memory map
+  with open(fasta_file, "rb") as in_file, open(output_file, "wb") as out_file:
+    if hasattr(os, "sendfile"):
+      for offset, length in ranges:
+        while length > 0:
+          sent = os.sendfile(out_file.fileno(), in_file.fileno(), offset, length)
+          if sent == 0:
+            raise IOError(f"Unexpected end of file copying {fasta_file}")
+          offset, length = offset + sent, length - sent
+    elif len(ranges) > 0:
+      with mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for offset, length in ranges:
+          out_file.write(data[offset:offset + length])
+
+
+def filter_fasta_by_index(fasta_file, index, accessions, output_file):
+  ranges = [(offset, length) for accession, offset, length in index if accession in accessions]
+  copy_file_ranges(fasta_file, ranges, output_file)
+  return len(ranges)
+
+
+def filter_fasta_by_scan(fasta_file, accessions, output_file):
+  # stream the records with a single output handle, stopping after the last accession,
+  # the accessions are expected to be unique as the contig names of an assembly
+  pending_accessions = set(accessions)
+  write_count, write_flag = 0, False
+  open_function = gzip.open if fasta_file.endswith(".gz") else open
+  with open_function(fasta_file, "rb") as in_file, open(output_file, "wb") as out_file:
+    for line in in_file:
+      if line.startswith(b">"):
+        if len(pending_accessions) == 0:
+          break
+        accession = get_header_accession(line)
+        write_flag = accession in accessions
+        if write_flag:
+          pending_accessions.discard(accession)
+          write_count += 1
+      if write_flag:
+        out_file.write(line)
+  return write_count
+
+
+def filter_fasta_records(fasta_file, accessions, output_file, build_index=False):
+  """
+  Write the records of a fasta file with the given accessions, in file order.
+  Parameters:
+    fasta_file (str): fasta file, plain or gzipped
+    accessions (set): accessions of the records to write
+    output_file (str): fasta file to write
+    build_index (bool): index a plain fasta file without a valid index before filtering
+  Returns:
+    int: number of records written
+  """
+  print(f"Valid accessions to write: {len(accessions)}")
+  index = None
+  if not fasta_file.endswith(".gz"):
+    index = load_fasta_index(fasta_file)
+    if index is None and build_index:
+      print(f"Building fasta index: {fasta_file + FASTA_INDEX_EXTENSION}")
+      index = build_fasta_index(fasta_file)
+  if index is not None:
+    write_count = filter_fasta_by_index(fasta_file, index, accessions, output_file)
+  else:
+    write_count = filter_fasta_by_scan(fasta_file, accessions, output_file)
+  print(f"Records written: {write_count}")
+  return write_count
@@ -1,24 +1,156 @@
-import gzip
-from Bio import SeqIO
+import os, re, gzip, shutil, subprocess, multiprocessing
+from collections import defaultdict
+from contextlib import contextmanager
 from dataclasses import dataclass
 
 
-def get_total_abundance(fastq_file):
+# size of the decompressed blocks read when counting lines
+READ_BLOCK_SIZE = 4 * 1024 * 1024
+# external gzip decompressors, faster than python gzip when installed
+GZIP_DECOMPRESSORS = [["igzip", "-dc"], ["pigz", "-dc"]]
+# line break followed by a line with only whitespace, as skipped by str.strip()
+BLANK_LINE_PATTERN = re.compile(rb"\n[ \t\r\f\v]*(?=\n)")
+# sidecar file with the read count of a fastq file
+READ_COUNT_CACHE_EXTENSION = ".read_count"
+# external gzip compressor, the level of the gzip command
+GZIP_COMPRESSOR = ["pigz", "-c", "-6"]
+
+
+@contextmanager
+def open_fastq_bytes(fastq_file):
+  """
+  Open a fastq file as a binary stream of decompressed bytes.
+  Gzipped files are decompressed by igzip or pigz when available.
+  Parameters:
+    fastq_file (str): path of a .fastq or .fastq.gz file
+  """
   # Check if the file is gzipped
-  if fastq_file.endswith(".fastq.gz"):
-    file_handle = gzip.open
-  elif fastq_file.endswith(".fastq"):
-    file_handle = open
-  else:
+  if fastq_file.endswith(".fastq"):
+    with open(fastq_file, "rb") as file:
+      yield file
+    return
+  elif not fastq_file.endswith(".fastq.gz"):
     raise ValueError(f"Trying to read invalid fastq file: {fastq_file}")
-  # Count reads in the FASTQ file
+  decompressor = next((command for command in GZIP_DECOMPRESSORS
+    if shutil.which(command[0]) is not None), None)
+  if decompressor is None:
+    with gzip.open(fastq_file, "rb") as file:
+      yield file
+    return
+  with open(fastq_file, "rb") as compressed_file:
+    process = subprocess.Popen(decompressor, stdin=compressed_file, stdout=subprocess.PIPE)
+    try:
+      yield process.stdout
+    except BaseException:
+      process.kill()
+      raise
+    finally:
+      process.stdout.close()
+      return_code = process.wait()
+  if return_code != 0:
+    raise RuntimeError(f"Error decompressing {fastq_file} with {decompressor[0]}: {return_code}")
+
+
+@contextmanager
+def open_gzip_writer(output_file, nthreads=1):
+  """
+  Open a gzip file to write bytes, compressed by pigz when available.
+  Parameters:
+    output_file (str): path of the .gz file to create
+    nthreads (int): number of threads of the compressor
+  """
+  if shutil.which(GZIP_COMPRESSOR[0]) is None:
+    with gzip.open(output_file, "wb", compresslevel=6) as file:
+      yield file
+    return
+  with open(output_file, "wb") as compressed_file:
+    process = subprocess.Popen(GZIP_COMPRESSOR + ["-p", str(nthreads)],
+      stdin=subprocess.PIPE, stdout=compressed_file)
+    try:
+      yield process.stdin
+    except BaseException:
+      process.kill()
+      raise
+    finally:
+      process.stdin.close()
+      return_code = process.wait()
+  if return_code != 0:
+    raise RuntimeError(f"Error compressing {output_file} with {GZIP_COMPRESSOR[0]}: {return_code}")
+
+
+def count_fastq_lines(fastq_file):
+  # Count the non blank lines reading the file in large blocks
   line_counter = 0
-  with file_handle(fastq_file, "rt") as file:
-    for line in file:
-      line = line.strip()
-      if len(line) > 0:
-        line_counter += 1
-  return int(line_counter/4)
+  # partial line after the last line break, None if it has non whitespace characters
+  blank_tail = b""
+  with open_fastq_bytes(fastq_file) as file:
+    while True:
+      block = file.read(READ_BLOCK_SIZE)
+      if len(block) == 0:
+        break
+      line_counter += block.count(b"\n")
+      # remove the lines with only whitespace, continuing the partial line of the last block
+      if blank_tail is not None:
+        block = b"\n" + blank_tail + block
+      line_counter -= len(BLANK_LINE_PATTERN.findall(block))
+      end = block.rfind(b"\n")
+      if end >= 0 or blank_tail is not None:
+        tail = block[end+1:]
+        blank_tail = tail if len(tail.strip()) == 0 else None
+  # last line without line break
+  if blank_tail is None:
+    line_counter += 1
+  return line_counter
+
+
+def get_read_count_cache_file(fastq_file, cache_dir):
+  return os.path.join(cache_dir, os.path.basename(fastq_file) + READ_COUNT_CACHE_EXTENSION)
+
+
+def get_cached_total_abundance(fastq_file, cache_dir):
+  cache_file = get_read_count_cache_file(fastq_file, cache_dir)
+  if not os.path.exists(cache_file):
+    return None
+  stat = os.stat(fastq_file)
+  try:
+    with open(cache_file, "r") as file:
+      size, mtime_ns, read_count = file.readline().strip().split("\t")
+    if int(size) == stat.st_size and int(mtime_ns) == stat.st_mtime_ns:
+      return int(read_count)
+  except ValueError:
+    print(f"Ignoring invalid read count cache: {cache_file}")
+  return None
+
+
+def set_cached_total_abundance(fastq_file, cache_dir, read_count):
+  cache_file = get_read_count_cache_file(fastq_file, cache_dir)
+  stat = os.stat(fastq_file)
+  try:
+    with open(cache_file, "w") as file:
+      file.write(f"{stat.st_size}\t{stat.st_mtime_ns}\t{read_count}\n")
+  except OSError as e:
+    print(f"Could not write read count cache {cache_file}: {e}")
+
+
+def get_total_abundance(fastq_file, cache_dir=""):
+  """
+  Count the reads of a fastq file.
+  Parameters:
+    fastq_file (str): path of a .fastq or .fastq.gz file
+    cache_dir (str): if given, read and write the count in a sidecar file in this
+      directory, valid while the fastq file keeps the same size and modification time
+  Returns:
+    int: number of reads
+  """
+  if cache_dir != "":
+    read_count = get_cached_total_abundance(fastq_file, cache_dir)
+    if read_count is not None:
+      return read_count
+  # Count reads in the FASTQ file
+  read_count = int(count_fastq_lines(fastq_file)/4)
+  if cache_dir != "":
+    set_cached_total_abundance(fastq_file, cache_dir, read_count)
+  return read_count
 
 
 @dataclass
@@ -31,26 +163,221 @@ class ReadInfo:
     return 0 if self.count == 0 else self.lengths/self.count
 
 
-def count_reads_by_sequence_id(fastq_file):
-  # Check if the file is gzipped
-  if fastq_file.endswith(".fastq.gz"):
-    file_handle = gzip.open
-  elif fastq_file.endswith(".fastq"):
-    file_handle = open
+#########################################################################################
+#### FASTQ TOKENIZER
+def iter_fastq_records(file):
+  """
+  Yield the (id, sequence length) of each record of a 4-line fastq binary stream,
+  the quality line is skipped without decoding.
+  """
+  while True:
+    header = file.readline()
+    if len(header) == 0:
+      break
+    if len(header.strip()) == 0:
+      continue
+    sequence = file.readline()
+    separator = file.readline()
+    file.readline()
+    if not header.startswith(b"@") or not separator.startswith(b"+"):
+      raise ValueError(f"Invalid fastq record: {header}")
+    title = header[1:].split(None, 1)
+    yield (title[0].decode() if len(title) > 0 else ""), len(sequence.rstrip())
+
+
+def iter_fastq_lines(file):
+  """
+  Yield the (id, header, sequence, separator, quality) lines of each record of a
+  4-line fastq binary stream, with the line breaks.
+  """
+  while True:
+    header = file.readline()
+    if len(header) == 0:
+      break
+    if len(header.strip()) == 0:
+      continue
+    sequence = file.readline()
+    separator = file.readline()
+    quality = file.readline()
+    if not header.startswith(b"@") or not separator.startswith(b"+"):
+      raise ValueError(f"Invalid fastq record: {header}")
+    title = header[1:].split(None, 1)
+    yield (title[0].decode() if len(title) > 0 else ""), header, sequence, separator, quality
+
+
+def iter_fastq_buffer_records(data, position=0, final=False):
+  """
+  Yield the (id, sequence length, next position) of the complete records of a
+  fastq buffer starting at position. If final the last line may not have a
+  line break, otherwise an incomplete record at the end is left unread.
+  """
+  while position < len(data):
+    line_ends = []
+    line_start = position
+    while len(line_ends) < 4:
+      line_end = data.find(b"\n", line_start)
+      if line_end < 0:
+        if not final or line_start >= len(data):
+          return
+        line_end = len(data)
+      # skip empty lines before the record header
+      if len(line_ends) == 0 and len(data[line_start:line_end].strip()) == 0:
+        position = line_start = line_end + 1
+        continue
+      line_ends.append(line_end)
+      line_start = line_end + 1
+    header = data[position:line_ends[0]]
+    separator = data[line_ends[1]+1:line_ends[2]]
+    if not header.startswith(b"@") or not separator.startswith(b"+"):
+      raise ValueError(f"Invalid fastq record: {header}")
+    title = header[1:].split(None, 1)
+    sequence_length = len(data[line_ends[0]+1:line_ends[1]].rstrip())
+    position = line_ends[3] + 1
+    yield (title[0].decode() if len(title) > 0 else ""), sequence_length, position
+
+
+def find_fastq_record_start(data):
+  # a record starts after a line break with a '@' line followed two lines
+  # after by a '+' line, a quality line starting with '@' is followed two
+  # lines after by a sequence line
+  position = data.find(b"\n@")
+  while position >= 0:
+    header_end = data.find(b"\n", position + 1)
+    sequence_end = data.find(b"\n", header_end + 1) if header_end >= 0 else -1
+    if sequence_end < 0 or sequence_end + 1 >= len(data):
+      return -1
+    if data.startswith(b"+", sequence_end + 1):
+      return position + 1
+    position = data.find(b"\n@", position + 1)
+  return -1
+
+
+def add_read_info(reads, record_id, sequence_length):
+  record_id = record_id.rsplit('_', 2)[0]
+  if record_id not in reads:
+    reads[record_id] = ReadInfo()
+  reads[record_id].lengths += sequence_length
+  reads[record_id].count += 1
+
+
+#########################################################################################
+#### PARALLEL FASTQ READ COUNT
+def get_bgzf_block_offsets(fastq_file):
+  """
+  Get the offsets of the BGZF blocks of a gzipped file.
+  Returns:
+    list: offset of each block plus the file size, or None if not BGZF
+  """
+  offsets = []
+  file_size = os.path.getsize(fastq_file)
+  with open(fastq_file, "rb") as file:
+    offset = 0
+    while offset < file_size:
+      header = file.read(12)
+      # gzip magic, deflate and FEXTRA flag
+      if len(header) < 12 or header[:4] != b"\x1f\x8b\x08\x04":
+        return None
+      extra = file.read(int.from_bytes(header[10:12], "little"))
+      block_size, position = 0, 0
+      while position + 4 <= len(extra):
+        subfield_length = int.from_bytes(extra[position+2:position+4], "little")
+        if extra[position:position+2] == b"BC" and subfield_length == 2:
+          block_size = int.from_bytes(extra[position+4:position+6], "little") + 1
+        position += 4 + subfield_length
+      if block_size == 0:
+        return None
+      offsets.append(offset)
+      offset += block_size
+      file.seek(offset)
+  offsets.append(file_size)
+  return offsets
+
+
+def get_fastq_chunks(fastq_file, nchunks):
+  # split plain files by bytes and BGZF files by blocks, None if not splittable
+  if fastq_file.endswith(".fastq"):
+    file_size = os.path.getsize(fastq_file)
+    offsets = list(range(0, file_size, max(1, file_size // nchunks))) + [file_size]
+    is_bgzf = False
   else:
-    raise ValueError(f"Trying to read invalid fastq file: {fastq_file}")  
-  # Parse the FASTQ file
+    offsets = get_bgzf_block_offsets(fastq_file)
+    if offsets is None:
+      return None
+    step = max(1, (len(offsets) - 1) // nchunks)
+    offsets = offsets[:-1:step] + [offsets[-1]]
+    is_bgzf = True
+  offsets = sorted(set(offsets))
+  return [(fastq_file, start, end, is_bgzf) for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def count_fastq_chunk_reads(chunk):
+  """
+  Count the reads of the records starting inside a chunk of the fastq file.
+  Returns:
+    tuple: bytes before the first record, dict of id to (count, lengths) and
+      bytes after the last complete record, or (chunk bytes, None, b"") when no
+      record starts inside the chunk
+  """
+  fastq_file, start, end, is_bgzf = chunk
+  with open(fastq_file, "rb") as file:
+    file.seek(start)
+    data = file.read(end - start)
+  if is_bgzf:
+    # each BGZF block is a complete gzip member
+    data = gzip.decompress(data)
+  position = 0 if start == 0 else find_fastq_record_start(data)
+  if position < 0:
+    return data, None, b""
   reads = {}
-  total_read_count = 0  
-  with file_handle(fastq_file, "rt") as file:
-    for record in SeqIO.parse(file, "fastq"):
-      # Increment the count for this sequence ID
-      record_id = record.id.rsplit('_', 2)[0]
-      if record_id not in reads:
-        reads[record_id] = ReadInfo()
-      reads[record_id].lengths += len(record.seq)
-      reads[record_id].count += 1
-      total_read_count += 1
+  next_position = position
+  for record_id, sequence_length, next_position in iter_fastq_buffer_records(data, position):
+    add_read_info(reads, record_id, sequence_length)
+  counts = {record_id: (read.count, read.lengths) for record_id, read in reads.items()}
+  return data[:position], counts, data[next_position:]
+
+
+def count_reads_by_sequence_id_parallel(fastq_file, nprocesses):
+  """
+  Count the reads of a plain or BGZF compressed fastq file using many processes.
+  Each process counts the records starting in its chunk and the fragments
+  between chunks are joined and counted at the end.
+  Returns:
+    dict: mapping of id to ReadInfo, or None if the file can't be split
+  """
+  chunks = get_fastq_chunks(fastq_file, nprocesses * 4)
+  if chunks is None:
+    return None
+  reads = defaultdict(ReadInfo)
+  pending = b""
+  with multiprocessing.Pool(nprocesses) as pool:
+    for prefix, counts, suffix in pool.imap(count_fastq_chunk_reads, chunks):
+      pending += prefix
+      if counts is None:
+        continue
+      # the pending fragments form the records between the chunks
+      for record_id, sequence_length, _ in iter_fastq_buffer_records(pending, final=True):
+        add_read_info(reads, record_id, sequence_length)
+      for record_id, (count, lengths) in counts.items():
+        reads[record_id].count += count
+        reads[record_id].lengths += lengths
+      pending = suffix
+  for record_id, sequence_length, _ in iter_fastq_buffer_records(pending, final=True):
+    add_read_info(reads, record_id, sequence_length)
+  return dict(reads)
+
+
+def count_reads_by_sequence_id(fastq_file, nprocesses=1):
+  # Parse the FASTQ file
+  reads = None
+  if nprocesses > 1:
+    reads = count_reads_by_sequence_id_parallel(fastq_file, nprocesses)
+  if reads is None:
+    reads = {}
+    with open_fastq_bytes(fastq_file) as file:
+      for record_id, sequence_length in iter_fastq_records(file):
+        # Increment the count for this sequence ID
+        add_read_info(reads, record_id, sequence_length)
+  total_read_count = sum(read.count for read in reads.values())
   
   count = 0
   abundance_sum = 0.0
@@ -0,0 +1,215 @@
+"""
+  Re-score the reads of a Kraken 2 output (.kout) for a list of confidence
+  thresholds in one pass, from the k-mer hit list of each read, following the
+  classification of kraken2 (ResolveTree): the taxon with the most hits in its
+  lineage is called, ties are resolved to their LCA, and the call moves up the
+  lineage until its clade has ceil(confidence * total k-mers) hits.
+  The --minimum-hit-groups filter can't be recovered from the hit lists and is
+  not applied.
+"""
+import math
+from collections import defaultdict
+from dataclasses import dataclass, field
+from . import kraken_output_parser as KrakenOutputParser
+
+
+# kraken 2 rank codes of the ranks (with the same domain ranks of parse_level), the
+# other ranks take the code of the closest ranked ancestor and their distance to it
+RANK_CODES = {
+  "SUPERKINGDOM": "D", "DOMAIN": "D", "ACELLULAR ROOT": "D", "KINGDOM": "K",
+  "PHYLUM": "P", "CLASS": "C", "ORDER": "O", "FAMILY": "F", "GENUS": "G", "SPECIES": "S"
+  }
+
+
+@dataclass
+class ConfidenceResult:
+  """
+  Classified reads of a kraken output re-scored with one confidence threshold.
+  """
+  confidence: float
+  unclassified_count: int = 0
+  # taxid to the number of reads classified to it
+  taxid_counts: dict = field(default_factory=lambda: defaultdict(int))
+  # accession to taxid to the number of reads, as the k2result_accession_to_taxid
+  accession_taxid_counts: dict = field(default_factory=dict)
+
+
+def parse_hit_list(hit_list: str):
+  """
+  Parse the k-mer hit list of a read, as "taxid:count" runs with "A" for the
+  ambiguous k-mers and "|:|" between the mates.
+  Returns:
+    hit_counts (dict): taxid to the number of k-mers assigned to it, 0 and A excluded
+    total_kmers (int): number of k-mers of the read, the ambiguous included
+  """
+  hit_counts = defaultdict(int)
+  total_kmers = 0
+  for hit in hit_list.split():
+    if hit == "|:|":
+      continue
+    taxid, _, count = hit.rpartition(":")
+    count = int(count)
+    total_kmers += count
+    if taxid != "0" and taxid != "A":
+      hit_counts[taxid] += count
+  return hit_counts, total_kmers
+
+
+class KrakenConfidenceScorer:
+  """
+  Classify the reads from their hit lists for many confidence thresholds, with the
+  ancestor tests on the Euler tour intervals of the taxonomy tree.
+  """
+  def __init__(self, taxonomy_tree, confidences):
+    self.taxonomy_tree = taxonomy_tree
+    self.confidences = list(confidences)
+    # thresholds checked from the lowest, which is the deepest call in the lineage
+    self.confidence_order = sorted(range(len(self.confidences)), key=lambda i: self.confidences[i])
+    # taxid to (tour_start, tour_end, node), None for taxids not in the taxonomy
+    self.tours = {}
+    self.missing_taxids = set()
+
+  def get_tour(self, taxid):
+    if taxid not in self.tours:
+      node = self.taxonomy_tree.get(taxid, None)
+      self.tours[taxid] = (node.tour_start, node.tour_end, node) if node is not None else None
+      if node is None:
+        self.missing_taxids.add(taxid)
+    return self.tours[taxid]
+
+  def get_parent_tour(self, tour):
+    parent = tour[2].parent
+    return self.get_tour(parent.taxid) if parent is not None else None
+
+  def get_lca_tour(self, tour1, tour2):
+    while tour1 is not None and not (tour1[0] <= tour2[0] < tour1[1]):
+      tour1 = self.get_parent_tour(tour1)
+    return tour1
+
+  def classify_read(self, hit_counts, total_kmers):
+    """
+    Classify a read for each confidence threshold.
+    Parameters:
+      hit_counts (dict): taxid to the number of k-mers assigned to it
+      total_kmers (int): number of k-mers of the read
+    Returns:
+      list: called node for each confidence, None if unclassified
+    """
+    calls = [None] * len(self.confidences)
+    hits = []
+    for taxid, count in hit_counts.items():
+      tour = self.get_tour(taxid)
+      if tour is not None:
+        hits.append((tour, count))
+    if len(hits) == 0:
+      return calls
+    # taxon with the most hits in its lineage, the LCA of the taxa tied
+    max_score, max_tour = 0, None
+    for tour, _ in hits:
+      score = sum(count for hit_tour, count in hits if hit_tour[0] <= tour[0] < hit_tour[1])
+      if score > max_score:
+        max_score, max_tour = score, tour
+      elif score == max_score:
+        max_tour = self.get_lca_tour(max_tour, tour)
+    # move up the lineage until the clade has the hits required by each confidence
+    total_hits = sum(count for _, count in hits)
+    position, tour = 0, max_tour
+    while tour is not None and position < len(calls):
+      clade_score = sum(count for hit_tour, count in hits if tour[0] <= hit_tour[0] < tour[1])
+      while position < len(calls):
+        index = self.confidence_order[position]
+        if clade_score < math.ceil(self.confidences[index] * total_kmers):
+          break
+        calls[index] = tour[2]
+        position += 1
+      # the ancestors have no more hits, the remaining confidences are not met
+      if clade_score == total_hits:
+        break
+      tour = self.get_parent_tour(tour)
+    return calls
+
+
+def rescore_kraken_output(kout_file, taxonomy_tree, confidences, by_accession=False):
+  """
+  Re-score all reads of a kraken output for each confidence threshold.
+  Parameters:
+    kout_file (str): kraken 2 output file, with the k-mer hit lists
+    taxonomy_tree (dict): taxonomy tree with Euler tour of the kraken database
+    confidences (list): confidence thresholds, from 0 to 1
+    by_accession (bool): also count the reads by accession of the simulated reads
+  Returns:
+    list: ConfidenceResult of each confidence threshold
+  """
+  print(f"Re-scoring kraken output {kout_file} for confidences: {confidences}")
+  scorer = KrakenConfidenceScorer(taxonomy_tree, confidences)
+  results = [ConfidenceResult(confidence) for confidence in confidences]
+  for lines in KrakenOutputParser.iter_kout_line_blocks(kout_file):
+    for line in lines:
+      columns = line.split("\t", 4)
+      if len(columns) < 5:
+        print(f"Invalid kraken output line: {line}")
+        continue
+      read_name = columns[1].strip()
+      hit_counts, total_kmers = parse_hit_list(columns[4])
+      calls = scorer.classify_read(hit_counts, total_kmers)
+      accession = KrakenOutputParser.get_read_accession(read_name) if by_accession else None
+      for result, node in zip(results, calls):
+        if node is None:
+          result.unclassified_count += 1
+          continue
+        result.taxid_counts[node.taxid] += 1
+        if by_accession:
+          if accession not in result.accession_taxid_counts:
+            result.accession_taxid_counts[accession] = defaultdict(int)
+          result.accession_taxid_counts[accession][node.taxid] += 1
+  if len(scorer.missing_taxids) > 0:
+    print(f"Hits to {len(scorer.missing_taxids)} taxids not found in taxonomy were ignored")
+  return results
+
+
+def write_kraken_report(taxonomy_tree, taxid_counts, unclassified_count, output_file):
+  """
+  Write the classified reads in the kraken 2 report format: percentage of reads,
+  reads in the clade, reads in the taxon, rank code, taxid and indented name.
+  Parameters:
+    taxonomy_tree (dict): taxonomy tree of the classified taxids
+    taxid_counts (dict): taxid to the number of reads classified to it
+    unclassified_count (int): number of unclassified reads
+    output_file (str): kraken report file to write
+  """
+  clade_counts, taxon_counts = defaultdict(int), defaultdict(int)
+  root_nodes = {}
+  for taxid, count in taxid_counts.items():
+    node = taxonomy_tree[taxid]
+    taxon_counts[node.taxid] += count
+    while node is not None:
+      clade_counts[node.taxid] += count
+      if node.parent is None:
+        root_nodes[node.taxid] = node
+      node = node.parent
+  total_reads = sum(taxon_counts.values()) + unclassified_count
+  get_percent = lambda count: 100 * count / total_reads if total_reads > 0 else 0
+
+  with open(output_file, "w") as file:
+    if unclassified_count > 0:
+      file.write(f"{get_percent(unclassified_count):6.2f}\t{unclassified_count}\t"
+        f"{unclassified_count}\tU\t0\tunclassified\n")
+    # depth first, the children with more reads first
+    pending_nodes = [(node, 0, "R", 0) for node in reversed(list(root_nodes.values()))]
+    while pending_nodes:
+      node, depth, rank_code, rank_depth = pending_nodes.pop()
+      rank = node.level.strip().upper()
+      if depth == 0:
+        rank_code, rank_depth = "R", 0
+      elif rank in RANK_CODES:
+        rank_code, rank_depth = RANK_CODES[rank], 0
+      else:
+        rank_depth += 1
+      code = rank_code + (str(rank_depth) if rank_depth > 0 else "")
+      clade_count = clade_counts[node.taxid]
+      file.write(f"{get_percent(clade_count):6.2f}\t{clade_count}\t{taxon_counts[node.taxid]}\t"
+        f"{code}\t{node.taxid}\t{'  ' * depth}{node.name}\n")
+      children = [child for child in node.children if child.taxid in clade_counts]
+      children.sort(key=lambda child: clade_counts[child.taxid], reverse=True)
+      for child in reversed(children):
+        pending_nodes.append((child, depth + 1, rank_code, rank_depth))
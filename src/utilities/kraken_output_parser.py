@@ -0,0 +1,107 @@
+"""
+  Stream the Kraken 2 per read output (.kout) in large blocks, parsing only the
+  first three columns (status, read name, taxid), and reduce the classified reads
+  to counts by taxid or by (accession, taxid).
+"""
+from collections import defaultdict
+from . import mapped_reads_table as MappedReadsTable
+
+
+# size of the blocks read from the kraken output file
+KOUT_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def get_read_accession(read_name: str):
+  # simulated reads are named {accession}_{number}_{number}
+  return read_name.rsplit('_', 2)[0]
+
+
+def iter_kout_line_blocks(kout_file, block_size=KOUT_BLOCK_SIZE):
+  # lists of complete lines of the kraken output, one list for each block read
+  pending = b""
+  with open(kout_file, "rb") as file:
+    while True:
+      data = file.read(block_size)
+      if not data:
+        break
+      data = pending + data
+      end = data.rfind(b"\n") + 1
+      pending = data[end:]
+      if end > 0:
+        yield data[:end].decode("utf-8").split("\n")[:-1]
+  if pending:
+    yield [pending.decode("utf-8")]
+
+
+def count_kraken_classified_reads(kout_file, mapped_reads=None, by_accession=False,
+                                  valid_taxids=None):
+  """
+  Count the classified reads of a kraken output file.
+  Parameters:
+    kout_file (str): kraken 2 output file
+    mapped_reads (dict): read name to the number of times it was mapped to a contig,
+      or a MappedReadsTable, if given the unmapped reads of each pair are also counted
+    by_accession (bool): count by (accession, taxid) instead of by taxid
+    valid_taxids (dict): taxonomy tree or any container of the accepted taxids,
+      the reads classified to other taxids are reported and skipped
+  Returns:
+    read_counts (dict): taxid or (accession, taxid) to the number of classified reads
+    unmapped_counts (dict): taxid or (accession, taxid) to the number of reads of the
+      pairs not mapped to contigs, None if mapped_reads is not given
+  """
+  read_counts = defaultdict(int)
+  unmapped_counts = defaultdict(int) if mapped_reads is not None else None
+  is_valid_taxid = {}
+  for lines in iter_kout_line_blocks(kout_file):
+    read_names, keys = [], []
+    for line in lines:
+      if line[:2] != "C\t":
+        continue
+      # the k-mer mapping column is never split
+      columns = line.split("\t", 3)
+      if len(columns) < 3:
+        continue
+      read_name = columns[1].strip()
+      taxid = columns[2].strip()
+      key = (get_read_accession(read_name), taxid) if by_accession else taxid
+      if taxid not in is_valid_taxid:
+        is_valid_taxid[taxid] = (len(taxid) > 0 and
+          (valid_taxids is None or taxid in valid_taxids))
+      if len(read_name) == 0 or (by_accession and len(key[0]) == 0) or not is_valid_taxid[taxid]:
+        print(f"Error not included k2result: read_name: {read_name}, taxid: {taxid}")
+        continue
+      read_counts[key] += 1
+      read_names.append(read_name)
+      keys.append(key)
+    if mapped_reads is not None:
+      # get result if unmapped, looking up the reads of the whole block at once
+      mapped_counts = MappedReadsTable.get_mapped_counts(mapped_reads, read_names)
+      for key, mapped_count in zip(keys, mapped_counts):
+        read_unmapped_count = 2 - mapped_count
+        if read_unmapped_count > 0:
+          unmapped_counts[key] += read_unmapped_count
+  return read_counts, unmapped_counts
+
+
+def get_read_names_by_taxids(kout_file, taxids):
+  """
+  Get the names of the reads assigned to any of the taxids in a kraken output file.
+  Parameters:
+    kout_file (str): kraken 2 output file
+    taxids (set): taxids of the reads to get, '0' for the unclassified reads
+  Returns:
+    set: read names
+  """
+  read_names = set()
+  for lines in iter_kout_line_blocks(kout_file):
+    for line in lines:
+      columns = line.split("\t", 3)
+      if len(columns) < 3:
+        continue
+      taxid = columns[2].strip()
+      # output with --use-names has the taxid as "name (taxid N)"
+      if "taxid" in taxid:
+        taxid = taxid.split("taxid ")[-1][:-1]
+      if taxid in taxids:
+        read_names.add(columns[1].strip())
+  return read_names
@@ -0,0 +1,88 @@
+"""
+  Compact table of the number of times each read was mapped to a contig, stored
+  as a sorted array of 64-bit hashes of the read names and their counts, about 9
+  bytes per read instead of the ~100 bytes of a dict keyed by the read names.
+"""
+import csv
+import numpy as np
+
+
+def hash_read_names(read_names):
+  # 64-bit hashes of the read names, python string hashes are the same only in the
+  # process that built the table and in its forked children
+  return np.fromiter(map(hash, read_names), dtype=np.int64, count=len(read_names))
+
+
+class MappedReadsTable:
+  """
+  Read name to mapped count lookup, with the same get interface of the dict of
+  mapped reads. Two different read names sharing a hash are counted together,
+  which is negligible for 64-bit hashes.
+  """
+  def __init__(self, read_hashes):
+    self.hashes, counts = np.unique(np.asarray(read_hashes, dtype=np.int64), return_counts=True)
+    # only counts up to 2 are meaningful for read pairs
+    self.counts = np.minimum(counts, np.iinfo(np.uint8).max).astype(np.uint8)
+
+  def __len__(self):
+    return len(self.hashes)
+
+  def __contains__(self, read_name):
+    return self.get(read_name, 0) > 0
+
+  def get(self, read_name, default=0):
+    read_hash = hash(read_name)
+    position = int(np.searchsorted(self.hashes, read_hash))
+    if position < len(self.hashes) and self.hashes[position] == read_hash:
+      return int(self.counts[position])
+    return default
+
+  def get_counts(self, read_names):
+    """
+    Get the mapped count of many reads at once, 0 for the reads not mapped.
+    Parameters:
+      read_names (list): read names to look for
+    Returns:
+      np.ndarray: mapped count of each read name
+    """
+    if len(self.hashes) == 0:
+      return np.zeros(len(read_names), dtype=np.uint8)
+    read_hashes = hash_read_names(read_names)
+    positions = np.minimum(np.searchsorted(self.hashes, read_hashes), len(self.hashes) - 1)
+    is_mapped = self.hashes[positions] == read_hashes
+    return np.where(is_mapped, self.counts[positions], 0)
+
+
+def get_mapped_counts(mapped_reads, read_names):
+  # mapped count of each read name from a MappedReadsTable or a dict of mapped reads
+  if hasattr(mapped_reads, "get_counts"):
+    return mapped_reads.get_counts(read_names).tolist()
+  return [mapped_reads.get(read_name, 0) for read_name in read_names]
+
+
+def build_mapped_reads_table(read_hashes, mapping_file):
+  """
+  Build the table of mapped reads from the hashes of the read names in the mapping
+  file, reporting the reads mapped more than twice as the dict counting does.
+  Parameters:
+    read_hashes (array): hash of the read name of each row of the mapping file
+    mapping_file (str): contig to read name tsv file
+  Returns:
+    MappedReadsTable: number of times each read was mapped
+  """
+  mapped_reads = MappedReadsTable(read_hashes)
+  repeated_hashes = set(mapped_reads.hashes[mapped_reads.counts > 2].tolist())
+  if len(repeated_hashes) > 0:
+    # the names are not kept in the table, find them again in the mapping file
+    repeated_reads = {}
+    with open(mapping_file, 'r') as file:
+      reader = csv.reader(file, delimiter='\t')
+      for row in reader:
+        read_mapped_name = row[1].strip()
+        if hash(read_mapped_name) not in repeated_hashes:
+          continue
+        repeated_reads[read_mapped_name] = repeated_reads.get(read_mapped_name, 0) + 1
+        if repeated_reads[read_mapped_name] > 2:
+          print(f"** MAPPING ERROR: read {read_mapped_name} was mapped to a contig " +
+            f"{repeated_reads[read_mapped_name]} times")
+  return mapped_reads
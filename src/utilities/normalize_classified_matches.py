@@ -1,28 +1,38 @@
-import csv
+import os, csv
+from array import array
 from collections import defaultdict
 from . import fastq_read_info as FastqReadInfo
 from . import taxonomy_tree_parser as TaxonomyParser
 from . import alignment_result_parser as AlignmentResultParser
+from . import mapped_reads_table as MappedReadsTable
+from . import kraken_output_parser as KrakenOutputParser
 
 
 #########################################################################################
 #### LOAD READ COUNT
-def count_contig_reads(mapping_file):
+def count_contig_reads(mapping_file, compact_mapped_reads=False):
   # Dictionary to store contig to reads abudance
   # Open the file and read line by line
   contig_read_count = defaultdict(int)
   mapped_reads = defaultdict(int)
+  # hashes of the read names, when counted in a compact table
+  read_hashes = array("q")
   with open(mapping_file, 'r') as file:
     reader = csv.reader(file, delimiter='\t')
     for row in reader:
       contig_name = row[0].strip()
       read_mapped_name = row[1].strip()
-      mapped_reads[read_mapped_name] += 1
-      if mapped_reads[read_mapped_name] > 2: 
-        print(f"** MAPPING ERROR: read {read_mapped_name} was mapped to a contig " +
-          f"{mapped_reads[read_mapped_name]} times")
+      if compact_mapped_reads:
+        read_hashes.append(hash(read_mapped_name))
+      else:
+        mapped_reads[read_mapped_name] += 1
+        if mapped_reads[read_mapped_name] > 2: 
+          print(f"** MAPPING ERROR: read {read_mapped_name} was mapped to a contig " +
+            f"{mapped_reads[read_mapped_name]} times")
       # Add the read to the set for the given contig
       contig_read_count[contig_name] += 1
+  if compact_mapped_reads:
+    mapped_reads = MappedReadsTable.build_mapped_reads_table(read_hashes, mapping_file)
   return contig_read_count, mapped_reads
 
 
@@ -57,7 +67,7 @@ def normalize_classified_matches(total_reads, classified_tree, output_file):
   level_list = TaxonomyParser.level_list(above_level=1)
   included_taxids = set()
   
-  for taxid,node in classified_tree.items():
+  for taxid,node in TaxonomyParser.get_nodes_with_abundance(classified_tree):
     if (node.taxid not in included_taxids and node.acumulated_abundance > 0 and 
         node.level_enum in level_list and node.parent is not None and
         node.level_enum != node.parent.level_enum):
@@ -82,7 +92,8 @@ def normalize_classified_matches(total_reads, classified_tree, output_file):
 
 #########################################################################################
 #### CALCULATE CONTIG READ COUNT
-def load_read_count(count_reads_file, count_reads_extension, mapping_file, output_file):
+def load_read_count(count_reads_file, count_reads_extension, mapping_file, output_file,
+                    compact_mapped_reads=False):
   """
   Load the read count from either a fastq file or a csv file containing
   the remaining contigs after mapping.
@@ -91,6 +102,7 @@ def load_read_count(count_reads_file, count_reads_extension, mapping_file, outpu
     count_reads_file (str): file containing the contig read count
     count_reads_extension (str): file extension of the count_reads_file
     mapping_file (str): csv file containing the mapping contigs to read names
+    compact_mapped_reads (bool): count the mapped reads in a MappedReadsTable
   
   Returns:
     total_abundance (int): total number of reads
@@ -100,8 +112,10 @@ def load_read_count(count_reads_file, count_reads_extension, mapping_file, outpu
   # include the number of reads contig
   total_abundance, contig_read_count, mapped_reads = 0, {}, {}
   if count_reads_extension.endswith(".fastq.gz"):
-    total_abundance = FastqReadInfo.get_total_abundance(count_reads_file)
-    contig_read_count, mapped_reads = count_contig_reads(mapping_file)
+    # the read count is cached with the outputs, not in the input folder
+    output_dir = os.path.dirname(os.path.abspath(output_file))
+    total_abundance = FastqReadInfo.get_total_abundance(count_reads_file, cache_dir=output_dir)
+    contig_read_count, mapped_reads = count_contig_reads(mapping_file, compact_mapped_reads)
     # double the abundance value to account for each mate from the sequencing
     total_abundance *= 2
   elif "_contig_unmatched_" in count_reads_extension:
@@ -123,7 +137,7 @@ def load_read_count(count_reads_file, count_reads_extension, mapping_file, outpu
 #########################################################################################
 #### GET ALIGNMENT RESULTS
 def load_alignment_tree(classified_tree, contig_read_count, alignment_file,
-  align_filters, output_unmatches_file, output_matches_file):
+  align_filters, output_unmatches_file, output_matches_file, nprocesses=1):
   # clean the alignment result tree
   """
   Load the alignment results for the contigs and the reads mapped to each contig.
@@ -135,6 +149,7 @@ def load_alignment_tree(classified_tree, contig_read_count, alignment_file,
     align_filters (dict): The alignment filters.
     output_unmatches_file (str): The file to write the alignment unmatched contigs.
     output_matches_file (str): The file to write the alignment matches.  
+    nprocesses (int): The number of processes getting the alignment results of the contigs.
   
   The function cleans the alignment result tree, loads the alignment results for the contigs
   and the reads mapped to each contig, and adds the abundance of the best hit for each contig
@@ -145,8 +160,9 @@ def load_alignment_tree(classified_tree, contig_read_count, alignment_file,
   # get alignment results for the contigs and the reads mapped to each contig
   _, contig_species_taxids = AlignmentResultParser.load_alignment_results(
     contig_read_count, alignment_file, align_filters, classified_tree,
-    output_unmatches_file, output_matches_file)
-    
+    output_unmatches_file, output_matches_file, nprocesses)
+  
+  taxid_abundance = defaultdict(int)
   for contig in contig_species_taxids:
     species_best_taxids = contig_species_taxids[contig]
     if contig not in contig_read_count or len(species_best_taxids) == 0: 
@@ -154,7 +170,8 @@ def load_alignment_tree(classified_tree, contig_read_count, alignment_file,
       continue
     read_count = contig_read_count[contig]
     taxid = species_best_taxids[0]
-    classified_tree[taxid].add_abundance(read_count)
+    taxid_abundance[taxid] += read_count
+  TaxonomyParser.add_abundance_by_taxid(classified_tree, taxid_abundance)
 
 
 #########################################################################################
@@ -169,23 +186,13 @@ def include_k2result_for_unmatched(classified_tree, mapped_reads, kout_file):
     mapped_reads (dict): A mapping of read names to the number of times they were mapped.
     kout_file (str): The file containing Kraken 2 results.
   
-  The function reads the Kraken 2 output file and adds the abundance of unmapped reads
-  to the classified tree for each taxid.
+  The function streams the Kraken 2 output file, counts the unmapped reads of each taxid
+  and adds these counts to the classified tree at once.
   """
   print(f"Get accession taxid abundance from: {kout_file}")
-  with open(kout_file, "r") as kraken_file:
-    for line in kraken_file:
-      line = line.strip().split()
-      if len(line) >= 3 and line[0] == "C":
-        read_name = line[1].strip()
-        taxid = line[2].strip()
-        if len(read_name) == 0 or len(taxid) == 0 or taxid not in classified_tree:
-          print(f"Error not included k2result: read_name: {read_name}, taxid: {taxid}")
-          continue
-        # get result if unmapped
-        read_unmapped_count = 2 - mapped_reads.get(read_name, 0)
-        if read_unmapped_count > 0:
-          classified_tree[taxid].add_abundance(read_unmapped_count)
+  _, taxid_abundance = KrakenOutputParser.count_kraken_classified_reads(kout_file,
+    mapped_reads, valid_taxids=classified_tree)
+  TaxonomyParser.add_abundance_by_taxid(classified_tree, taxid_abundance)
 
 
 def load_kraken_tree(classified_tree, kreport_file):
@@ -206,8 +213,10 @@ def load_kraken_tree(classified_tree, kreport_file):
   # create the classified_tree from the kraken report
   _, report_tree = TaxonomyParser.load_tree_from_kraken_report(kreport_file)  
   # set values from the kraken report in the classified_tree
+  taxid_abundance = {}
   for k,node in report_tree.items():
     if k not in classified_tree:
       print(f"Node not found in taxonomy tree: {node}")
     elif node.abundance > 0:
-      classified_tree[k].add_abundance(node.abundance * 2)
\ No newline at end of file
+      taxid_abundance[k] = node.abundance * 2
+  TaxonomyParser.add_abundance_by_taxid(classified_tree, taxid_abundance)
\ No newline at end of file
@@ -0,0 +1,430 @@
+"""
+  Array-backed (struct-of-arrays) taxonomy tree. The topology comes from the
+  taxonomy snapshot columns and the abundances are stored in NumPy arrays, while
+  the tree keeps the dict-like access by taxid used with the TreeNode trees.
+"""
+import os, copy
+import numpy as np
+from . import taxonomy_tree_parser as TaxonomyParser
+from . import taxonomy_snapshot as TaxonomySnapshot
+from .taxonomy_tree_parser import Level
+
+
+LEVEL_BY_VALUE = {level.value: level for level in Level}
+
+
+#########################################################################################
+#### NODE VIEW
+
+class TaxonomyArrayNode:
+  """
+  Lightweight view of one node of a TaxonomyArrayTree, exposing the same
+  attributes and methods of TreeNode.
+  """
+  __slots__ = ("tree", "index")
+  level_name_spaces = 0
+
+  def __init__(self, tree: 'TaxonomyArrayTree', index: int):
+    self.tree = tree
+    self.index = index
+
+  def __hash__(self):
+    return hash(self.index)
+
+  def __eq__(self, other):
+    return (isinstance(other, TaxonomyArrayNode) and
+      self.index == other.index and self.tree is other.tree)
+
+  def __str__(self):
+    parent = self.parent
+    parent_name = parent.name if parent else ''
+    parent_level = parent.level if parent else ''
+    parent_taxid = parent.taxid if parent else ''
+    return (f"{self.taxid},{self.level},{self.level_enum},"
+      f"{str(self.level_name_spaces)},{self.name},"
+      f"{parent_taxid},{parent_level},{parent_name}")
+
+  def __repr__(self):
+    return self.__str__()
+
+  @property
+  def taxid(self):
+    return str(self.tree.taxids[self.index])
+
+  @property
+  def name(self):
+    return self.tree.snapshot.get_name(self.index).strip().replace(",",";")
+
+  @property
+  def level(self):
+    return self.tree.snapshot.get_rank(self.index)
+
+  @property
+  def level_enum(self):
+    return LEVEL_BY_VALUE[int(self.tree.levels[self.index])]
+
+  @property
+  def abundance(self):
+    return int(self.tree.abundance[self.index])
+
+  @property
+  def acumulated_abundance(self):
+    return int(self.tree.acumulated_abundance[self.index])
+
+  @property
+  def tour_start(self):
+    return int(self.tree.tour_starts[self.index])
+
+  @property
+  def tour_end(self):
+    return int(self.tree.tour_ends[self.index])
+
+  @property
+  def parent(self):
+    return self.tree.get_node(int(self.tree.parents[self.index]))
+
+  @property
+  def children(self):
+    return [self.tree.get_node(i) for i in self.tree.get_children(self.index)]
+
+  def get_highest_node_at_level(self, level: Level):
+    return self.tree.get_node(self.tree.get_highest_index_at_level(self.index, level))
+
+  def get_highest_node_at_next_level(self):
+    return self.tree.get_node(self.tree.get_highest_index_at_next_level(self.index))
+
+  def clear_abundance(self):
+    self.tree.abundance[self.index] = 0
+    self.tree.acumulated_abundance[self.index] = 0
+
+  def add_abundance(self, abundance: int):
+    self.tree.add_abundance(self.index, abundance)
+
+  def is_descendant_of(self, node):
+    return self.tree.is_descendant(self.index, node.index)
+
+  def get_all_nodes(self, all_nodes_dict = None):
+    nodes_from = []
+    for index in self.tree.get_subtree(self.index):
+      node = self.tree.get_node(index)
+      nodes_from.append(node)
+      if all_nodes_dict is not None:
+        all_nodes_dict[node.taxid] = node
+    return nodes_from
+
+  def get_nodes_from_level(self, level: Level, higher_rank_dict = None):
+    nodes_from_level = []
+    if self.level_enum == level:
+      nodes_from_level.append(self)
+    for child_node in self.children:
+      nodes = child_node.get_nodes_from_level(level, higher_rank_dict)
+      nodes_from_level.extend(nodes)
+    if higher_rank_dict is not None and self.level_enum < level:
+      higher_rank_dict[self] = nodes_from_level
+    return nodes_from_level
+
+
+#########################################################################################
+#### ARRAY TREE
+
+class TaxonomyArrayTree:
+  """
+  Taxonomy tree stored as arrays indexed by node: parent index, level enum and
+  depth from the snapshot, plus the abundance and acumulated abundance of each node.
+  It behaves as a read-only dict of taxid to TaxonomyArrayNode, so the functions
+  written for the TreeNode dict (tree_by_taxid) also accept this tree.
+  """
+
+  def __init__(self, snapshot: TaxonomySnapshot.TaxonomySnapshot):
+    self.snapshot = snapshot
+    self.taxids = snapshot.taxids
+    self.parents = snapshot.parents
+    self.levels = snapshot.levels
+    self.index_by_taxid = snapshot.index_by_taxid
+    self.depths = snapshot.depths
+    self.level_ancestors = snapshot.level_ancestors
+    self.tour_starts = snapshot.tour_starts
+    self.tour_ends = snapshot.tour_ends
+    self.root_index = snapshot.root_index
+    self.abundance = np.zeros(len(snapshot), dtype=np.int64)
+    self.acumulated_abundance = np.zeros(len(snapshot), dtype=np.int64)
+    self.lineages = {}
+    self.child_offsets, self.child_indexes = None, None
+    self.depth_order, self.depth_bounds = None, None
+    self.tour_indexes, self.lca_index = None, None
+    # index arrays of the nodes with abundance set since the last clear, or None
+    # when too many nodes were touched and a clear must reset the whole arrays
+    self.touched, self.touched_count = [], 0
+
+  ##### dict of taxid to node
+  def get_index(self, taxid):
+    try:
+      taxid = int(taxid)
+    except (TypeError, ValueError):
+      return -1
+    if taxid < 0 or taxid >= len(self.index_by_taxid):
+      return -1
+    return int(self.index_by_taxid[taxid])
+
+  def get_node(self, index: int):
+    return TaxonomyArrayNode(self, index) if index >= 0 else None
+
+  def __contains__(self, taxid):
+    return self.get_index(taxid) >= 0
+
+  def __getitem__(self, taxid):
+    index = self.get_index(taxid)
+    if index < 0:
+      raise KeyError(taxid)
+    return TaxonomyArrayNode(self, index)
+
+  def get(self, taxid, default=None):
+    index = self.get_index(taxid)
+    return TaxonomyArrayNode(self, index) if index >= 0 else default
+
+  def __len__(self):
+    return int(np.count_nonzero(self.index_by_taxid >= 0))
+
+  def keys(self):
+    # nodes in the taxonomy files order followed by the merged taxids
+    for taxid in self.taxids:
+      yield str(taxid)
+    merged_taxids = np.flatnonzero(self.index_by_taxid >= 0)
+    indexes = self.index_by_taxid[merged_taxids]
+    for taxid in merged_taxids[self.taxids[indexes] != merged_taxids]:
+      yield str(taxid)
+
+  def __iter__(self):
+    return self.keys()
+
+  def values(self):
+    for _, node in self.items():
+      yield node
+
+  def items(self):
+    for taxid in self.keys():
+      yield taxid, self[taxid]
+
+  @property
+  def root(self):
+    return TaxonomyArrayNode(self, self.root_index)
+
+  ##### topology
+  def get_lineage(self, index: int):
+    """
+    Return the array of node indexes from the node up to the root,
+    memoized for the nodes already queried.
+    """
+    lineage = self.lineages.get(index)
+    if lineage is None:
+      path = []
+      current = index
+      while current >= 0 and current not in self.lineages:
+        path.append(current)
+        current = int(self.parents[current])
+      lineage = np.array(path, dtype=np.int32)
+      if current >= 0:
+        lineage = np.concatenate((lineage, self.lineages[current]))
+      self.lineages[index] = lineage
+    return lineage
+
+  def get_children(self, index: int):
+    if self.child_offsets is None:
+      has_parent = self.parents >= 0
+      self.child_indexes = np.flatnonzero(has_parent)[
+        np.argsort(self.parents[has_parent], kind="stable")].astype(np.int32)
+      counts = np.bincount(self.parents[has_parent], minlength=len(self.parents))
+      self.child_offsets = np.zeros(len(self.parents) + 1, dtype=np.int64)
+      np.cumsum(counts, out=self.child_offsets[1:])
+    return self.child_indexes[self.child_offsets[index]:self.child_offsets[index+1]].tolist()
+
+  def get_subtree(self, index: int):
+    # depth first pre-order, the same order of TreeNode.get_all_nodes, is the
+    # range of the Euler tour between the node and its last descendant
+    tour_indexes = self.get_tour_indexes()
+    return tour_indexes[self.tour_starts[index]:self.tour_ends[index]].tolist()
+
+  def get_tour_indexes(self):
+    # node index at each position of the Euler tour
+    if self.tour_indexes is None:
+      self.tour_indexes = np.argsort(self.tour_starts).astype(np.int32)
+    return self.tour_indexes
+
+  def is_descendant(self, index: int, ancestor_index: int):
+    return bool(self.tour_starts[ancestor_index] <= self.tour_starts[index] <
+      self.tour_ends[ancestor_index])
+
+  def get_highest_index_at_level(self, index: int, level: Level):
+    if index < 0:
+      return -1
+    return int(self.level_ancestors[index, TaxonomyParser.level_index(level)])
+
+  def get_highest_index_at_next_level(self, index: int):
+    level_ancestors = self.level_ancestors[index]
+    node_level = int(self.levels[index])
+    for next_level in reversed(TaxonomyParser.level_list()):
+      if next_level < node_level:
+        next_index = level_ancestors[TaxonomyParser.level_index(next_level)]
+        if next_index >= 0:
+          return int(next_index)
+    return -1
+
+  def get_nodes_from_level(self, level: Level, index=-1):
+    index = self.root_index if index < 0 else index
+    return [self.get_node(i) for i in self.get_subtree(index) if self.levels[i] == level]
+
+  ##### abundance
+  def add_abundance(self, index: int, abundance: int):
+    lineage = self.get_lineage(index)
+    self.abundance[index] += abundance
+    self.acumulated_abundance[lineage] += abundance
+    self.set_touched(lineage)
+
+  def set_touched(self, indexes):
+    if self.touched is None:
+      return
+    self.touched_count += len(indexes)
+    if self.touched_count > len(self.taxids) // 8:
+      self.touched = None
+    else:
+      self.touched.append(indexes)
+
+  def get_touched_indexes(self):
+    # sorted indexes of the touched nodes, or None if all nodes must be visited
+    if self.touched is None:
+      return None
+    if len(self.touched) == 0:
+      return np.zeros(0, dtype=np.int64)
+    return np.unique(np.concatenate(self.touched))
+
+  def add_abundances(self, indexes, abundances):
+    """
+    Add the abundance of many nodes at once. The direct counts are reduced by
+    node first, then the acumulated abundance of every ancestor is updated with
+    a single bottom-up pass over the nodes ordered by depth, O(reads + nodes).
+    When only a few nodes are touched the lineages are updated directly instead.
+    """
+    indexes = np.asarray(indexes, dtype=np.int64)
+    abundances = np.broadcast_to(np.asarray(abundances, dtype=np.int64), indexes.shape)
+    direct = np.zeros(len(self.taxids), dtype=np.int64)
+    np.add.at(direct, indexes, abundances)
+    touched = np.flatnonzero(direct)
+    self.abundance += direct
+    if len(touched) * int(self.depths.max() + 1) < len(self.taxids):
+      for index in touched.tolist():
+        lineage = self.get_lineage(index)
+        self.acumulated_abundance[lineage] += direct[index]
+        self.set_touched(lineage)
+    else:
+      sums = self.get_subtree_sums(direct)
+      self.acumulated_abundance += sums
+      self.set_touched(np.flatnonzero((sums != 0) | (direct != 0)))
+
+  def add_abundance_by_taxid(self, taxid_abundance: dict):
+    indexes = np.fromiter((self.get_index(taxid) for taxid in taxid_abundance),
+      dtype=np.int64, count=len(taxid_abundance))
+    if np.any(indexes < 0):
+      missing = next(taxid for taxid in taxid_abundance if self.get_index(taxid) < 0)
+      raise KeyError(missing)
+    abundances = np.fromiter(taxid_abundance.values(), dtype=np.int64,
+      count=len(taxid_abundance))
+    self.add_abundances(indexes, abundances)
+
+  def get_subtree_sums(self, values):
+    # add each depth layer into its parents, from the deepest layer up to the root
+    if self.depth_order is None:
+      self.depth_order = np.argsort(self.depths, kind="stable").astype(np.int32)
+      self.depth_bounds = np.searchsorted(self.depths[self.depth_order],
+        np.arange(int(self.depths.max()) + 2))
+    sums = values.copy()
+    for depth in range(len(self.depth_bounds) - 2, 0, -1):
+      indexes = self.depth_order[self.depth_bounds[depth]:self.depth_bounds[depth+1]]
+      np.add.at(sums, self.parents[indexes], sums[indexes])
+    return sums
+
+  def clear_abundance(self):
+    # only the touched nodes are reset, unless there were too many of them
+    touched = self.get_touched_indexes()
+    if touched is None:
+      self.abundance.fill(0)
+      self.acumulated_abundance.fill(0)
+    else:
+      self.abundance[touched] = 0
+      self.acumulated_abundance[touched] = 0
+    self.touched, self.touched_count = [], 0
+
+  def new_overlay(self):
+    """
+    Create a tree sharing this topology (arrays, lineages and caches) with its
+    own zeroed abundance arrays, so each sample gets its abundances without
+    copying or clearing the taxonomy.
+    """
+    overlay = copy.copy(self)
+    overlay.abundance = np.zeros_like(self.abundance)
+    overlay.acumulated_abundance = np.zeros_like(self.acumulated_abundance)
+    overlay.touched, overlay.touched_count = [], 0
+    return overlay
+
+  def get_nodes_with_abundance(self):
+    indexes = self.get_touched_indexes()
+    if indexes is None:
+      indexes = np.flatnonzero(self.acumulated_abundance > 0)
+    else:
+      indexes = indexes[self.acumulated_abundance[indexes] > 0]
+    for index in indexes.tolist():
+      node = TaxonomyArrayNode(self, index)
+      yield node.taxid, node
+
+
+#########################################################################################
+#### LOAD ARRAY TREE
+
+def get_subtree_array_snapshot(snapshot, keep_taxids):
+  if keep_taxids is None:
+    return snapshot
+  is_kept = TaxonomySnapshot.get_subtree_mask(snapshot, keep_taxids)
+  print(f"Keeping {int(is_kept.sum())} taxids from the subtrees of: {keep_taxids}")
+  return TaxonomySnapshot.get_subtree_snapshot(snapshot, is_kept)
+
+
+def load_array_tree_from_taxonomy_files(names_file: str, nodes_file: str, merged_file="",
+                                        keep_taxids=None, nprocesses=1):
+  snapshot = TaxonomySnapshot.parse_taxonomy_columns(names_file, nodes_file, merged_file,
+    nprocesses)
+  tree = TaxonomyArrayTree(get_subtree_array_snapshot(snapshot, keep_taxids))
+  return tree.root, tree
+
+
+def load_array_tree_from_taxonomy_snapshot(snapshot_file: str, keep_taxids=None):
+  print(f"Loading taxonomy array tree from snapshot: {snapshot_file}")
+  snapshot = TaxonomySnapshot.load_taxonomy_snapshot(snapshot_file)
+  tree = TaxonomyArrayTree(get_subtree_array_snapshot(snapshot, keep_taxids))
+  print(f"Length of taxonomy taxid tree: {len(tree.taxids)}")
+  return tree.root, tree
+
+
+def load_taxonomy_array_tree(taxonomy_database: str, keep_taxids=None, nprocesses=1):
+  """
+  Load the taxonomy array tree from the compiled snapshot of the taxonomy database,
+  falling back to parse the taxdump files when there is no valid snapshot.
+
+  Parameters:
+    taxonomy_database (str): directory containing names.dmp, nodes.dmp and merged.dmp
+    keep_taxids (set): if given only the subtrees of these taxids and their lineage
+      to the root are kept in the tree
+    nprocesses (int): number of processes parsing the taxdump files without snapshot
+
+  Returns:
+    root_node (TaxonomyArrayNode): root node of the taxonomy tree
+    tree (TaxonomyArrayTree): taxonomy tree accessed by taxid, including merged taxids
+  """
+  snapshot_file = TaxonomySnapshot.get_valid_snapshot_file(taxonomy_database)
+  if snapshot_file != "":
+    return load_array_tree_from_taxonomy_snapshot(snapshot_file, keep_taxids)
+  names_file = os.path.join(taxonomy_database, "names.dmp")
+  nodes_file = os.path.join(taxonomy_database, "nodes.dmp")
+  merged_file = os.path.join(taxonomy_database, "merged.dmp")
+  if not os.path.exists(merged_file):
+    merged_file = ""
+  return load_array_tree_from_taxonomy_files(names_file, nodes_file, merged_file, keep_taxids,
+    nprocesses)
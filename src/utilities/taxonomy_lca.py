@@ -0,0 +1,135 @@
+"""
+  Lowest common ancestor (LCA) queries over the Euler tour of a taxonomy tree,
+  answered in constant time with a sparse table of range minimum depths. The
+  queries are batched over arrays of taxid pairs, for both the TreeNode trees
+  (TaxonomyTree) and the array trees (TaxonomyArrayTree).
+"""
+import numpy as np
+from . import taxonomy_snapshot as TaxonomySnapshot
+
+
+class TaxonomyLCAIndex:
+  """
+  Sparse table over the nodes in Euler tour (pre-order) positions. For two nodes
+  at positions p < q, the shallowest node in the positions (p, q] is a child of
+  their LCA, so the LCA is its parent. The table takes about n * log2(n) int32,
+  it is built once by tree and shared with the trees copied from it.
+  """
+  def __init__(self, tour_parents, tour_depths):
+    # parent position (-1 for the roots) and depth of the node at each position
+    self.tour_parents = np.asarray(tour_parents, dtype=np.int32)
+    self.tour_depths = np.asarray(tour_depths, dtype=np.int32)
+    # table[k][i] is the position of the shallowest node in [i, i + 2^k)
+    size = len(self.tour_parents)
+    self.table = [np.arange(size, dtype=np.int32)]
+    while (1 << len(self.table)) <= size:
+      half = 1 << (len(self.table) - 1)
+      previous = self.table[-1]
+      left, right = previous[:size - 2 * half + 1], previous[half:size - half + 1]
+      self.table.append(np.where(self.tour_depths[left] <= self.tour_depths[right], left, right))
+
+  def __len__(self):
+    return len(self.tour_parents)
+
+  def get_lca_positions(self, positions1, positions2):
+    """
+    Get the LCA of many pairs of nodes at once.
+    Parameters:
+      positions1 (array): Euler tour position of the first node of each pair, -1 if absent
+      positions2 (array): Euler tour position of the second node of each pair, -1 if absent
+    Returns:
+      np.ndarray: Euler tour position of the LCA of each pair, -1 if a node is absent
+        or the nodes are in different trees
+    """
+    positions1 = np.asarray(positions1, dtype=np.int64)
+    positions2 = np.asarray(positions2, dtype=np.int64)
+    first, last = np.minimum(positions1, positions2), np.maximum(positions1, positions2)
+    lca_positions = np.where(first >= 0, first, -1)
+    pairs = np.flatnonzero((first >= 0) & (first < last))
+    starts, ends = first[pairs] + 1, last[pairs]
+    # largest power of two not longer than each range, frexp is exact for integers
+    powers = np.frexp((ends - starts + 1).astype(np.float64))[1] - 1
+    for power in np.unique(powers).tolist():
+      selected = np.flatnonzero(powers == power)
+      left = self.table[power][starts[selected]]
+      right = self.table[power][ends[selected] - (1 << power) + 1]
+      shallowest = np.where(self.tour_depths[left] <= self.tour_depths[right], left, right)
+      lca_positions[pairs[selected]] = self.tour_parents[shallowest]
+    return lca_positions
+
+
+#########################################################################################
+#### INDEX OF A TREE
+
+def build_lca_index(tree_by_taxid):
+  # TreeNode trees keep the nodes in tour order, array trees the node indexes
+  tour_nodes = getattr(tree_by_taxid, "tour_nodes", None)
+  if tour_nodes is not None:
+    tour_parents = np.fromiter((node.parent.tour_start if node.parent is not None else -1
+      for node in tour_nodes), dtype=np.int32, count=len(tour_nodes))
+    tour_depths = TaxonomySnapshot.get_node_depths(tour_parents)
+    return TaxonomyLCAIndex(tour_parents, tour_depths)
+  if hasattr(tree_by_taxid, "get_tour_indexes"):
+    tour_indexes = tree_by_taxid.get_tour_indexes()
+    parents = tree_by_taxid.parents[tour_indexes]
+    tour_parents = np.where(parents >= 0, tree_by_taxid.tour_starts[np.maximum(parents, 0)], -1)
+    return TaxonomyLCAIndex(tour_parents, tree_by_taxid.depths[tour_indexes])
+  return None
+
+
+def get_lca_index(tree_by_taxid):
+  """
+  Get the LCA index of a tree, built on the first call.
+  Returns:
+    TaxonomyLCAIndex: index of the tree, None if the tree has no Euler tour
+  """
+  lca_index = getattr(tree_by_taxid, "lca_index", None)
+  if lca_index is None:
+    lca_index = build_lca_index(tree_by_taxid)
+    if lca_index is not None:
+      tree_by_taxid.lca_index = lca_index
+  return lca_index
+
+
+def get_tour_position(tree_by_taxid, taxid):
+  node = tree_by_taxid.get(taxid, None)
+  return node.tour_start if node is not None else -1
+
+
+def get_tour_node(tree_by_taxid, position: int):
+  if position < 0:
+    return None
+  tour_nodes = getattr(tree_by_taxid, "tour_nodes", None)
+  if tour_nodes is not None:
+    return tour_nodes[position]
+  return tree_by_taxid.get_node(int(tree_by_taxid.get_tour_indexes()[position]))
+
+
+def get_lca_nodes(tree_by_taxid, taxids1, taxids2):
+  """
+  Get the LCA node of each pair of taxids of a tree with Euler tour.
+  Parameters:
+    tree_by_taxid (dict): TaxonomyTree or TaxonomyArrayTree
+    taxids1 (list): first taxid of each pair
+    taxids2 (list): second taxid of each pair
+  Returns:
+    list: LCA node of each pair, None if a taxid is absent or they have no common ancestor
+  """
+  lca_index = get_lca_index(tree_by_taxid)
+  positions1 = [get_tour_position(tree_by_taxid, taxid) for taxid in taxids1]
+  positions2 = [get_tour_position(tree_by_taxid, taxid) for taxid in taxids2]
+  lca_positions = lca_index.get_lca_positions(positions1, positions2)
+  return [get_tour_node(tree_by_taxid, position) for position in lca_positions.tolist()]
+
+
+def get_lca_taxids(tree_by_taxid, taxids1, taxids2):
+  """
+  Get the LCA taxid and rank of each pair of taxids of a tree with Euler tour.
+  Returns:
+    lca_taxids (list): taxid of the LCA of each pair, None if there is no LCA
+    lca_levels (list): Level of the LCA of each pair, None if there is no LCA
+  """
+  lca_nodes = get_lca_nodes(tree_by_taxid, taxids1, taxids2)
+  lca_taxids = [node.taxid if node is not None else None for node in lca_nodes]
+  lca_levels = [node.level_enum if node is not None else None for node in lca_nodes]
+  return lca_taxids, lca_levels
@@ -0,0 +1,457 @@
+"""
+  Compile the NCBI taxdump files (names.dmp, nodes.dmp, merged.dmp) into a single
+  binary snapshot with array-backed columns, loaded through mmap so parallel
+  processes share the same read-only pages.
+"""
+import os, json, mmap
+import numpy as np
+from . import taxonomy_tree_parser as TaxonomyParser
+from .taxonomy_tree_parser import Level
+
+
+SNAPSHOT_FILENAME = "taxonomy.snapshot"
+# taxdump files of the snapshot sources, merged.dmp is optional
+SOURCE_FILENAMES = ["names.dmp", "nodes.dmp", "merged.dmp"]
+SNAPSHOT_MAGIC = b"AESOPTAX"
+SNAPSHOT_VERSION = 3
+SNAPSHOT_ALIGNMENT = 64
+
+
+#########################################################################################
+#### TAXONOMY SNAPSHOT COLUMNS
+
+class TaxonomySnapshot:
+  """
+  Column storage of the complete taxonomy, one row per node.
+
+  Attributes:
+    taxids (int32): taxid of each node
+    parents (int32): index of the parent node, -1 for the root
+    levels (int8): Level enum value of each node
+    ranks (uint8): index of the original rank name in rank_names
+    name_offsets (int64): start of each scientific name in names, length n+1
+    names (uint8): utf-8 encoded scientific names concatenated
+    index_by_taxid (int32): node index by taxid (merged taxids included), -1 if absent
+    depths (int32): distance of each node to the root
+    level_ancestors (int32): highest ancestor index at each level, shape n x len(Level),
+      with the column given by TaxonomyParser.level_index(level), -1 if absent
+    tour_starts (int32): position of each node in the depth first pre-order (Euler tour)
+    tour_ends (int32): position after the last node of the subtree of each node
+    rank_names (list): original rank names from nodes.dmp
+    sources (dict): size and mtime of the files used to build the snapshot
+  """
+  columns = ["taxids", "parents", "levels", "ranks", "name_offsets", "names",
+    "index_by_taxid", "depths", "level_ancestors", "tour_starts", "tour_ends"]
+
+  def __init__(self, rank_names, sources, **columns):
+    self.rank_names = rank_names
+    self.sources = sources
+    for column in TaxonomySnapshot.columns:
+      setattr(self, column, columns[column])
+
+  def __len__(self):
+    return len(self.taxids)
+
+  def get_index(self, taxid):
+    taxid = int(taxid)
+    if taxid < 0 or taxid >= len(self.index_by_taxid):
+      return -1
+    return int(self.index_by_taxid[taxid])
+
+  def get_name(self, index: int):
+    start, end = self.name_offsets[index], self.name_offsets[index+1]
+    return bytes(self.names[start:end]).decode("utf-8")
+
+  def get_rank(self, index: int):
+    return self.rank_names[self.ranks[index]]
+
+  @property
+  def root_index(self):
+    return int(np.flatnonzero(self.parents < 0)[0])
+
+
+def get_node_depths(parents):
+  # pointer jumping: each pass doubles the distance to the known ancestor
+  ancestors = parents.astype(np.int32)
+  depths = (ancestors >= 0).astype(np.int32)
+  has_ancestor = np.flatnonzero(ancestors >= 0)
+  while len(has_ancestor) > 0:
+    next_ancestors = ancestors[has_ancestor]
+    depths[has_ancestor] += depths[next_ancestors]
+    ancestors[has_ancestor] = ancestors[next_ancestors]
+    has_ancestor = has_ancestor[ancestors[has_ancestor] >= 0]
+  return depths
+
+
+def get_level_ancestors(parents, levels, depths):
+  """
+  Build the table of the highest ancestor (closest to the root) at each level
+  for every node, including the node itself. The table is filled one depth at a
+  time, each node copies the row of its parent and sets its own level if unset.
+  """
+  level_ancestors = np.full((len(parents), len(Level)), -1, dtype=np.int32)
+  order = np.argsort(depths, kind="stable")
+  bounds = np.searchsorted(depths[order], np.arange(int(depths.max()) + 2))
+  for depth in range(len(bounds) - 1):
+    indexes = order[bounds[depth]:bounds[depth+1]]
+    if depth > 0:
+      level_ancestors[indexes] = level_ancestors[parents[indexes]]
+    columns = TaxonomyParser.level_index(levels[indexes])
+    unset = level_ancestors[indexes, columns] < 0
+    level_ancestors[indexes[unset], columns[unset]] = indexes[unset]
+  return level_ancestors
+
+
+def get_euler_tour(parents, depths):
+  """
+  Number the nodes in depth first pre-order, visiting the children in index order,
+  so the subtree of a node is the range [tour_start, tour_end) of the tour. The
+  subtree sizes are summed from the leaves up and the positions set from the root
+  down, one depth at a time.
+  """
+  order = np.argsort(depths, kind="stable")
+  bounds = np.searchsorted(depths[order], np.arange(int(depths.max()) + 2))
+  sizes = np.ones(len(parents), dtype=np.int64)
+  for depth in range(len(bounds) - 2, 0, -1):
+    indexes = order[bounds[depth]:bounds[depth+1]]
+    np.add.at(sizes, parents[indexes], sizes[indexes])
+  tour_starts = np.zeros(len(parents), dtype=np.int64)
+  roots = order[bounds[0]:bounds[1]]
+  tour_starts[roots] = np.cumsum(sizes[roots]) - sizes[roots]
+  for depth in range(1, len(bounds) - 1):
+    indexes = order[bounds[depth]:bounds[depth+1]]
+    # siblings sorted by parent, each one starts after the subtrees of the previous ones
+    indexes = indexes[np.argsort(parents[indexes], kind="stable")]
+    node_parents, node_sizes = parents[indexes], sizes[indexes]
+    previous_sizes = np.cumsum(node_sizes) - node_sizes
+    is_first = np.ones(len(indexes), dtype=bool)
+    is_first[1:] = node_parents[1:] != node_parents[:-1]
+    first_sizes = np.maximum.accumulate(np.where(is_first, previous_sizes, 0))
+    tour_starts[indexes] = tour_starts[node_parents] + 1 + previous_sizes - first_sizes
+  tour_ends = tour_starts + sizes
+  return tour_starts.astype(np.int32), tour_ends.astype(np.int32)
+
+
+def get_file_source(file: str):
+  # size and mtime of a source file, None if it doesn't exist
+  if file == "" or not os.path.exists(file):
+    return None
+  stat = os.stat(file)
+  return [stat.st_size, stat.st_mtime_ns]
+
+
+def get_taxonomy_sources(names_file: str, nodes_file: str, merged_file=""):
+  # absent files are recorded as None, so adding them later outdates the snapshot
+  sources = {filename: None for filename in SOURCE_FILENAMES}
+  for file in (names_file, nodes_file, merged_file):
+    if file != "":
+      sources[os.path.basename(file)] = get_file_source(file)
+  return sources
+
+
+#########################################################################################
+#### PARSE TAXONOMY FILES INTO COLUMNS
+
+def parse_taxonomy_columns(names_file: str, nodes_file: str, merged_file="", nprocesses=1):
+  # names.dmp and nodes.dmp are parsed in chunks by a pool of processes
+  taxid_names, nodes = TaxonomyParser.parse_taxonomy_files(names_file, nodes_file, nprocesses)
+  print(f"Length of names by taxid tree: {len(taxid_names)}")
+
+  taxids, parent_taxids, ranks = [], [], []
+  rank_codes, rank_names = {}, []
+  included_taxids = set()
+  for node in nodes:
+    if node[0] is None:
+      print(f"Invalid line: {node[1]}")
+      continue
+    taxid = int(node[0])
+    if taxid in included_taxids:
+      print(f"Duplicate taxid: new='{node}'")
+      continue
+    rank = node[2]
+    if rank not in rank_codes:
+      rank_codes[rank] = len(rank_names)
+      rank_names.append(rank)
+    included_taxids.add(taxid)
+    taxids.append(taxid)
+    parent_taxids.append(int(node[1]))
+    ranks.append(rank_codes[rank])
+
+  taxids = np.array(taxids, dtype=np.int32)
+  parent_taxids = np.array(parent_taxids, dtype=np.int32)
+  index_by_taxid = np.full(int(taxids.max()) + 1, -1, dtype=np.int32)
+  index_by_taxid[taxids] = np.arange(len(taxids), dtype=np.int32)
+  # set parent index, the root points to itself in nodes.dmp
+  parents = index_by_taxid[parent_taxids]
+  if (parents < 0).any():
+    missing = parent_taxids[parents < 0]
+    raise ValueError(f"Parent taxids not found in taxonomy: {missing[:10]}")
+  parents[parent_taxids == taxids] = -1
+  # set level enum of each rank name
+  rank_levels = np.array([TaxonomyParser.parse_level(r) for r in rank_names], dtype=np.int8)
+  ranks = np.array(ranks, dtype=np.uint8)
+  levels = rank_levels[ranks]
+  # concatenate the scientific names
+  encoded_names = [taxid_names[str(taxid)].encode("utf-8") for taxid in taxids.tolist()]
+  name_offsets = np.zeros(len(taxids) + 1, dtype=np.int64)
+  np.cumsum([len(name) for name in encoded_names], out=name_offsets[1:])
+  names = np.frombuffer(b"".join(encoded_names), dtype=np.uint8)
+  print(f"Length of taxonomy taxid tree: {len(taxids)}")
+
+  # include merged taxids
+  if merged_file != "":
+    print(f"Loading merged taxids from file: {merged_file}")
+    with open(merged_file, "rb") as f:
+      for line in f:
+        row = line.split(b"|")
+        old_taxid, new_taxid = int(row[0]), int(row[1])
+        if old_taxid >= len(index_by_taxid):
+          extension = np.full(old_taxid + 1 - len(index_by_taxid), -1, dtype=np.int32)
+          index_by_taxid = np.concatenate((index_by_taxid, extension))
+        if (index_by_taxid[old_taxid] < 0 and new_taxid < len(index_by_taxid) and
+            index_by_taxid[new_taxid] >= 0):
+          index_by_taxid[old_taxid] = index_by_taxid[new_taxid]
+        else:
+          print(f"Invalid merged taxid: old='{old_taxid}' new='{new_taxid}'")
+
+  # precompute the depth and the highest ancestor at each level of every node
+  depths = get_node_depths(parents)
+  level_ancestors = get_level_ancestors(parents, levels, depths)
+  tour_starts, tour_ends = get_euler_tour(parents, depths)
+
+  sources = get_taxonomy_sources(names_file, nodes_file, merged_file)
+  return TaxonomySnapshot(rank_names, sources, taxids=taxids, parents=parents,
+    levels=levels, ranks=ranks, name_offsets=name_offsets, names=names,
+    index_by_taxid=index_by_taxid, depths=depths, level_ancestors=level_ancestors,
+    tour_starts=tour_starts, tour_ends=tour_ends)
+
+
+#########################################################################################
+#### WRITE AND LOAD SNAPSHOT FILE
+
+def align_offset(offset: int):
+  return (offset + SNAPSHOT_ALIGNMENT - 1) // SNAPSHOT_ALIGNMENT * SNAPSHOT_ALIGNMENT
+
+
+def save_taxonomy_snapshot(snapshot: TaxonomySnapshot, snapshot_file: str):
+  """
+  Write the snapshot columns to a binary file. The file starts with a magic string,
+  the length of the json header and the header itself, followed by the raw column
+  arrays aligned to 64 bytes.
+  """
+  arrays, offset = {}, 0
+  for column in TaxonomySnapshot.columns:
+    array = np.ascontiguousarray(getattr(snapshot, column))
+    arrays[column] = {"dtype": array.dtype.str, "shape": array.shape, "offset": offset}
+    offset = align_offset(offset + array.nbytes)
+  header = json.dumps({"version": SNAPSHOT_VERSION, "rank_names": snapshot.rank_names,
+    "sources": snapshot.sources, "arrays": arrays}).encode("utf-8")
+  data_start = align_offset(len(SNAPSHOT_MAGIC) + 8 + len(header))
+
+  # write to a temporary file so readers never see a partial snapshot
+  tmp_file = f"{snapshot_file}.{os.getpid()}.tmp"
+  with open(tmp_file, "wb") as f:
+    f.write(SNAPSHOT_MAGIC)
+    f.write(len(header).to_bytes(8, "little"))
+    f.write(header)
+    for column in TaxonomySnapshot.columns:
+      f.seek(data_start + arrays[column]["offset"])
+      f.write(np.ascontiguousarray(getattr(snapshot, column)).tobytes())
+  os.replace(tmp_file, snapshot_file)
+  print(f"Taxonomy snapshot written: {snapshot_file} ({os.path.getsize(snapshot_file)} bytes)")
+
+
+def load_snapshot_header(snapshot_file: str):
+  """
+  Read the json header of a snapshot file, without mapping its columns.
+  Returns:
+    header (dict): version, rank names, sources and arrays of the snapshot
+    data_start (int): offset of the first column in the file
+  """
+  header_start = len(SNAPSHOT_MAGIC) + 8
+  with open(snapshot_file, "rb") as f:
+    if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+      raise ValueError(f"Invalid taxonomy snapshot file: {snapshot_file}")
+    header_length = int.from_bytes(f.read(8), "little")
+    header = json.loads(f.read(header_length))
+  if header["version"] != SNAPSHOT_VERSION:
+    raise ValueError(f"Taxonomy snapshot version {header['version']} is not supported, "
+      f"expected {SNAPSHOT_VERSION}: {snapshot_file}")
+  return header, align_offset(header_start + header_length)
+
+
+def load_taxonomy_snapshot(snapshot_file: str):
+  header, data_start = load_snapshot_header(snapshot_file)
+  with open(snapshot_file, "rb") as f:
+    buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+  columns = {}
+  for column, info in header["arrays"].items():
+    shape = tuple(info["shape"])
+    columns[column] = np.frombuffer(buffer, dtype=np.dtype(info["dtype"]),
+      count=int(np.prod(shape)), offset=data_start + info["offset"]).reshape(shape)
+  return TaxonomySnapshot(header["rank_names"], header["sources"], **columns)
+
+
+def compile_taxonomy_snapshot(taxonomy_database: str, snapshot_file="", nprocesses=1):
+  names_file = os.path.join(taxonomy_database, "names.dmp")
+  nodes_file = os.path.join(taxonomy_database, "nodes.dmp")
+  merged_file = os.path.join(taxonomy_database, "merged.dmp")
+  if not os.path.exists(merged_file):
+    merged_file = ""
+  if snapshot_file == "":
+    snapshot_file = os.path.join(taxonomy_database, SNAPSHOT_FILENAME)
+  snapshot = parse_taxonomy_columns(names_file, nodes_file, merged_file, nprocesses)
+  save_taxonomy_snapshot(snapshot, snapshot_file)
+  return snapshot_file
+
+
+def get_valid_snapshot_file(taxonomy_database: str):
+  """
+  Return the snapshot file of the taxonomy database if it exists and was compiled
+  from the current taxdump files, otherwise return an empty string. Only the header
+  of the snapshot is read, the columns are mapped by the caller.
+  """
+  snapshot_file = os.path.join(taxonomy_database, SNAPSHOT_FILENAME)
+  if not os.path.exists(snapshot_file):
+    return ""
+  try:
+    header, _ = load_snapshot_header(snapshot_file)
+  except (ValueError, KeyError) as e:
+    print(f"Ignoring taxonomy snapshot: {e}")
+    return ""
+  # files added, removed or changed since the snapshot was compiled outdate it
+  sources = header["sources"]
+  for filename in sorted(set(SOURCE_FILENAMES) | set(sources)):
+    file = os.path.join(taxonomy_database, filename)
+    if sources.get(filename) != get_file_source(file):
+      print(f"Taxonomy snapshot is outdated for file: {file}")
+      return ""
+  return snapshot_file
+
+
+#########################################################################################
+#### LOAD TAXONOMY TREE
+
+def get_subtree_mask(snapshot: TaxonomySnapshot, keep_taxids):
+  """
+  Select the nodes in the subtrees of the given taxids plus their lineage to the root.
+  Returns:
+    np.ndarray: bool mask by node index of the kept nodes
+  """
+  is_kept = np.zeros(len(snapshot), dtype=bool)
+  keep_indexes = []
+  for taxid in keep_taxids:
+    index = snapshot.get_index(taxid)
+    if index < 0:
+      print(f"Taxid to keep not found in taxonomy: {taxid}")
+      continue
+    keep_indexes.append(index)
+  is_kept[keep_indexes] = True
+  # descendants, one depth at a time from the root down
+  order = np.argsort(snapshot.depths, kind="stable")
+  bounds = np.searchsorted(snapshot.depths[order], np.arange(int(snapshot.depths.max()) + 2))
+  for depth in range(1, len(bounds) - 1):
+    indexes = order[bounds[depth]:bounds[depth+1]]
+    is_kept[indexes] |= is_kept[snapshot.parents[indexes]]
+  # lineage of the subtree roots
+  for index in keep_indexes:
+    while index >= 0:
+      is_kept[index] = True
+      index = int(snapshot.parents[index])
+  return is_kept
+
+
+def get_subtree_snapshot(snapshot: TaxonomySnapshot, is_kept):
+  """
+  Build the snapshot with only the kept nodes, which must include their lineage to
+  the root, renumbering the node indexes in the columns. The merged taxids of the
+  kept nodes are preserved.
+  Parameters:
+    snapshot (TaxonomySnapshot): complete taxonomy snapshot
+    is_kept (np.ndarray): bool mask by node index of the kept nodes
+  Returns:
+    TaxonomySnapshot: snapshot of the kept nodes in memory
+  """
+  kept = np.flatnonzero(is_kept)
+  new_indexes = np.full(len(snapshot) + 1, -1, dtype=np.int32)
+  new_indexes[kept] = np.arange(len(kept), dtype=np.int32)
+  # -1 (absent) indexes map to the last entry, which stays -1
+  parents = new_indexes[snapshot.parents[kept]]
+  level_ancestors = new_indexes[snapshot.level_ancestors[kept]]
+  index_by_taxid = new_indexes[snapshot.index_by_taxid]
+  # gather the bytes of the kept names
+  starts = snapshot.name_offsets[kept]
+  lengths = snapshot.name_offsets[kept + 1] - starts
+  name_offsets = np.zeros(len(kept) + 1, dtype=np.int64)
+  np.cumsum(lengths, out=name_offsets[1:])
+  names = snapshot.names[np.repeat(starts - name_offsets[:-1], lengths) +
+    np.arange(name_offsets[-1], dtype=np.int64)]
+  # the lineages are kept, so the depths don't change
+  depths = snapshot.depths[kept]
+  tour_starts, tour_ends = get_euler_tour(parents, depths)
+  return TaxonomySnapshot(snapshot.rank_names, snapshot.sources,
+    taxids=snapshot.taxids[kept], parents=parents, levels=snapshot.levels[kept],
+    ranks=snapshot.ranks[kept], name_offsets=name_offsets, names=names,
+    index_by_taxid=index_by_taxid, depths=depths, level_ancestors=level_ancestors,
+    tour_starts=tour_starts, tour_ends=tour_ends)
+
+
+def load_tree_from_taxonomy_snapshot(snapshot_file: str, keep_taxids=None):
+  snapshot = load_taxonomy_snapshot(snapshot_file)
+  print(f"Loading taxonomy tree from snapshot: {snapshot_file}")
+  is_kept = None
+  if keep_taxids is not None:
+    is_kept = get_subtree_mask(snapshot, keep_taxids)
+    print(f"Keeping {int(is_kept.sum())} taxids from the subtrees of: {keep_taxids}")
+
+  nodes = [None] * len(snapshot)
+  tree_by_taxid = TaxonomyParser.TaxonomyTree()
+  indexes = range(len(snapshot)) if is_kept is None else np.flatnonzero(is_kept).tolist()
+  for index in indexes:
+    taxid = str(snapshot.taxids[index])
+    node = TaxonomyParser.TreeNode(snapshot.get_name(index), taxid, snapshot.get_rank(index))
+    tree_by_taxid[taxid] = node
+    nodes[index] = node
+  for index in indexes:
+    parent = int(snapshot.parents[index])
+    if parent >= 0:
+      nodes[index].set_parent_node(nodes[parent])
+  TaxonomyParser.set_euler_tour(tree_by_taxid)
+  print(f"Length of taxonomy taxid tree: {len(tree_by_taxid)}")
+
+  # include merged taxids
+  merged_taxids = np.flatnonzero(snapshot.index_by_taxid >= 0)
+  indexes = snapshot.index_by_taxid[merged_taxids]
+  is_merged = snapshot.taxids[indexes] != merged_taxids
+  if is_kept is not None:
+    is_merged &= is_kept[indexes]
+  for taxid, index in zip(merged_taxids[is_merged].tolist(), indexes[is_merged].tolist()):
+    tree_by_taxid[str(taxid)] = nodes[index]
+
+  return nodes[snapshot.root_index], tree_by_taxid
+
+
+def load_taxonomy_tree(taxonomy_database: str, keep_taxids=None, nprocesses=1):
+  """
+  Load the taxonomy tree from the compiled snapshot of the taxonomy database,
+  falling back to parse the taxdump files when there is no valid snapshot.
+
+  Parameters:
+    taxonomy_database (str): directory containing names.dmp, nodes.dmp and merged.dmp
+    keep_taxids (set): if given only the subtrees of these taxids and their lineage
+      to the root are loaded
+    nprocesses (int): number of processes parsing the taxdump files without snapshot
+
+  Returns:
+    root_node (TreeNode): root node of the taxonomy tree
+    tree_by_taxid (dict): mapping of taxid to TreeNode, including merged taxids
+  """
+  snapshot_file = get_valid_snapshot_file(taxonomy_database)
+  if snapshot_file != "":
+    return load_tree_from_taxonomy_snapshot(snapshot_file, keep_taxids)
+  names_file = os.path.join(taxonomy_database, "names.dmp")
+  nodes_file = os.path.join(taxonomy_database, "nodes.dmp")
+  merged_file = os.path.join(taxonomy_database, "merged.dmp")
+  return TaxonomyParser.load_tree_from_taxonomy_files(names_file, nodes_file, merged_file,
+    keep_taxids, nprocesses)
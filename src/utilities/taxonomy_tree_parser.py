@@ -5,8 +5,9 @@ Created: 2023/08/21
 
   Utility class used to load the taxonomic tree from a kraken report file.
 """
-import csv, time
+import os, csv, time, multiprocessing
 from enum import IntEnum
+from functools import lru_cache
 from typing import List
 from dataclasses import dataclass
 
@@ -32,6 +33,22 @@ class Level(IntEnum):
 def level_list(above_level=0):
   return [i for i in list(Level) if i.value > above_level]
 
+def level_index(level):
+  # position of the level in tables with one entry per Level, Level.U first
+  return level - Level.U
+
+@lru_cache(maxsize=None)
+def parse_level(level: str):
+  # few distinct ranks, the parsed levels are cached
+  level = level.strip().upper()
+  if level not in valid_levels:
+    level = "NO RANK"
+  elif level == "SUPERKINGDOM":
+    level = "DOMAIN"
+  elif level == "ACELLULAR ROOT":
+    level = "DOMAIN"
+  return Level[level[0]] if level[0] in Level.__members__ else None
+
 @dataclass
 class TreeNode:
   name: str
@@ -43,6 +60,11 @@ class TreeNode:
   acumulated_abundance: int = 0
   children: List['TreeNode'] = None
   parent: 'TreeNode' = None
+  # list of nodes with abundance added since the last clear, set only on root nodes
+  touched_nodes = None
+  # position of the node in the Euler tour of the tree and after its last descendant
+  tour_start = None
+  tour_end = None
   
   def __init__(self, name: str, taxid: str, level: str, abundance = 0, acumulated_abundance = 0):
     self.name = name.strip().replace(",",";")
@@ -51,6 +73,7 @@ class TreeNode:
     self.abundance = abundance
     self.acumulated_abundance = acumulated_abundance
     self.children = []
+    self.level_nodes = None
     # count spaces at the begining of name
     count_spaces = 0
     for char in name:
@@ -59,13 +82,7 @@ class TreeNode:
       else:
         break
     self.level_name_spaces = count_spaces    
-    if self.level not in valid_levels:
-      self.level = "NO RANK"
-    elif self.level == "SUPERKINGDOM":
-      self.level = "DOMAIN"
-    elif self.level == "ACELLULAR ROOT":
-      self.level = "DOMAIN"
-    self.level_enum = Level[self.level[0]] if self.level[0] in Level.__members__ else None
+    self.level_enum = parse_level(self.level)
     self.level = level.strip()
   
   def __hash__(self):
@@ -86,6 +103,7 @@ class TreeNode:
     # set children and parent attributes
     parent_node.children.append(self)
     self.parent = parent_node
+    self.level_nodes = None
   
   def set_parent(self, last_node:'TreeNode'):
     # initialize parent node
@@ -100,22 +118,34 @@ class TreeNode:
       node = node.parent
     return False
   
+  def get_level_nodes(self):
+    # highest node at each level in the lineage of this node (itself included),
+    # memoized on the first query and shared with descendants with the same levels
+    if self.level_nodes is None:
+      lineage, current_node = [], self
+      while current_node is not None and current_node.level_nodes is None:
+        lineage.append(current_node)
+        current_node = current_node.parent
+      level_nodes = (current_node.level_nodes if current_node is not None
+        else (None,) * len(Level))
+      for node in reversed(lineage):
+        if node.level_enum is not None and level_nodes[level_index(node.level_enum)] is None:
+          position = level_index(node.level_enum)
+          level_nodes = level_nodes[:position] + (node,) + level_nodes[position+1:]
+        node.level_nodes = level_nodes
+    return self.level_nodes
+  
   def get_highest_node_at_level(self, level: Level):
-    node_in_level, current_node = None, self
-    while current_node is not None:
-      if current_node.level_enum == level:
-        node_in_level = current_node
-      current_node = current_node.parent
-    return node_in_level
+    return self.get_level_nodes()[level_index(level)]
   
   def get_highest_node_at_next_level(self):
-    next_node = None
+    level_nodes = self.get_level_nodes()
     for next_level in reversed(level_list()):
       if next_level < self.level_enum:
-        next_node = self.get_highest_node_at_level(next_level)
+        next_node = level_nodes[level_index(next_level)]
         if next_node is not None:
-          break
-    return next_node
+          return next_node
+    return None
   
   def clear_abundance(self):
     self.abundance = 0
@@ -124,10 +154,16 @@ class TreeNode:
   def add_abundance(self, abundance: int):
     self.abundance += abundance
     self.acumulated_abundance += abundance
-    parent_node = self.parent
-    while parent_node is not None:
-      parent_node.acumulated_abundance += abundance
-      parent_node = parent_node.parent
+    node = self
+    while node.parent is not None:
+      node = node.parent
+      node.acumulated_abundance += abundance
+    # the root keeps the touched nodes to clear only their lineages
+    if node.touched_nodes is not None:
+      node.touched_nodes.append(self)
+  
+  def is_descendant_of(self, node:'TreeNode'):
+    return is_descendant(self, node)
   
   def get_all_nodes(self, all_nodes_dict = None):
     nodes_from = []
@@ -159,10 +195,109 @@ def get_hierarchy_nodes(node: TreeNode):
   return all_parents
 
 
+def is_descendant(node, ancestor_node):
+  # the node is in the subtree of the ancestor node (itself included) when its
+  # position is inside the Euler tour interval of the ancestor
+  return ancestor_node.tour_start <= node.tour_start < ancestor_node.tour_end
+
+
+class TaxonomyTree(dict):
+  """
+  Dict of taxid to TreeNode that remembers its root nodes after the first clear.
+  From then on the roots collect the nodes touched by add_abundance, so the
+  next clears only reset the lineages of those nodes instead of every node.
+  """
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.root_nodes = None
+    # nodes in the Euler tour order, set by set_euler_tour
+    self.tour_nodes = None
+    # TaxonomyLCAIndex over the Euler tour, built on the first LCA query
+    self.lca_index = None
+
+  def get_subtree_nodes(self, taxid):
+    # the node and all its descendants, in the order of TreeNode.get_all_nodes
+    node = self[taxid]
+    return self.tour_nodes[node.tour_start:node.tour_end]
+
+
+def set_euler_tour(tree_by_taxid: dict):
+  """
+  Number the nodes of the tree in depth first pre-order, setting on each node its
+  position (tour_start) and the position after its last descendant (tour_end), so
+  ancestor and descendant tests are a comparison of the intervals.
+  Parameters:
+    tree_by_taxid (dict): mapping of taxid to TreeNode, merged taxids are skipped
+  Returns:
+    list: nodes in the Euler tour order
+  """
+  root_nodes = {}
+  for node in tree_by_taxid.values():
+    if node.parent is None:
+      root_nodes[id(node)] = node
+  tour_nodes = []
+  for root_node in root_nodes.values():
+    pending_nodes = [root_node]
+    while pending_nodes:
+      node = pending_nodes.pop()
+      node.tour_start = len(tour_nodes)
+      tour_nodes.append(node)
+      pending_nodes.extend(reversed(node.children))
+  # the subtree of a node ends with the subtree of its last child
+  for node in reversed(tour_nodes):
+    node.tour_end = node.children[-1].tour_end if node.children else node.tour_start + 1
+  if isinstance(tree_by_taxid, TaxonomyTree):
+    tree_by_taxid.tour_nodes = tour_nodes
+    tree_by_taxid.lca_index = None
+  return tour_nodes
+
+
 def clear_abundance_from_tree(tree_by_taxid: dict):
+  # Array trees clear all abundance arrays at once
+  if hasattr(tree_by_taxid, "clear_abundance"):
+    tree_by_taxid.clear_abundance()
+    return
+  root_nodes = getattr(tree_by_taxid, "root_nodes", None)
+  if root_nodes is not None:
+    # Clear only the lineages of the touched nodes, up to a node already cleared
+    cleared_nodes = set()
+    for root_node in root_nodes:
+      for node in root_node.touched_nodes:
+        while node is not None and id(node) not in cleared_nodes:
+          node.clear_abundance()
+          cleared_nodes.add(id(node))
+          node = node.parent
+      root_node.touched_nodes = []
+    return
   # Loop throught all tree nodes and clear it
+  root_nodes = {}
   for value in tree_by_taxid.values():
     value.clear_abundance()
+    if value.parent is None:
+      root_nodes[id(value)] = value
+  # Start tracking the touched nodes in the tree roots
+  if isinstance(tree_by_taxid, TaxonomyTree):
+    for root_node in root_nodes.values():
+      root_node.touched_nodes = []
+    tree_by_taxid.root_nodes = list(root_nodes.values())
+
+
+def get_nodes_with_abundance(tree_by_taxid: dict):
+  # Array trees select the nodes from the abundance arrays
+  if hasattr(tree_by_taxid, "get_nodes_with_abundance"):
+    return tree_by_taxid.get_nodes_with_abundance()
+  return ((taxid, node) for taxid, node in tree_by_taxid.items()
+    if node.acumulated_abundance > 0)
+
+
+def add_abundance_by_taxid(tree_by_taxid: dict, taxid_abundance: dict):
+  # Array trees accumulate all abundances in a single bottom-up pass
+  if hasattr(tree_by_taxid, "add_abundance_by_taxid"):
+    tree_by_taxid.add_abundance_by_taxid(taxid_abundance)
+    return
+  # Walk to the root only once for each taxid
+  for taxid, abundance in taxid_abundance.items():
+    tree_by_taxid[taxid].add_abundance(abundance)
 
 
 def get_abundance(tree_by_taxid: dict, taxid: int):
@@ -172,54 +307,179 @@ def get_abundance(tree_by_taxid: dict, taxid: int):
   return abundance
 
 
-def load_tree_from_taxonomy_files(names_file: str, nodes_file: str, merged_file=""):
+def get_line_chunks(file_name: str, nchunks: int):
+  # byte ranges of the file with about the same size, split at line boundaries
+  file_size = os.path.getsize(file_name)
+  offsets = [0]
+  with open(file_name, "rb") as file:
+    for chunk_index in range(1, nchunks):
+      file.seek(max(offsets[-1], file_size * chunk_index // nchunks))
+      file.readline()
+      offsets.append(min(file.tell(), file_size))
+  offsets.append(file_size)
+  offsets = sorted(set(offsets))
+  return [(file_name, start, end) for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def read_line_chunk(chunk):
+  file_name, start, end = chunk
+  with open(file_name, "rb") as file:
+    file.seek(start)
+    data = file.read(end - start)
+  lines = data.decode("utf-8").split("\n")
+  if lines[-1] == "":
+    lines.pop()
+  return [line.rstrip("\r") for line in lines]
+
+
+def parse_names_chunk(chunk):
+  # scientific name of each taxid in the chunk of names.dmp
   taxid_names = {}
-  with open(names_file, "r") as f:
-    reader = csv.reader(f, delimiter='|')
-    for row in reader:
-      tax_id = row[0].strip()
-      name_txt = row[1].strip()
-      name_class = row[3].strip()
-      if name_class == "scientific name":
-        taxid_names[tax_id] = name_txt
+  for line in read_line_chunk(chunk):
+    if "scientific name" not in line:
+      continue
+    row = line.split("|")
+    if row[3].strip() == "scientific name":
+      taxid_names[row[0].strip()] = row[1].strip()
+  return taxid_names
+
+
+def parse_nodes_chunk(chunk):
+  # (taxid, parent taxid, level) of each line in the chunk of nodes.dmp,
+  # or (None, row) for the invalid lines
+  nodes = []
+  for line in read_line_chunk(chunk):
+    row = line.split("|", 3)
+    if len(row) > 3:
+      nodes.append((row[0].strip(), row[1].strip(), row[2].strip()))
+    else:
+      nodes.append((None, row))
+  return nodes
+
+
+def parse_taxonomy_files(names_file: str, nodes_file: str, nprocesses=1):
+  """
+  Parse names.dmp and nodes.dmp concurrently, each split in chunks of lines
+  parsed by a pool of processes.
+  Returns:
+    taxid_names (dict): mapping of taxid to scientific name
+    nodes (list): (taxid, parent taxid, level) of each line of nodes.dmp in file order
+  """
+  if nprocesses <= 1:
+    taxid_names = parse_names_chunk(get_line_chunks(names_file, 1)[0])
+    nodes = parse_nodes_chunk(get_line_chunks(nodes_file, 1)[0])
+    return taxid_names, nodes
+  names_chunks = get_line_chunks(names_file, nprocesses * 4)
+  nodes_chunks = get_line_chunks(nodes_file, nprocesses * 4)
+  with multiprocessing.Pool(nprocesses) as pool:
+    names_results = pool.map_async(parse_names_chunk, names_chunks)
+    nodes_results = pool.map_async(parse_nodes_chunk, nodes_chunks)
+    taxid_names = {}
+    for chunk_names in names_results.get():
+      taxid_names.update(chunk_names)
+    nodes = []
+    for chunk_nodes in nodes_results.get():
+      nodes.extend(chunk_nodes)
+  return taxid_names, nodes
+
+
+def get_subtree_taxids(parent_by_taxid: dict, keep_taxids):
+  """
+  Get the taxids in the subtrees of the given taxids plus their lineage to the root.
+  Parameters:
+    parent_by_taxid (dict): parent taxid of every taxid in nodes.dmp
+    keep_taxids (set): root taxids of the subtrees to keep
+  Returns:
+    dict: taxid of every node to True if it is kept in the taxonomy tree
+  """
+  keep_taxids = {str(taxid).strip() for taxid in keep_taxids}
+  for taxid in keep_taxids - parent_by_taxid.keys():
+    print(f"Taxid to keep not found in taxonomy: {taxid}")
+  # walk up from each taxid until a taxid with known result, then set the path
+  is_kept = {taxid: True for taxid in keep_taxids if taxid in parent_by_taxid}
+  for taxid in parent_by_taxid:
+    path, current_taxid = [], taxid
+    while current_taxid not in is_kept:
+      path.append(current_taxid)
+      parent_taxid = parent_by_taxid.get(current_taxid)
+      if parent_taxid is None or parent_taxid == current_taxid:
+        # reached the root without passing by a kept taxid
+        is_kept[current_taxid] = False
+        break
+      current_taxid = parent_taxid
+    for path_taxid in path:
+      is_kept[path_taxid] = is_kept[current_taxid]
+  # include the lineage of the subtree roots up to the root
+  for taxid in keep_taxids:
+    while taxid in parent_by_taxid:
+      is_kept[taxid] = True
+      parent_taxid = parent_by_taxid[taxid]
+      if parent_taxid == taxid:
+        break
+      taxid = parent_taxid
+  return is_kept
+
+
+def load_tree_from_taxonomy_files(names_file: str, nodes_file: str, merged_file="",
+                                  keep_taxids=None, nprocesses=1):
+  """
+  Load the taxonomy tree from the NCBI taxdump files.
+  Parameters:
+    names_file (str): names.dmp file
+    nodes_file (str): nodes.dmp file
+    merged_file (str): merged.dmp file, optional
+    keep_taxids (set): if given only the subtrees of these taxids and their lineage
+      to the root are loaded, the other nodes are pruned while parsing
+    nprocesses (int): number of processes parsing names.dmp and nodes.dmp
+  Returns:
+    root_node (TreeNode): root node of the taxonomy tree
+    tree_by_taxid (dict): mapping of taxid to TreeNode, including merged taxids
+  """
+  taxid_names, nodes = parse_taxonomy_files(names_file, nodes_file, nprocesses)
+  is_kept = None
+  if keep_taxids is not None:
+    parent_by_taxid = {node[0]: node[1] for node in nodes if node[0] is not None}
+    is_kept = get_subtree_taxids(parent_by_taxid, keep_taxids)
+    print(f"Keeping {sum(is_kept.values())} taxids from the subtrees of: {keep_taxids}")
+    taxid_names = {taxid: name for taxid, name in taxid_names.items()
+      if is_kept.get(taxid, False)}
   print(f"Length of names by taxid tree: {len(taxid_names)}")
   
-  tree_by_taxid = {}
+  tree_by_taxid = TaxonomyTree()
   parent_by_taxid = {}
-  with open(nodes_file, "r") as file:
-    csv_reader = csv.reader(file, delimiter='|')
-    for row in csv_reader:
-      if len(row) > 3:
-        taxid = row[0].strip()
-        level = row[2].strip()
-        name = taxid_names[taxid]
-        new_node = TreeNode(name, taxid, level)
-        # check for invalid values
-        # if new_node.level_enum is None:
-        #   # print(f"Invalid level: '{row}'")
-        #   continue
-        if taxid in tree_by_taxid:                    
-          print(f"Duplicate taxid: new='{row}' existing='{tree_by_taxid[taxid]}")
-          continue         
-        # set node in dict tree
-        tree_by_taxid[taxid] = new_node
-        # set parent for taxid
-        parent_by_taxid[taxid] = row[1].strip()
-      else:
-        print(f"Invalid line: {row}")
+  for node in nodes:
+    if node[0] is None:
+      print(f"Invalid line: {node[1]}")
+      continue
+    taxid, parent_taxid, level = node
+    if is_kept is not None and not is_kept.get(taxid, False):
+      continue
+    if taxid in tree_by_taxid:
+      print(f"Duplicate taxid: new='{node}' existing='{tree_by_taxid[taxid]}")
+      continue
+    # set node in dict tree
+    tree_by_taxid[taxid] = TreeNode(taxid_names[taxid], taxid, level)
+    # set parent for taxid
+    parent_by_taxid[taxid] = parent_taxid
+  root_nodes = []
   for taxid,node in tree_by_taxid.items():
     parent_taxid = parent_by_taxid[taxid]
     if parent_taxid == taxid:
       print(f"Setting parent none for node: {node}")
+      root_nodes.append(node)
       continue
     parent_node = tree_by_taxid[parent_taxid]
     node.set_parent_node(parent_node)
-  for taxid,node in tree_by_taxid.items():    
-    parent_node = node.parent
-    while parent_node is not None and node.level_enum is None:
-      if parent_node.level_enum is not None:
-        node.level_enum = parent_node.level_enum
-      parent_node = parent_node.parent
+  # nodes without level inherit the level of the closest ancestor with level,
+  # visiting the parents before their children
+  pending_nodes = root_nodes
+  while pending_nodes:
+    node = pending_nodes.pop()
+    for child_node in node.children:
+      if child_node.level_enum is None:
+        child_node.level_enum = node.level_enum
+      pending_nodes.append(child_node)
+  set_euler_tour(tree_by_taxid)
   print(f"Length of taxonomy taxid tree: {len(tree_by_taxid)}")
   
   # include merged taxids
@@ -230,8 +490,12 @@ def load_tree_from_taxonomy_files(names_file: str, nodes_file: str, merged_file=
       for row in reader:      
         old_tax_id = row[0].strip()
         new_tax_id = row[1].strip()
-        if old_tax_id not in tree_by_taxid and new_tax_id in tree_by_taxid:
+        # pruned nodes are still valid taxids and can't be merged
+        is_pruned = is_kept is not None and old_tax_id in is_kept
+        if old_tax_id not in tree_by_taxid and new_tax_id in tree_by_taxid and not is_pruned:
           tree_by_taxid[old_tax_id] = tree_by_taxid[new_tax_id]
+        elif is_kept is not None and not is_kept.get(new_tax_id, False):
+          continue
         else:        
           print(f"Invalid merged taxid: old='{old_tax_id}' new='{new_tax_id}'")
   
@@ -239,7 +503,7 @@ def load_tree_from_taxonomy_files(names_file: str, nodes_file: str, merged_file=
 
 
 def load_tree_from_kraken_report(kraken_report_file: str):
-  tree_by_taxid = {}
+  tree_by_taxid = TaxonomyTree()
   root_node, last_node = None, None
   with open(kraken_report_file, 'r') as file:
     for line in file:
@@ -269,6 +533,7 @@ def load_tree_from_kraken_report(kraken_report_file: str):
         # print(f"New node: {new_node}")
       else:
         print(f"Invalid line: {line}")
+  set_euler_tour(tree_by_taxid)
   print(f"Length report taxid tree: {len(tree_by_taxid)}")
   return root_node, tree_by_taxid
 